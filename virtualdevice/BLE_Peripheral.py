@@ -1,7 +1,6 @@
 import sys
 import os
 import json
-import subprocess
 
 # Force stdout to be line-buffered and unbuffered env
 sys.stdout.reconfigure(line_buffering=True)
@@ -12,8 +11,16 @@ os.environ["PYTHONUNBUFFERED"] = "1"
 DEVICE_SPEC_PATH = sys.argv[1] 
 
 import threading
+import signal
 import time
 
+from file_watcher import FileWatcher
+from device_spawner import launch_device
+from device_events import open_event_pipe, read_events
+from persistence_journal import atomic_write
+from device_state import get_state_file, FLAG_SETUP_COMPLETE
+from fleet_supervisor import RestartBackoff
+
 device_id = sys.argv[2] 
 
 device_id = sys.argv[2]  # Initial fallback
@@ -33,13 +40,23 @@ update_file = f"data.json"  # ← MUST be outside the try-except
 # Global variable to store the update path
 current_update_path = "data.json"
 
+# Wakes up only when an update file is actually written (inotify, stat polling as fallback)
+update_watcher = FileWatcher()
+
 def handle_stdin_updates():
+    global current_update_path
     for line in sys.stdin:
         try:
             print("[BLE_Peripheral] 🛰️ Received raw stdin:", line.strip())
             update = json.loads(line.strip())
             device_id = update.get("device_id")
             update_path = update.get("update_path")
+
+            # Direct push: values inline in the message, no file round trip
+            if device_id and "characteristics" in update:
+                apply_updates(DEVICE_SPEC_PATH, update["characteristics"])
+                continue
+
             if not device_id or not update_path:
                 print("[BLE_Peripheral] ❌ Missing device_id or update_path")
                 continue
@@ -47,47 +64,78 @@ def handle_stdin_updates():
             # ✅ Confirm file path received
             print(f"[BLE_Peripheral] Update path received: {update_path}")
 
+            # Shared-memory tables are read by the device process itself
+            if update_path.endswith(".values"):
+                print(f"[BLE_Peripheral] ✅ {device_id} reads updates from {update_path}")
+                continue
+
             with open(f"{device_id}_update_path.txt", "w") as f:
                 f.write(update_path)
             print(f"[BLE_Peripheral] ✅ Saved update path for {device_id}")
 
+            # Follow the newest update file; it is applied now and on every rewrite
+            update_watcher.unwatch(current_update_path)
+            current_update_path = update_path
+            start_update_watcher(DEVICE_SPEC_PATH, update_path)
+
         except Exception as e:
             print(f"[BLE_Peripheral] ❌ Error parsing stdin update: {e}")
 
 
+def apply_updates(device_spec_path, updates):
+    """Merge {service_uuid: {char_uuid: value}} into the spec in one pass."""
+    # Some producers wrap the table as {"device_id": ..., "characteristics": {...}}
+    updates = updates.get("characteristics", updates)
+    flat = {}
+    for service_uuid, chars in updates.items():
+        if isinstance(chars, dict):
+            flat.update(chars)
+    if not flat:
+        return False
+
+    with open(device_spec_path, "r") as f:
+        spec = json.load(f)
+
+    changed = False
+    for service in spec.get("gatt", {}).get("services", []):
+        for char in service.get("characteristics", []):
+            uuid = char.get("uuid")
+            if uuid in flat and char.get("initial_value") != flat[uuid]:
+                print(f"[{device_id}]  Updating {uuid} to {flat[uuid]}")
+                char["initial_value"] = flat[uuid]
+                changed = True
+    if changed:
+        # Atomic replace, so the running VirtualDevice never sees a half-written spec
+        atomic_write(device_spec_path, lambda f: json.dump(spec, f, indent=4))
+        print(f"[{device_id}] ✅ Updated spec with new values.")
+    return changed
+
+
 def apply_updates_from_file(device_spec_path, update_file):
     try:
         with open(update_file, "r") as f:
             updates = json.load(f)
-        with open(device_spec_path, "r") as f:
-            spec = json.load(f)
-
-        changed = False
-        for service in spec.get("gatt", {}).get("services", []):
-            for char in service.get("characteristics", []):
-                uuid = char.get("uuid")
-                for service_uuid, chars in updates.items():
-                    if uuid in chars:
-                        new_value = chars[uuid]
-                        if char.get("initial_value") != new_value:
-                            print(f"[dev123]  Updating {uuid} to {new_value}")
-                            char["initial_value"] = new_value
-                            changed = True
-        if changed:
-            with open(device_spec_path, "w") as f:
-                json.dump(spec, f, indent=4)
-            print("[dev123] ✅ Updated spec with new values.")
+        apply_updates(device_spec_path, updates)
     except Exception as e:
-        print(f"[dev123] ❌ Error applying updates: {e}")
+        print(f"[{device_id}] ❌ Error applying updates: {e}")
+
+def start_update_watcher(device_spec_path, update_file):
+    """Apply update_file now and again every time it is rewritten."""
+    apply_updates_from_file(device_spec_path, update_file)
+    update_watcher.watch(update_file, lambda path: apply_updates_from_file(device_spec_path, path))
 
-def start_update_loop(device_spec_path, update_file, interval=1):
-    def loop():
-        while True:
-            apply_updates_from_file(device_spec_path, update_file)
-            time.sleep(interval)
-    threading.Thread(target=loop, daemon=True).start()
+def _state_flags():
+    """Flags of this device's snapshot slot, None before its first run (or without a state file)."""
+    try:
+        return get_state_file().flags(device_id)
+    except Exception as e:
+        print(f"⚠️ Device state file unavailable: {e}")
+        return None
 
 def read_setup_status():
+    flags = _state_flags()
+    if flags is not None:
+        return "YES" if flags & FLAG_SETUP_COMPLETE else "NO"
     try:
         with open(DEVICE_SPEC_PATH, "r") as f:
             data = json.load(f)
@@ -96,6 +144,9 @@ def read_setup_status():
         return "NO"
 
 def set_setup_status(status):
+    if _state_flags() is not None:
+        get_state_file().set_setup(device_id, status.upper() == "YES")
+        return
     try:
         with open(DEVICE_SPEC_PATH, "r") as f:
             data = json.load(f)
@@ -106,6 +157,11 @@ def set_setup_status(status):
         print(f"❌ Failed to update setup status: {e}")
         
 def set_value_status(status):
+    if _state_flags() is not None:
+        # Applied (and written back to the spec) by the device on its next start
+        get_state_file().reset(device_id, status.upper())
+        print("✅ All characteristic initial values reset.")
+        return
     try:
         with open(DEVICE_SPEC_PATH, "r") as f:
             data = json.load(f)
@@ -134,37 +190,40 @@ if len(sys.argv) > 2 and sys.argv[2] == "--reset":
 
 setup_status = read_setup_status()
 
+update_watcher.start()
+threading.Thread(target=handle_stdin_updates, daemon=True).start()
+
 if setup_status == "NO":
     print("Starting commissioning mode...")
     update_file = f"{device_id}_update.json"
-    commissioning_process = subprocess.Popen(
-
-    ["python", "VirtualDevice.py", DEVICE_SPEC_PATH, "Readings2.csv", "android-netsim", device_id],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT,
-        text=True
-    )
-    os.environ['PYTHONUNBUFFERED'] = "1"
-    print("BLE_PERIPHERAL_READY", flush=True)
-
-    for line in commissioning_process.stdout:
-        print("[DEVICE]", line.strip())
-        if "Disconnected from" in line or "reason:" in line:  # <- Bumble log disconnection pattern
-            print(" COMMISSIONING DONE (via disconnect log)")
-            commissioning_process.terminate()
-            commissioning_process.wait()
-            set_setup_status("YES")
-            break
-
-
-print(" Starting normal mode...")
-
-
-normal_process = subprocess.Popen( ["python", "VirtualDevice.py", DEVICE_SPEC_PATH, "Readings2.csv", "android-netsim", device_id])
-normal_process.wait()
 
-os.environ['PYTHONUNBUFFERED'] = "1"
-print("BLE_PERIPHERAL_READY", flush=True)
+# One device process for both modes: it reports ready/connected/commissioned/
+# disconnected on the event pipe and switches to normal mode by itself.
+# Forked from a warm spawner when VIRTUAL_DEVICE_SPAWNER is set, fresh interpreter otherwise.
+# A crashed device is started again (with backoff) instead of silently disappearing.
+backoff = RestartBackoff()
+while True:
+    events_fd, device_events_fd = open_event_pipe()
+    device_process = launch_device([DEVICE_SPEC_PATH, "Readings2.csv", "android-netsim", device_id],
+                                   event_fd=device_events_fd)
+    os.close(device_events_fd)
+    started = time.monotonic()
+
+    for event in read_events(events_fd):
+        print("[DEVICE EVENT]", json.dumps(event))
+        if event["event"] == "ready":
+            print("BLE_PERIPHERAL_READY", flush=True)
+        elif event["event"] == "commissioned":
+            # The device has already saved setup_complete=YES and is advertising again
+            print(" COMMISSIONING DONE, now in normal mode")
+
+    code = device_process.wait()
+    if code == 0 or (code < 0 and -code in (signal.SIGTERM, signal.SIGINT)):
+        break
+    delay = backoff.next(time.monotonic() - started)
+    print("[DEVICE EVENT]", json.dumps({"event": "crashed", "device_id": device_id, "code": code,
+                                        "restart_in": delay}))
+    time.sleep(delay)
 
 import sys
 import threading
@@ -5,6 +5,9 @@ from datetime import datetime  # Optional: for timestamped logs
 
 from mqtt_client import MqttClient
 from device_managers import start_virtual_device, update_ble_peripheral
+from agent_pipeline import AgentPipeline
+from topic_router import TopicRouter
+from metrics import get_metrics, get_registry, start_metrics_server
 
 
 
@@ -24,16 +27,29 @@ mqtt.connect()
 
  #  Make sure this import is correct
 
+# /data handling runs on its own event loop: per-device bounded queues,
+# last value wins per characteristic, so the MQTT callback thread only enqueues
+pipeline = AgentPipeline(update_ble_peripheral).start()
+STATS_INTERVAL = config.get("stats_interval", 10)
+
+# Per-device Prometheus text on a local port and, if enabled, on /<host>/<device_id>/metrics
+if config.get("metrics_port") is not None:
+    start_metrics_server(config["metrics_port"])
+METRICS_MQTT = config.get("metrics_mqtt", False)
+
 def on_data_message(client, userdata, msg):
-    try:
-        payload = msg.payload.decode()
-        data = json.loads(payload)
-        print(f"[AGENT] Received /data payload: {data}")
-        update_ble_peripheral(data)
-    except Exception as e:
-        print(f"[AGENT]  Error handling data message: {e}")
-        
-    
+    if not pipeline.submit(msg.payload, msg.topic):
+        print(f"[AGENT]  Data backlog full, dropped message on {msg.topic}")
+
+
+# A handful of wildcard subscriptions at the broker; per-device routing happens
+# in this trie, so starting a device costs no broker round trip
+router = TopicRouter()
+WILDCARD_TOPICS = list(dict.fromkeys([
+    f"/{AGENT_HOSTNAME}/+/spec",
+    f"/{AGENT_HOSTNAME}/+/data",
+    "/gppr_doppelio/+/data",       # external data topic used in incoming MQTT
+]))
 
 
 def on_spec(client, userdata, msg):
@@ -46,39 +62,40 @@ def on_spec(client, userdata, msg):
         return
 
     device_id = msg.topic.split('/')[-2]
+    metrics = get_metrics(device_id)
+    metrics.inc("agent_messages_total", kind="spec")
     print(f"[AGENT] Starting /'{device_id}'/deviceready.")
-    ready = start_virtual_device(device_id, device_spec, mqtt, AGENT_HOSTNAME)
+    with metrics.time("agent_device_start_seconds"):
+        ready = start_virtual_device(device_id, device_spec, mqtt, AGENT_HOSTNAME)
 
     if ready:
         deviceready_topic = f"/{AGENT_HOSTNAME}/{device_id}/deviceready"
         print(f"[AGENT] Device '{device_id}' is ready. Publishing deviceready.")
         mqtt.publish(deviceready_topic, "")
 
-        # Subscribe to the data topic for this device now
-    # Subscribe to BOTH agent-hosted and backend-hosted data topic
+    # Route the agent-hosted data topic for this device now (the backend-hosted
+    # one is the same topic, so it is routed once)
     agent_data_topic = f"/{AGENT_HOSTNAME}/{device_id}/data"
-    backend_data_topic = f"/{AGENT_HOSTNAME}/{device_id}/data"
-    
-    mqtt.subscribe_sync(agent_data_topic, on_data_message)
-    mqtt.subscribe_sync(backend_data_topic, on_data_message)  
+    router.add(agent_data_topic, on_data_message)
 
 
 
 def handle_startdevice(device_id):
+    get_metrics(device_id).inc("agent_messages_total", kind="startdevice")
     spec_topic = f"/{AGENT_HOSTNAME}/{device_id}/spec"
     getspec_topic = f"/{AGENT_HOSTNAME}/{device_id}/getspec" 
-    data_topic = f"/{AGENT_HOSTNAME}/{device_id}/data"   # Add this line
 
-    print(f"[AGENT] Subscribing to spec topic '{spec_topic}' with callback")
-    mqtt.subscribe_sync(spec_topic, on_spec)
+    # Route before requesting the spec so the reply can't race us
+    print(f"[AGENT] Routing spec topic '{spec_topic}'")
+    router.add(spec_topic, on_spec)
 
     print(f"[AGENT] Requesting spec for device '{device_id}' on topic '{getspec_topic}'")
     mqtt.publish(getspec_topic, "")
     
     # Correctly subscribe to external data topic used in incoming MQTT
     external_data_topic = f"/gppr_doppelio/{device_id}/data"
-    print(f"[AGENT] Subscribing to EXTERNAL data topic '{external_data_topic}'")
-    mqtt.subscribe_sync(external_data_topic, on_data_message)
+    print(f"[AGENT] Routing EXTERNAL data topic '{external_data_topic}'")
+    router.add(external_data_topic, on_data_message)
 
     
    
@@ -101,14 +118,29 @@ def on_startdevice(client, userdata, msg):
 topic = f"/{AGENT_HOSTNAME}/startdevice"
 mqtt.subscribe_sync(topic, on_startdevice)
 
+for wildcard_topic in WILDCARD_TOPICS:
+    print(f"[AGENT] Subscribing to '{wildcard_topic}'")
+    mqtt.subscribe_sync(wildcard_topic, router.dispatch)
+
 
 
 print("[AGENT] Agent is now running. Press Ctrl+C to stop.")
 try:
+    last_stats = time.time()
     while True:
         time.sleep(1)
+        if STATS_INTERVAL and time.time() - last_stats >= STATS_INTERVAL:
+            last_stats = time.time()
+            # Per-device queue depth, drops and MQTT-to-GATT latency
+            mqtt.publish(f"/{AGENT_HOSTNAME}/agentstats",
+                         json.dumps({**pipeline.stats(), "router": router.stats()}))
+            if METRICS_MQTT:
+                registry = get_registry()
+                for device_id in registry.devices():
+                    mqtt.publish(f"/{AGENT_HOSTNAME}/{device_id}/metrics", registry.render(device_id))
 except KeyboardInterrupt:
     print("[AGENT] Stopping agent...")
+    pipeline.stop()
     mqtt.disconnect()
 
 
@@ -1,18 +1,32 @@
 # MQTTJSONmanager.py
 
+import os
 import tempfile
 import json
 
+from shared_values import SharedValueWriter
+
 class MQTTJsonManager:
     def __init__(self):
         self.current_json_path = None
+        # Values go straight into the device's shared-memory table; the
+        # device process picks them up without any file being created
+        self.shared = SharedValueWriter()
 
     def write_json(self, device_id, data):
-        with tempfile.NamedTemporaryFile("w", delete=False, suffix="_update.json") as f:
-            json.dump(data, f, indent=4)
-            self.current_json_path = f.name
-        print(f"[MQTTJsonManager] ✅ JSON written to {self.current_json_path}")
-        return self.current_json_path
+        try:
+            path, written = self.shared.write_update(device_id, data)
+        except OverflowError as e:
+            print(f"[MQTTJsonManager] ⚠️ {e}, falling back to a JSON file")
+            # One update file per device, replaced on each fallback instead of piling up
+            path = os.path.join(tempfile.gettempdir(), f"{device_id}_update.json")
+            with open(path + ".tmp", "w") as f:
+                json.dump(data, f, indent=4)
+            os.replace(path + ".tmp", path)
+        self.current_json_path = path
+        print(f"[MQTTJsonManager] ✅ Values written to {path}")
+        # Concurrent writes for other devices may already have moved current_json_path
+        return path
 
     def update_path(self, path):
         self.current_json_path = path
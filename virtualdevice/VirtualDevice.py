@@ -1,24 +1,45 @@
+import startup_timing  # first, so the import phase is timed from here
+
+import os
 import sys
 import asyncio
-import json
+import struct
 import logging
-import threading
-import time
-import random
 
-from bumble.transport import open_transport_or_link
-from bumble.device import Device
+from bumble.device import Device, DeviceConfiguration
 from bumble.gatt import Service, Characteristic
 from bumble.gatt import Service as _s
-from bumble.core import AdvertisingData, UUID
 from bumble.att import Attribute
 from bumble import hci
 
-import pandas as pd 
-
-logging.basicConfig(level=logging.DEBUG)
+from value_store import get_value_store, normalize_uuid
+from persistence_journal import (enable_spec_journal, get_readings_journal, open_readings_journal,
+                                 close_readings_journal, start_journals)
+from readings_cache import readings_cache
+from file_watcher import FileWatcher
+from connection_lifecycle import ConnectionLifecycle
+from notification_scheduler import get_notification_scheduler
+from readings_replay import start_replay
+from value_generators import start_generators
+from value_codecs import compile_codec
+from profile_cache import profile_cache
+from advertising_engine import AdvertisingEngine
+from gatt_sessions import SessionManager, get_session
+from long_values import install_long_values, snapshot_for, remember_snapshot
+from shared_values import SharedValueReader, remove_table
+from device_events import get_event_channel
+from device_state import get_state_file, restore_state, apply_state, restore_bonds, StateSaver
+from device_logging import setup_logging, device_logger, dump_recent, install_signal_handlers, shutdown_logging
+from metrics import get_metrics, get_registry, start_metrics_server, metrics_port, METRICS_PORT_ENV
+
+# Lifecycle is reported on the event channel (device_events.py), so nothing
+# parses log output any more. Records are written by a background thread;
+# VIRTUAL_DEVICE_LOG_LEVEL / VIRTUAL_DEVICE_BUMBLE_LOG_LEVEL set the levels
+setup_logging()
 logger = logging.getLogger(__name__)
 
+startup_timing.process_timer.mark("import")
+
 
 # BLE disconnection reason map
 BLE_REASON_MAP = {
@@ -53,16 +74,27 @@ PERMISSION_MAP = {
 }
 
 class DynamicCharacteristic(Characteristic):
-    def __init__(self, uuid, properties, permissions, initial_value, json_file , csv_file):
+    def __init__(self, uuid, properties, permissions, initial_value, json_file , csv_file, value_store=None, codec=None,
+                 metrics=None, template=None):
         self.properties_list = properties
         self.permissions_list = permissions
         self.json_file = json_file  # This should be the path to the JSON file, not a dictionary
+        self.value_store = value_store or get_value_store(json_file)
         self.uuid_str = uuid
         self.value = initial_value
         self.csv_file = csv_file
-
-        prop_flags = sum(getattr(Characteristic.Properties, prop.upper(), 0) for prop in properties)
-        perm_flags = sum(PERMISSION_MAP.get(perm.lower(), 0) for perm in permissions)
+        # Compiled once from the spec's "format"; the hot paths never inspect strings
+        self.codec = codec or compile_codec(None)
+        self.metrics = metrics or get_metrics(os.path.basename(json_file))
+        # Per-device logger; the per-read/write lines below are sampled
+        self.log = device_logger(self.metrics.device_id)
+
+        if template is not None:
+            # Precompiled in the shared GATT profile (profile_cache.py)
+            prop_flags, perm_flags = template.prop_flags, template.perm_flags
+        else:
+            prop_flags = sum(getattr(Characteristic.Properties, prop.upper(), 0) for prop in properties)
+            perm_flags = sum(PERMISSION_MAP.get(perm.lower(), 0) for perm in permissions)
 
         super().__init__(uuid, prop_flags, perm_flags, initial_value)
         
@@ -70,10 +102,11 @@ class DynamicCharacteristic(Characteristic):
         """Reads the latest value for the characteristic from the CSV file."""
         if self.csv_file:
             try:
-                df = pd.read_csv(self.csv_file)
+                with self.metrics.time("csv_io_seconds", op="read"):
+                    table = readings_cache.table(self.csv_file)
 
-                if self.name in df.columns:
-                    latest_value = df[self.name].dropna().iloc[-1]
+                if self.name in table.columns:
+                    latest_value = table.latest(self.name)
                     return int(latest_value)  
                 else:
                     logger.error(f"Characteristic '{self.name}' not found in CSV columns.")
@@ -84,21 +117,19 @@ class DynamicCharacteristic(Characteristic):
     async def read_csv_value(self, connection):
         """Returns the current value from CSV when read."""
         self.value = self.read_csv_data()
-        logger.info(f"Read {self.uuid} ({self.name}): {self.value}")
-        return bytes([self.value])  
+        self.log.info("Read %s (%s): %s", self.uuid, self.name, self.value)
+        return self.codec.encode(self.value)
 
     def load_initial_value_from_csv(self):
             """Loads initial value from CSV based on UUID."""
             if not self.csv_file:
                 return None
             try:
-                df = pd.read_csv(self.csv_file)
-                match = df[df["uuid"] == self.uuid]  
-                if not match.empty:
-                    val = match.iloc[0]["value"]
-                    if isinstance(val, str) and val.startswith("0x"):
-                        return bytes.fromhex(val[2:])  
-                    return val.encode() if isinstance(val, str) else bytes([int(val)])
+                val = get_readings_journal(self.csv_file).pending.get(self.uuid_str)
+                if val is None:
+                    val = readings_cache.table(self.csv_file).value_for_uuid(self.uuid_str)
+                if val is not None:
+                    return self.codec.encode(val)
             except Exception as e:
                 logger.error(f"Error loading initial value for {self.uuid} from CSV: {e}")
             return None
@@ -109,96 +140,77 @@ class DynamicCharacteristic(Characteristic):
 
         if self.csv_file:
             try:
-                df = pd.read_csv(self.csv_file)
-                if self.uuid in df["uuid"].values:
-                    df.loc[df["uuid"] == self.uuid, "value"] = value.hex()  
-                else:
-                    new_entry = pd.DataFrame({"uuid": [self.uuid], "value": [value.hex()]})
-                    df = pd.concat([df, new_entry], ignore_index=True)
-                df.to_csv(self.csv_file, index=False)  
-                decoded_value = value.decode('utf-8')
-                self.value = decoded_value
-                logger.info(f" WRITE to {self.uuid_str}: STRING='{decoded_value}'")
+                # Journaled and coalesced; the CSV itself is rewritten on the next flush
+                with self.metrics.time("csv_io_seconds", op="write"):
+                    get_readings_journal(self.csv_file).append(self.uuid_str, value.hex())
+                self.log.debug("CSV write %s: %r", self.uuid_str, value)
             except Exception as e:
                 logger.error(f"Error updating CSV with new value: {e}")
 
 
 
     async def read_value(self, connection):
-        """Read updated value from JSON file."""
-        self.value = self.read_json_value()
-        logger.info(f" Read {self.uuid_str}: {self.value}")
-        return bytes(self.value) if isinstance(self.value, int) else self.value
+        """Read the current (already encoded) value from the value store."""
+        snapshot = snapshot_for(connection, self)
+        if snapshot is not None:
+            # Read Blob of a long value: serve the offset from the offset-0 snapshot
+            return snapshot
+        with self.metrics.time("gatt_read_seconds"):
+            # Value state is shared by every central; only the counts are per session
+            self.value = self.read_json_value()
+        remember_snapshot(connection, self, self.value)
+        session = get_session(connection)
+        if session is not None:
+            session.record_read(len(self.value))
+        self.log.info("Read %s: %s", self.uuid_str, self.value)
+        return self.value
 
     async def write_value(self, connection, value):
         """Handle app write to this characteristic and update JSON."""
-        try:
-            logger.info(f"Received write value: {value}")
-            # Check if it's a UTF-8 encoded string
-            decoded_value = value.decode('utf-8')
-            self.value = decoded_value
-            #logger.info(f"✍️ WRITE to {self.uuid_str}: STRING='{decoded_value}'")
-        except UnicodeDecodeError:
-            # Handle if it's not a string (maybe bytes)
-            self.value = int.from_bytes(value, byteorder="little")
-            logger.info(f"✍️ WRITE to {self.uuid_str}: HEX={hex(self.value)}")
-
-        self.update_readings_json()
-        await self.write_csv_value(connection, value)
+        with self.metrics.time("gatt_write_seconds"):
+            value = bytes(value)
+            self.value = value
+            session = get_session(connection)
+            if session is not None:
+                session.record_write(len(value))
+            decoded_value = self.codec.decode(value)
+            self.log.info("✍️ WRITE to %s: %r", self.uuid_str, decoded_value)
+
+            self.update_readings_json(decoded_value)
+            await self.write_csv_value(connection, value)
 
     def read_json_value(self):
-        """Load value from JSON for this characteristic UUID."""
+        """Look up the value for this characteristic UUID in the device's value store."""
         try:
-            with open(self.json_file, "r") as f:
-                data = json.load(f)
-
-            for service in data.get("gatt", {}).get("services", []):
-                for char in service.get("characteristics", []):
-                    if char.get("uuid", "").lower() == self.uuid_str.lower():
-                        value_str = char.get("initial_value", "0x00")
-                        if isinstance(value_str, str) and value_str.startswith("0x"):
-                            return bytes.fromhex(value_str[2:])
-                        else:
-                            return value_str.encode()
-
+            # Only re-parses when the spec was changed behind our back
+            with self.metrics.time("json_io_seconds", op="read"):
+                self.value_store.reload_if_changed()
+                return self.value_store.get_bytes(self.uuid_str, self.value)
         except Exception as e:
-            logger.error(f" Failed to read value from JSON for {self.uuid_str}: {e}")
+            self.log.error("Failed to read value from JSON for %s: %s", self.uuid_str, e)
         return self.value
 
-    def update_readings_json(self):
-        """Write current value to JSON for this UUID."""
+    def update_readings_json(self, new_value=None):
+        """Write current value to JSON for this UUID, in its spec representation."""
         try:
-            with open(self.json_file, "r") as f:
-                data = json.load(f)
-
-            updated = False
-            for service in data.get("gatt", {}).get("services", []):
-                for char in service.get("characteristics", []):
-                    if char.get("uuid", "").lower() == self.uuid_str.lower():
-                        char["initial_value"] = (
-                            self.value if isinstance(self.value, str) else hex(self.value)
-                        )
-                        updated = True
-                        logger.info(f"📄 JSON Updated: {self.uuid_str} -> {char['initial_value']}")
-                        break
-                if updated:
-                    break
-
-            if updated:
-                with open(self.json_file, "w") as f:
-                    json.dump(data, f, indent=4)
-            else:
-                logger.warning(f"⚠️ UUID {self.uuid_str} not found in JSON file!")
+            with self.metrics.time("json_io_seconds", op="write"):
+                self.value_store.reload_if_changed()
+                if new_value is None:
+                    new_value = self.codec.decode(self.value)
+                changed = self.value_store.set(self.uuid_str, new_value)
+            if changed:
+                self.log.debug("📄 JSON Updated: %s -> %s", self.uuid_str, new_value)
 
         except Exception as e:
-            logger.error(f"❌ Failed to update JSON for {self.uuid_str}: {e}")
+            self.log.error("❌ Failed to update JSON for %s: %s", self.uuid_str, e)
  
 
-def load_services_from_json(config_file, readings_csv):
+def load_services_from_json(config_file, readings_csv, metrics=None):
     """Load services and characteristics from the device_spec.json and a CSV for readings."""
     try:
-        with open(config_file, 'r') as f:
-            config = json.load(f)
+        value_store = get_value_store(config_file)
+        enable_spec_journal(value_store)
+        config = value_store.config
 
         logger.info(f"Loaded config from {config_file}")
     except Exception as e:
@@ -207,113 +219,156 @@ def load_services_from_json(config_file, readings_csv):
 
     try:
         # Load readings from the CSV file
-        readings_df = pd.read_csv(readings_csv)
-        readings = dict(zip(readings_df['uuid'], readings_df['value']))
+        readings = readings_cache.table(readings_csv).as_dict("uuid", "value")
         logger.info(f"Loaded readings from {readings_csv}")
     except Exception as e:
         logger.warning(f" Could not load readings CSV: {e}")
         readings = {}
 
+    # Same model, same compiled templates: only values and bumble objects are per device
+    profile = profile_cache.gatt(value_store, PROPERTY_MAP, PERMISSION_MAP)
+
     services = []
-    for service_data in config.get("gatt", {}).get("services", []):
+    for service_uuid, templates in profile.services:
         characteristics = []
-        for char_data in service_data.get("characteristics", []):
-            uuid = char_data["uuid"]
-            props = sum(PROPERTY_MAP.get(p.lower(), 0) for p in char_data.get("properties", []))
-            perms = sum(PERMISSION_MAP.get(p.lower(), 0) for p in char_data.get("permissions", []))
-            
+        for template in templates:
+            uuid = template.uuid
+
             # Set initial value from CSV or default value
-            val = readings.get(uuid, char_data.get("initial_value", "0x00"))
-            initial_value = bytes.fromhex(val[2:]) if isinstance(val, str) and val.startswith("0x") else val.encode()
+            codec = template.codec
+            val = readings.get(uuid, value_store.get(uuid, "0x00"))
+            try:
+                initial_value = codec.encode(val)
+            except (ValueError, TypeError, struct.error) as e:
+                logger.warning(f"⚠️ Bad initial value {val!r} for {uuid} ({codec.name}): {e}")
+                initial_value = b"\x00" * (codec.size or 1)
 
             # Initialize DynamicCharacteristic with correct file path
             char = DynamicCharacteristic(
                 uuid,
-                properties=[p.lower() for p in char_data.get("properties", [])],
-                permissions=[p.lower() for p in char_data.get("permissions", [])],
+                properties=template.properties,
+                permissions=template.permissions,
                 initial_value=initial_value,
                 json_file=config_file ,
-                csv_file = readings_csv # Ensure this is a path, not a dictionary
+                csv_file = readings_csv, # Ensure this is a path, not a dictionary
+                value_store=value_store,
+                codec=codec,
+                metrics=metrics,
+                template=template
             )
 
             characteristics.append(char)
 
         # Create service with the list of characteristics
-        service = Service(service_data["uuid"], characteristics)
+        service = Service(service_uuid, characteristics)
         services.append(service)
 
     return services
 
  
-#Handle Notifications
-from bumble.att import ATT_Handle_Value_Notification
-async def monitor_and_notify(connection, device):
-    attr = next((a for a in device.gatt_server.attributes
-                 if hasattr(a, 'uuid') and (a.properties & Characteristic.Properties.NOTIFY)), None)
-    print(attr)
-
-    counter = 0
-    
-    value = bytes([0x01, counter % 256])
-    await device.gatt_server.notify_subscriber(
-        connection=connection,
-        attribute=attr,
-        value=value,
-        force=True
-    )
-    logger.info(f"📡 Periodic Notify sent: {value.hex()}")
-    counter += 1
-    await asyncio.sleep(5)
-
-
-async def send_handle_value_notification(connection, characteristic_handle, value):
-    """
-    Send a Handle Value Notification to the client.
-    - connection: The active BLE connection.
-    - characteristic_handle: The handle of the characteristic for which notification is sent.
-    - value: The updated value of the characteristic.
-    """
-    # Ensure the characteristic handle is valid
-    if characteristic_handle is None:
-        logger.error(" Invalid characteristic handle.")
-        return
-
-    # Create the Handle Value Notification packet
-    notification = ATT_Handle_Value_Notification(
-        attribute_handle=characteristic_handle,
-        value=value
-    )
+_spec_watcher = None
+_spec_watcher_loop = None
+NOTIFY_MASK = Characteristic.Properties.NOTIFY | Characteristic.Properties.INDICATE
 
-    # Send the notification
-    connection.send(notification)
-    logger.info(f"📡 Sent Handle Value Notification for handle={characteristic_handle:#04x} with value={value.hex()}")
 
-async def update_characteristic_value(connection, characteristic_handle, new_value):
+def publish_value(device, uuid):
+    """Refresh a characteristic from the value store and notify subscribers if it can."""
+    char = device.characteristics_by_uuid.get(normalize_uuid(uuid))
+    if char is None:
+        return
+    char.value = device.value_store.get_bytes(uuid, char.value)
+    if char.properties & NOTIFY_MASK:
+        asyncio.create_task(device.notify_subscribers(char, char.value))
+        device.metrics.inc("notifications_total", source="update")
+
+
+def apply_characteristic_updates(device, updates):
+    """Apply {service_uuid: {char_uuid: value}} straight to a running device."""
+    updates = updates.get("characteristics", updates)
+    changed = 0
+    for service_uuid, chars in updates.items():
+        if not isinstance(chars, dict):
+            continue
+        for uuid, value in chars.items():
+            if device.value_store.get(uuid) == value:
+                continue
+            if device.value_store.set(uuid, value):
+                publish_value(device, uuid)
+                changed += 1
+    return changed
+
+
+def watch_spec_updates(device, config_file, services):
+    """Push external spec edits (BLE_Peripheral updates) into the live GATT server.
+
+    Changed characteristics are notified to subscribed centrals right away.
+    Uses inotify, so an idle device does no work at all.
     """
-    Update the characteristic value and send a Handle Value Notification to the client.
-    - connection: The active BLE connection.
-    - characteristic_handle: The handle of the characteristic.
-    - new_value: The new value to be updated.
+    value_store = get_value_store(config_file)
+    device.value_store = value_store
+    device.characteristics_by_uuid = {normalize_uuid(char.uuid_str): char
+                                      for service in services for char in service.characteristics
+                                      if isinstance(char, DynamicCharacteristic)}
+
+    def on_spec_changed(path):
+        for uuid in value_store.reload_if_changed():
+            device.log.info("🔄 %s updated externally", uuid)
+            publish_value(device, uuid)
+
+    watcher = get_file_watcher()
+    watcher.watch(config_file, on_spec_changed)
+    return watcher
+
+
+def get_file_watcher():
+    global _spec_watcher, _spec_watcher_loop
+    loop = asyncio.get_running_loop()
+    if _spec_watcher is None:
+        # One inotify fd for every device hosted in this process
+        _spec_watcher = FileWatcher()
+    if _spec_watcher_loop is not loop:
+        # First device, or devices started again under a new event loop
+        _spec_watcher.attach(loop)
+        _spec_watcher_loop = loop
+    return _spec_watcher
+
+
+async def follow_shared_values(device, reader, interval=0.05, idle_check=30.0):
+    """Apply values the agent writes into this device's shared-memory table.
+
+    The task sleeps until the agent rings the table's bell file, so an idle
+    device (or one the agent never writes to) costs nothing; idle_check is
+    only a fallback in case a bell event is lost. After a wake-up, interval
+    lets a burst of agent writes land before they are applied together.
+    Changed slots go through the value store (journaled) and are notified
+    like any other external update.
     """
-    # Update the characteristic's value (in the virtual device)
-    # Here we assume you are keeping track of the value (e.g., in a dictionary or class property)
-    logger.info(f"🔄 Updating characteristic value for handle={characteristic_handle:#04x} to {new_value.hex()}")
-
-    # Send the Handle Value Notification to the client
-    await send_handle_value_notification(connection, characteristic_handle, new_value)
+    bell = asyncio.Event()
+    watcher = get_file_watcher()
+    watcher.watch(reader.bell_path, lambda path: bell.set())
+    try:
+        while True:
+            bell.clear()
+            try:
+                for uuid, value in reader.changes().items():
+                    if device.value_store.get(uuid) == value:
+                        continue
+                    if device.value_store.set(uuid, value):
+                        publish_value(device, uuid)
+            except Exception as e:
+                logger.error(f"❌ Shared value update failed: {e}")
+            if not reader.busy:
+                try:
+                    await asyncio.wait_for(bell.wait(), idle_check)
+                except asyncio.TimeoutError:
+                    pass
+            await asyncio.sleep(interval)
+    finally:
+        watcher.unwatch(reader.bell_path)
 
-# Example function to simulate a value change (e.g., when device name changes)
-async def change_device_name(connection, new_device_name):
-    device_name_handle = 0x0002  # Example handle for Device Name characteristic (you need to get this from your GATT)
-    new_value = new_device_name.encode('utf-8')
 
-    # Trigger the characteristic update and notification
-    await update_characteristic_value(connection, device_name_handle, new_value)
-    
 #from bumble.att import ATT_Notification
 
-import asyncio
-
 async def handle_client(reader, writer):
     addr = writer.get_extra_info('peername')
     print(f"Wi-Fi client connected: {addr}")
@@ -335,121 +390,227 @@ async def start_wifi_server(port=8888):
 
 
 
-async def setup_virtual_device(config_file, readings_csv, transport_path, device_id):
-
-    logger.info(f" Loading config: {config_file}")
-    with open(config_file, 'r') as f:
-        config = json.load(f)
-
-    advertisement_data = config.get("advertisement", {})
-   # setup = config.get("setup_complete:,"")
-    local_name = advertisement_data.get("local_name", "Virtual_Device")
-    flags = advertisement_data.get("flags", 0x06)
-    service_uuids = advertisement_data.get("service_uuids", [])
-    manufacturer_data = advertisement_data.get("manufacturer_data", [])
-   
-    irk = config.get("irk", None)
-    
-    
-    async with await open_transport_or_link(transport_path) as hci_transport:
-        logger.info("Netsim initialized")
-
-        device = Device.from_config_file_with_hci(config_file, hci_transport.source, hci_transport.sink)
-       
-   
-        await device.power_on()
-      
-      
-        logger.info(" Loading GATT services...")
-        services = load_services_from_json(config_file, readings_csv)
-        for service in services:
-            device.add_service(service)
-        logger.info(" GATT services loaded")
-        
-        @device.on("connection")
-        def on_connection(connection):
-            global commissioning_connection_established
-            commissioning_connection_established = True
-            logger.info(" Device connected (BLE)")
-            print("COMMISSIONING_DONE", flush=True)
-          
-        import asyncio
-
-        async def monitor_connection(device):
-            while True:
-                if not device.connections:
-                    await device.start_advertising()
-                await asyncio.sleep(1)  # Check every second
-        
-        # In your main section:
-        asyncio.create_task(monitor_connection(device))
-
-        
-        @device.on("disconnection")
-        def on_disconnection(connection, reason):
-            reason_name = hci.HCI_Connection_Termination_Reason.get(reason, "Unknown")
-            logger.warning(f"🔌 Disconnected (reason={reason:#04x} - {reason_name})")
-            device.start_advertising()
-            
-            # Only print when commissioning is actually complete
-            #if commissioning_is_complete:
-             #   print("COMMISSIONING_DONE", flush=True)
+def device_from_config(config, config_file, hci_source, hci_sink):
+    """bumble Device from the already parsed spec (no second read of the file)."""
+    device_config = DeviceConfiguration()
+    load_from_dict = getattr(device_config, "load_from_dict", None)
+    if load_from_dict is None:
+        # Older bumble: only knows how to load from the file itself
+        return Device.from_config_file_with_hci(config_file, hci_source, hci_sink)
+    load_from_dict(config)
+    return Device.from_config_with_hci(device_config, hci_source, hci_sink)
 
 
-        service_uuid_bytes = b''.join(UUID(uuid).to_bytes() for uuid in service_uuids)
-        manufacturer_bytes = b''.join(bytes.fromhex(m[2:]) for m in manufacturer_data if isinstance(m, str) and m.startswith("0x"))
+async def start_virtual_device(config_file, readings_csv, hci_source, hci_sink, device_id, timer=None):
+    """Build, power on and start advertising one virtual device on an open HCI transport.
 
-        adv_fields = [
-            (AdvertisingData.COMPLETE_LIST_OF_16_BIT_SERVICE_CLASS_UUIDS, service_uuid_bytes),
-            (AdvertisingData.COMPLETE_LOCAL_NAME, local_name.encode("utf-8"))
-        ]
+    Returns the running Device. Several of these can share one event loop
+    (see device_host.py). Phases are booked on `timer` (a StartupTimer) if given.
+    """
+    timer = timer or startup_timing.StartupTimer(device_id)
+    logger.info(f" Loading config: {config_file}")
+    value_store = get_value_store(config_file)
+    config = value_store.config
 
-        if sum(len(v) + 2 for _, v in adv_fields) + len(manufacturer_bytes) + 2 <= 31:
-            adv_fields.append((AdvertisingData.MANUFACTURER_SPECIFIC_DATA, manufacturer_bytes))
+    # Warm restart: setup status, values, bonds and identity from the host's state file
+    try:
+        state = restore_state(device_id)
+        if state is not None:
+            apply_state(value_store, config, state)
+    except Exception as e:
+        state = None
+        logger.error(f"❌ Could not restore device state: {e}")
 
-        advertising_data = bytes(AdvertisingData(adv_fields))
-        scan_response_data = bytes(AdvertisingData(adv_fields))
+    # Encoded once per distinct "advertisement" section, shared by identical devices
+    advertising = profile_cache.advertising(config)
+    local_name = config.get("advertisement", {}).get("local_name", "Virtual_Device")
 
+    device = device_from_config(config, config_file, hci_source, hci_sink)
+    device.metrics = get_metrics(device_id)
+    device.log = device_logger(device_id)
+   
+    await device.power_on()
+    if state is not None:
+        await restore_bonds(device, state)
+    timer.mark("power_on")
   
+    logger.info(" Loading GATT services...")
+    services = load_services_from_json(config_file, readings_csv, device.metrics)
+    for service in services:
+        device.add_service(service)
+    device.readings_csv = readings_csv
+    if readings_csv:
+        open_readings_journal(readings_csv)
+    start_journals()
+    device.spec_watcher = watch_spec_updates(device, config_file, services)
+    device.shared_values = SharedValueReader(device_id)
+    device.shared_values_task = asyncio.create_task(
+        follow_shared_values(device, device.shared_values, config.get("shared_poll_interval", 0.05)))
+    logger.info(" GATT services loaded")
+    timer.mark("gatt_load")
+    
+    events = get_event_channel()
+    device.events = events
+    # Commissioning ends with the first central's disconnect; the device then
+    # simply carries on in normal mode, same transport and GATT server
+    device.commissioning = config.get("setup_complete", "NO") == "NO"
+
+    @device.on("connection")
+    def on_connection(connection):
+        device.log.info("Device connected (BLE) from %s", connection.peer_address)
+        device.metrics.inc("connections_total")
+        events.emit("connected", device_id, peer=str(connection.peer_address),
+                    handle=connection.handle, commissioning=device.commissioning)
+        # bumble reports the end of a link on the connection, not on the device
+        connection.on("disconnection", lambda reason: on_disconnection(connection, reason))
+
+    # Re-advertising is event driven (see connection_lifecycle.py); it carries on
+    # while fewer than "max_connections" centrals are linked
+    device.lifecycle = ConnectionLifecycle.from_config(device, config)
+    # Per-central MTU, subscriptions and pending indications (gatt_sessions.py)
+    device.sessions = SessionManager.from_config(device, config)
+    # Read Blob snapshots, prepared writes, device-initiated MTU exchange
+    device.long_values = install_long_values(device, config)
+
+    # Periodic notify/indicate streams declared in the spec ("notify": {"rate_hz": ..., "source": ...})
+    scheduler = get_notification_scheduler()
+    scheduler.add_device(device, device.characteristics_by_uuid.values(), config)
+
+    # Recorded trace playback from the spec's "replay" section
+    try:
+        device.replay = start_replay(device, config, publish=publish_value)
+    except Exception as e:
+        device.replay = None
+        logger.error(f"❌ Could not start readings replay: {e}")
 
-        setup_status = config.get("setup_complete", "NO")
-
-        if setup_status == "NO":
-            logger.info("Device is being set up for the first time.")
-            device.advertising_data = advertising_data
-            device.scan_response_data = scan_response_data
-           
+    # Synthetic values from per-characteristic "generator" sections, batched per process
+    try:
+        device.generators = start_generators(device, config, publish=publish_value)
+    except Exception as e:
+        device.generators = None
+        logger.error(f"❌ Could not start value generators: {e}")
+
+    def on_disconnection(connection, reason):
+        reason_name = BLE_REASON_MAP.get(reason, "Unknown")
+        device.log.warning("🔌 Disconnected (reason=%#04x - %s)", reason, reason_name)
+        device.metrics.inc("disconnections_total")
+        events.emit("disconnected", device_id, handle=connection.handle, reason=reason,
+                    reason_name=reason_name)
+        if device.commissioning:
+            device.commissioning = False
             config["setup_complete"] = "YES"
-            with open(config_file, 'w') as f:
-                json.dump(config, f, indent=4)
-                
-        logger.info(f" Advertising raw: {advertising_data.hex()} (len={len(advertising_data)})")
-        logger.info(f" Scan response raw: {scan_response_data.hex()} (len={len(scan_response_data)})")
+            value_store.save()
+            if getattr(device, "state_saver", None) is not None:
+                # A few bytes in the state file; the spec above is for tools that read it
+                device.state_saver.state_file.set_setup(device_id, True)
+            device.log.info("✅ Commissioning complete, continuing in normal mode")
+            events.emit("commissioned", device_id)
+
+
+    if device.commissioning:
+        logger.info("Device is being set up for the first time.")
+
+    # Packs adv/scan response, follows live values in place (advertising_engine.py)
+    device.advertiser = AdvertisingEngine.from_config(device, value_store, config, advertising)
+    device.lifecycle.advertise = device.advertiser.start_advertising
+    advertising_data = device.advertiser.advertising_data
+    scan_response_data = device.advertiser.scan_response_data
+
+    logger.info(f" Advertising raw: {advertising_data.hex()} (len={len(advertising_data)})")
+    logger.info(f" Scan response raw: {scan_response_data.hex()} (len={len(scan_response_data)})")
+
+    logger.info(f" Now advertising as '{local_name}'")
+    logger.info(" Virtual BLE Peripheral is running...")
+    #device.advertising_type = AdvertisingType.UNDIRECTED_CONNECTABLE_SCANNABLE
+
+    await device.lifecycle.start_advertising()
+    timer.mark("first_advertisement")
+    device.startup_timer = timer
+
+    # Counts kept by the lifecycle and the scheduler, read only when scraped
+    def collect_metrics():
+        yield "advertising_restarts_total", {"device": device_id}, device.lifecycle.advertising_restarts
+        yield "advertising_updates_total", {"device": device_id}, device.advertiser.updates
+        yield ("notifications_total", {"device": device_id, "source": "stream"},
+               scheduler.sent_by_device.get(device, 0))
+    device.metrics_collector = collect_metrics
+    get_registry().add_collector(collect_metrics)
 
-        print(device.advertising_data)
-        logger.info(f" Now advertising as '{local_name}'")
-        logger.info(" Virtual BLE Peripheral is running...")
-        #device.advertising_type = AdvertisingType.UNDIRECTED_CONNECTABLE_SCANNABLE
+    try:
+        device.state_saver = StateSaver(device, device_id, config, get_state_file(),
+                                        config.get("state_interval", 5.0))
+        device.state_saver.start()
+    except Exception as e:
+        device.state_saver = None
+        logger.error(f"❌ Device state snapshots disabled: {e}")
+
+    events.emit("ready", device_id, mode="commissioning" if device.commissioning else "normal",
+                startup_ms=round(timer.total() * 1000, 1), metrics_port=metrics_port())
+    return device
+
+
+async def stop_virtual_device(device, config_file):
+    """Stop advertising, drop connections and release the watchers of a running device."""
+    lifecycle = getattr(device, "lifecycle", None)
+    if lifecycle is not None:
+        lifecycle.close()
+    if getattr(device, "sessions", None) is not None:
+        device.sessions.close()
+    if getattr(device, "long_values", None) is not None:
+        device.long_values.close()
+    get_notification_scheduler().remove_device(device)
+    get_registry().remove_collector(getattr(device, "metrics_collector", None))
+    if getattr(device, "advertiser", None) is not None:
+        await device.advertiser.stop()
+    if getattr(device, "replay", None) is not None:
+        device.replay.stop()
+    if getattr(device, "generators", None) is not None:
+        device.generators.remove(device)
+    spec_watcher = getattr(device, "spec_watcher", None)
+    if spec_watcher is not None:
+        spec_watcher.unwatch(config_file)
+    if getattr(device, "shared_values_task", None) is not None:
+        device.shared_values_task.cancel()
+        device.shared_values.close()
+        # Nothing reads the table once the device is gone; don't leave it in /dev/shm
+        remove_table(device.shared_values.device_id)
+    for connection in list(device.connections.values()):
+        try:
+            await connection.disconnect()
+        except Exception as e:
+            logger.warning(f"Disconnect failed while stopping device: {e}")
+    await device.stop_advertising()
+    value_store = get_value_store(config_file)
+    if value_store.journal is not None:
+        value_store.journal.flush()
+    if getattr(device, "readings_csv", None):
+        close_readings_journal(device.readings_csv)
+    # After the flush, so the snapshot is newer than the spec it describes
+    if getattr(device, "state_saver", None) is not None:
+        await device.state_saver.close()
 
-        
-        await device.start_advertising()
-        # Just before waiting for event
-        #update_file_path = sys.argv[5] if len(sys.argv) > 5 else "data.json"
 
+async def setup_virtual_device(config_file, readings_csv, transport_path, device_id):
+    from bumble.transport import open_transport_or_link  # pulls in grpc for netsim; only when needed
 
+    timer = startup_timing.process_timer
+    timer.device_id = device_id
+    install_signal_handlers()
+    if os.environ.get(METRICS_PORT_ENV):
+        start_metrics_server(os.environ[METRICS_PORT_ENV])
+    async with await open_transport_or_link(transport_path) as hci_transport:
+        logger.info("Netsim initialized")
+        timer.mark("transport_open")
 
-        
-        # Start JSON polling thread
-      #   polling_thread = threading.Thread(
-      #      target=poll_json_and_update_gatt,
-       #     args=(update_file_path, device.gatt_server),
-        #    daemon=True
-        #)
-        #polling_thread.start()
+        try:
+            await start_virtual_device(config_file, readings_csv,
+                                       hci_transport.source, hci_transport.sink, device_id, timer)
+        except Exception:
+            logger.exception(f"❌ {device_id} failed to start")
+            dump_recent()
+            raise
+        timer.emit()
 
-        
-        await asyncio.sleep(40) 
-        
         await asyncio.Event().wait()
         
 
@@ -459,4 +620,7 @@ if __name__ == '__main__':
         print("Usage: python VirtualDevice.py <device_spec.json> <readings.csv> <usb:0>")
         sys.exit(1)
 
-    asyncio.run(setup_virtual_device(sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4]))
+    try:
+        asyncio.run(setup_virtual_device(sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4]))
+    finally:
+        shutdown_logging()
@@ -0,0 +1,252 @@
+# advertising_engine.py
+#
+# Builds and maintains a device's advertising and scan response payloads.
+#
+# Fields are packed by priority (flags, service UUIDs, local name,
+# manufacturer data, service data) into the advertising packet first and
+# the scan response second; a local name that fits neither is shortened.
+# With "extended" the same happens against the extended advertising limit
+# on a bumble advertising set.
+#
+# Live fields follow characteristic values from the value store:
+#
+#   "advertisement": {
+#       ...,
+#       "extended": false,                 # true, false or "auto" (extended only if legacy overflows)
+#       "dynamic": {
+#           "max_rate_hz": 20,
+#           "manufacturer_data": {"company_id": "0x0075", "characteristics": ["dd01"]},
+#           "service_data": {"00dd": "dd02"}
+#       }
+#   }
+#
+# A value change only marks the payload dirty; a task rebuilds it at most
+# max_rate_hz times a second and, if the bytes changed, pushes them to the
+# controller in place (HCI set advertising/scan response data, or the
+# advertising set's setters): no stop/start cycle.
+
+import time
+import asyncio
+import logging
+from collections import deque
+
+from bumble import hci
+from bumble.core import AdvertisingData, UUID
+
+from value_store import normalize_uuid
+
+logger = logging.getLogger(__name__)
+
+LEGACY_LIMIT = 31
+# Largest payload one HCI_LE_Set_Extended_Advertising_Data command carries
+EXTENDED_LIMIT = 251
+
+
+def encode_field(ad_type, data):
+    return bytes((len(data) + 1, ad_type)) + data
+
+
+def static_fields(advertisement):
+    """(ad_type, data) pairs for the fixed part of an "advertisement" section, in priority order."""
+    fields = []
+    flags = advertisement.get("flags")
+    if flags is not None:
+        fields.append((AdvertisingData.FLAGS, bytes((int(flags) & 0xFF,))))
+    service_uuids = advertisement.get("service_uuids", [])
+    if service_uuids:
+        fields.append((AdvertisingData.COMPLETE_LIST_OF_16_BIT_SERVICE_CLASS_UUIDS,
+                       b''.join(UUID(uuid).to_bytes() for uuid in service_uuids)))
+    local_name = advertisement.get("local_name", "Virtual_Device")
+    fields.append((AdvertisingData.COMPLETE_LOCAL_NAME, local_name.encode("utf-8")))
+    dynamic = advertisement.get("dynamic", {})
+    manufacturer_data = advertisement.get("manufacturer_data", [])
+    if manufacturer_data and "manufacturer_data" not in dynamic:
+        data = b''.join(bytes.fromhex(m[2:]) for m in manufacturer_data
+                        if isinstance(m, str) and m.startswith("0x"))
+        if data:
+            fields.append((AdvertisingData.MANUFACTURER_SPECIFIC_DATA, data))
+    return fields
+
+
+def pack_advertising(fields, limit=LEGACY_LIMIT):
+    """First-fit the fields into (advertising, scan response); returns (adv, scan, dropped types)."""
+    adv, scan = bytearray(), bytearray()
+    dropped = []
+    for ad_type, data in fields:
+        encoded = encode_field(ad_type, data)
+        if len(adv) + len(encoded) <= limit:
+            adv += encoded
+        elif len(scan) + len(encoded) <= limit:
+            scan += encoded
+        elif ad_type == AdvertisingData.COMPLETE_LOCAL_NAME:
+            target = adv if limit - len(adv) >= limit - len(scan) else scan
+            room = limit - len(target) - 2
+            if room > 0:
+                target += encode_field(AdvertisingData.SHORTENED_LOCAL_NAME, data[:room])
+            else:
+                dropped.append(ad_type)
+        else:
+            dropped.append(ad_type)
+    return bytes(adv), bytes(scan), dropped
+
+
+class AdvertisingEngine:
+    """Per-device advertising payloads, updated in place from live characteristic values."""
+
+    def __init__(self, device, value_store, advertisement, fields=None, history=256):
+        self.device = device
+        self.value_store = value_store
+        self.advertisement = advertisement
+        self.static = list(fields if fields is not None else static_fields(advertisement))
+        dynamic = advertisement.get("dynamic", {})
+        self.max_rate_hz = float(dynamic.get("max_rate_hz", 10))
+        manufacturer = dynamic.get("manufacturer_data")
+        self.company_id = None
+        self.manufacturer_uuids = []
+        if manufacturer:
+            self.company_id = int(str(manufacturer.get("company_id", "0xFFFF")), 0).to_bytes(2, "little")
+            self.manufacturer_uuids = [normalize_uuid(u) for u in manufacturer.get("characteristics", [])]
+        self.service_data = [(UUID(service_uuid).to_bytes(), normalize_uuid(uuid))
+                             for service_uuid, uuid in dynamic.get("service_data", {}).items()]
+        self.watched = set(self.manufacturer_uuids) | {uuid for _, uuid in self.service_data}
+
+        mode = advertisement.get("extended", False)
+        self.extended = mode is True
+        self.advertising_data, self.scan_response_data, dropped = self.build()
+        if dropped and mode == "auto":
+            self.extended = True
+            self.advertising_data, self.scan_response_data, dropped = self.build()
+        if dropped:
+            logger.warning(f"⚠️ Advertising fields {dropped} do not fit "
+                           f"{'extended' if self.extended else 'legacy'} advertising, dropped")
+
+        self.advertising_set = None
+        self.updates = 0
+        self.skipped = 0
+        self.deferred = 0
+        self.failures = 0
+        self.recent = deque(maxlen=history)   # times of pushed updates
+        self._dirty = asyncio.Event()
+        self._task = None
+        if self.watched:
+            value_store.add_listener(self._on_value)
+
+    @classmethod
+    def from_config(cls, device, value_store, config, profile=None):
+        advertisement = config.get("advertisement", {})
+        fields = (profile.fields_for(advertisement.get("local_name", "Virtual_Device"))
+                  if profile is not None else None)
+        return cls(device, value_store, advertisement, fields)
+
+    def dynamic_fields(self):
+        fields = []
+        if self.company_id is not None:
+            data = self.company_id + b''.join(self.value_store.get_bytes(u, b"") for u in self.manufacturer_uuids)
+            fields.append((AdvertisingData.MANUFACTURER_SPECIFIC_DATA, data))
+        for service_bytes, uuid in self.service_data:
+            kind = (AdvertisingData.SERVICE_DATA_16_BIT_UUID if len(service_bytes) == 2
+                    else AdvertisingData.SERVICE_DATA_128_BIT_UUID)
+            fields.append((kind, service_bytes + self.value_store.get_bytes(uuid, b"")))
+        return fields
+
+    def build(self):
+        limit = EXTENDED_LIMIT if self.extended else LEGACY_LIMIT
+        return pack_advertising(self.static + self.dynamic_fields(), limit)
+
+    def apply(self):
+        """Install the current payloads on the device (used by the next advertising start)."""
+        self.device.advertising_data = self.advertising_data
+        self.device.scan_response_data = self.scan_response_data
+
+    async def start_advertising(self):
+        """Replacement for device.start_advertising(), see ConnectionLifecycle.advertise."""
+        self.apply()
+        if self._task is None and self.watched:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        if not self.extended:
+            await self.device.start_advertising()
+            return
+        if self.advertising_set is None:
+            from bumble.device import AdvertisingParameters
+            self.advertising_set = await self.device.create_advertising_set(
+                advertising_parameters=AdvertisingParameters(),
+                advertising_data=self.advertising_data,
+                scan_response_data=self.scan_response_data)
+        else:
+            await self.advertising_set.start()
+
+    def _on_value(self, uuid):
+        if uuid in self.watched:
+            self._dirty.set()
+
+    async def push(self):
+        """Rebuild the payloads and send them to the controller if they changed."""
+        adv, scan, _ = self.build()
+        if adv == self.advertising_data and scan == self.scan_response_data:
+            self.skipped += 1
+            return False
+        adv_changed = adv != self.advertising_data
+        scan_changed = scan != self.scan_response_data
+        self.advertising_data, self.scan_response_data = adv, scan
+        self.apply()
+        # Our extended set, or the set bumble sends legacy PDUs through on
+        # controllers with extended advertising (bumble's own, netsim)
+        advertising_set = (self.advertising_set if self.extended
+                           else getattr(self.device, "legacy_advertising_set", None))
+        if advertising_set is not None:
+            if adv_changed:
+                await advertising_set.set_advertising_data(adv)
+            if scan_changed:
+                await advertising_set.set_scan_response_data(scan)
+        elif not self.extended and getattr(self.device, "is_advertising", False):
+            # Legacy advertising data may be replaced while advertising is enabled
+            if adv_changed:
+                await self.device.send_command(hci.HCI_LE_Set_Advertising_Data_Command(advertising_data=adv))
+            if scan_changed:
+                await self.device.send_command(
+                    hci.HCI_LE_Set_Scan_Response_Data_Command(scan_response_data=scan))
+        else:
+            # Not advertising: apply() above is what the next start sends
+            self.deferred += 1
+            return False
+        self.updates += 1
+        self.recent.append(time.perf_counter())
+        return True
+
+    async def _run(self):
+        interval = 1.0 / self.max_rate_hz if self.max_rate_hz > 0 else 0.0
+        while True:
+            await self._dirty.wait()
+            self._dirty.clear()
+            try:
+                await self.push()
+            except Exception as e:
+                self.failures += 1
+                logger.warning(f"⚠️ Advertising update failed: {e}")
+            # Changes arriving meanwhile coalesce into the next push
+            await asyncio.sleep(interval)
+
+    def rate(self, window=5.0):
+        now = time.perf_counter()
+        return sum(1 for t in self.recent if now - t <= window) / window
+
+    def stats(self):
+        return {
+            "extended": self.extended,
+            "advertising_len": len(self.advertising_data),
+            "scan_response_len": len(self.scan_response_data),
+            "updates": self.updates,
+            "skipped": self.skipped,
+            "deferred": self.deferred,
+            "failures": self.failures,
+            "updates_per_second": self.rate(),
+        }
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self.watched:
+            self.value_store.remove_listener(self._on_value)
+        if self.advertising_set is not None:
+            await self.advertising_set.stop()
@@ -0,0 +1,330 @@
+# agent_loadtest.py
+#
+# Load test for BLE_agent.py without a broker, backend or real devices.
+#
+#   python agent_loadtest.py [--devices 2000] [--batch 100] [--messages 20000]
+#                            [--rate 0] [--spec-delay 0] [--start-delay 0.05]
+#                            [--apply-delay 0.001] [--out results.json]
+#
+# BLE_agent runs unchanged in a background thread; its `mqtt_client` and
+# `device_managers` imports resolve to the in-process stand-ins below:
+#
+#   FakeBroker      topic routing like a broker, delivering every message on
+#                   ONE thread, the way paho runs callbacks
+#   FakeBackend     answers /getspec with /spec and timestamps /deviceready
+#   fake managers   start_virtual_device / update_ble_peripheral that only sleep
+#
+# The harness publishes /startdevice for every device_id, waits for the
+# deviceready replies, then floods /data. Reported: startdevice->deviceready
+# latency, data throughput (published, routed, applied), broker delivery lag
+# (how far the single callback thread falls behind) and agent CPU/memory.
+
+import os
+import sys
+import json
+import time
+import queue
+import types
+import random
+import socket
+import argparse
+import resource
+import threading
+import contextlib
+
+from topic_router import TopicRouter
+from connection_lifecycle import summarize
+
+DEFAULT_SPEC = "Qubo_bulb12W_spec.json"
+
+
+class FakeMessage:
+    __slots__ = ("topic", "payload", "published_at")
+
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload if isinstance(payload, bytes) else str(payload).encode()
+        self.published_at = time.perf_counter()
+
+
+class FakeBroker:
+    """In-process pub/sub with MQTT wildcards and a single delivery thread."""
+
+    def __init__(self):
+        self.subscriptions = TopicRouter()
+        self.subscribed = 0
+        self.published = 0
+        self.delivered = 0
+        self.unrouted = 0
+        self.delivery_lag = []
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._deliver, daemon=True, name="fake-broker")
+        self._thread.start()
+
+    def subscribe(self, pattern, callback, client=None):
+        def handler(_client, userdata, msg):
+            callback(client, userdata, msg)
+        self.subscriptions.add(pattern, handler)
+        self.subscribed += 1
+
+    def publish(self, topic, payload):
+        self.published += 1
+        self._queue.put(FakeMessage(topic, payload))
+
+    def _deliver(self):
+        while True:
+            msg = self._queue.get()
+            self.delivery_lag.append(time.perf_counter() - msg.published_at)
+            handlers = self.subscriptions.match(msg.topic)
+            if not handlers:
+                self.unrouted += 1
+            for handler in handlers:
+                try:
+                    handler(None, None, msg)
+                except Exception as e:
+                    print(f"[LOADTEST] Callback for {msg.topic} failed: {e}", file=sys.__stderr__)
+            self.delivered += 1
+            self._queue.task_done()
+
+    def backlog(self):
+        return self._queue.qsize()
+
+    def drain(self, timeout=None):
+        """Wait until everything published so far has been delivered."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._queue.unfinished_tasks:
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+
+class FakeMqttClient:
+    """Same surface BLE_agent uses from mqtt_client.MqttClient."""
+
+    broker = None   # set by install_fakes()
+
+    def __init__(self, broker_host, client_id):
+        self.broker_host = broker_host
+        self.client_id = client_id
+
+    def connect(self):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def subscribe_sync(self, topic, callback):
+        self.broker.subscribe(topic, callback, self)
+
+    def publish(self, topic, payload):
+        self.broker.publish(topic, payload)
+
+
+class FakeBackend:
+    """Backend side: serves specs and records when each device reports ready."""
+
+    def __init__(self, broker, hostname, spec, spec_delay=0.0):
+        self.broker = broker
+        self.hostname = hostname
+        self.spec = json.dumps(spec)
+        self.spec_delay = spec_delay
+        self.requested = {}
+        self.ready = {}
+        self.all_ready = threading.Event()
+        self.expected = 0
+        self._lock = threading.Lock()
+        broker.subscribe(f"/{hostname}/+/getspec", self.on_getspec)
+        broker.subscribe(f"/{hostname}/+/deviceready", self.on_deviceready)
+
+    def start_devices(self, device_ids):
+        now = time.perf_counter()
+        with self._lock:
+            for device_id in device_ids:
+                self.requested[device_id] = now
+            self.expected = len(self.requested)
+        self.broker.publish(f"/{self.hostname}/startdevice", json.dumps({"start": list(device_ids)}))
+
+    def on_getspec(self, client, userdata, msg):
+        device_id = msg.topic.split("/")[-2]
+        if self.spec_delay:
+            # Backend response time; published from a timer so the broker thread stays free
+            threading.Timer(self.spec_delay, self.broker.publish,
+                            (f"/{self.hostname}/{device_id}/spec", self.spec)).start()
+        else:
+            self.broker.publish(f"/{self.hostname}/{device_id}/spec", self.spec)
+
+    def on_deviceready(self, client, userdata, msg):
+        device_id = msg.topic.split("/")[-2]
+        with self._lock:
+            if device_id in self.requested and device_id not in self.ready:
+                self.ready[device_id] = time.perf_counter() - self.requested[device_id]
+                if len(self.ready) >= self.expected:
+                    self.all_ready.set()
+
+
+class FakeDeviceManagers:
+    """Stand-in for device_managers: no subprocesses, just the configured delays."""
+
+    def __init__(self, start_delay=0.05, apply_delay=0.001):
+        self.start_delay = start_delay
+        self.apply_delay = apply_delay
+        self.started = 0
+        self.applied = 0
+        self.values = 0
+        self._lock = threading.Lock()
+
+    def start_virtual_device(self, device_id, device_spec, mqtt, hostname):
+        if self.start_delay:
+            time.sleep(self.start_delay)
+        with self._lock:
+            self.started += 1
+        return True
+
+    def update_ble_peripheral(self, data):
+        if self.apply_delay:
+            time.sleep(self.apply_delay)
+        with self._lock:
+            self.applied += 1
+            self.values += sum(len(c) for c in data.get("characteristics", {}).values()
+                               if isinstance(c, dict))
+
+
+def install_fakes(broker, managers):
+    """Make BLE_agent's `mqtt_client` / `device_managers` imports resolve to the fakes."""
+    FakeMqttClient.broker = broker
+    mqtt_module = types.ModuleType("mqtt_client")
+    mqtt_module.MqttClient = FakeMqttClient
+    managers_module = types.ModuleType("device_managers")
+    managers_module.start_virtual_device = managers.start_virtual_device
+    managers_module.update_ble_peripheral = managers.update_ble_peripheral
+    sys.modules["mqtt_client"] = mqtt_module
+    sys.modules["device_managers"] = managers_module
+
+
+def start_agent(broker, timeout=10.0):
+    """Import BLE_agent on a daemon thread (its main loop never returns) and wait for its subscriptions."""
+    thread = threading.Thread(target=__import__, args=("BLE_agent",), daemon=True, name="ble-agent")
+    thread.start()
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        agent = sys.modules.get("BLE_agent")
+        topics = getattr(agent, "WILDCARD_TOPICS", None)
+        if topics is not None and broker.subscribed >= len(topics) + 3:   # + startdevice, backend's two
+            return agent
+        time.sleep(0.01)
+    raise RuntimeError("BLE_agent did not finish subscribing")
+
+
+def cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def data_payload(device_id, rng):
+    return json.dumps({"device_id": device_id,
+                       "characteristics": {"00dd": {"dd01": f"0x{rng.randrange(256):02X}"}}})
+
+
+def run_loadtest(devices=2000, batch=100, messages=20000, rate=0.0, spec_path=DEFAULT_SPEC,
+                 spec_delay=0.0, start_delay=0.05, apply_delay=0.001, timeout=300.0):
+    with open("config.json", "r") as f:
+        hostname = json.load(f).get("hostname") or socket.gethostname()
+    with open(spec_path, "r") as f:
+        spec = json.load(f)
+
+    broker = FakeBroker()
+    managers = FakeDeviceManagers(start_delay, apply_delay)
+    backend = FakeBackend(broker, hostname, spec, spec_delay)
+    install_fakes(broker, managers)
+    agent = start_agent(broker)
+
+    device_ids = [f"load{i:05d}" for i in range(devices)]
+    result = {"devices": devices, "batch": batch, "messages": messages, "rate": rate,
+              "start_delay_s": start_delay, "apply_delay_s": apply_delay, "spec_delay_s": spec_delay}
+
+    # Phase 1: /startdevice -> /getspec -> /spec -> /deviceready
+    cpu, started = cpu_seconds(), time.perf_counter()
+    for i in range(0, devices, batch):
+        backend.start_devices(device_ids[i:i + batch])
+    backend.all_ready.wait(timeout)
+    elapsed = time.perf_counter() - started
+    result["startdevice"] = {
+        "ready": len(backend.ready),
+        "elapsed_s": round(elapsed, 3),
+        "per_sec": len(backend.ready) / elapsed if elapsed else None,
+        "cpu_s": round(cpu_seconds() - cpu, 3),
+        "latency": summarize(list(backend.ready.values())),
+    }
+
+    # Phase 2: /data flood, optionally paced at `rate` messages per second
+    rng = random.Random(0)
+    applied_before, lag_before = managers.applied, len(broker.delivery_lag)
+    routed_before = agent.router.routed
+    cpu, started = cpu_seconds(), time.perf_counter()
+    for n in range(messages):
+        device_id = device_ids[n % devices]
+        broker.publish(f"/{hostname}/{device_id}/data", data_payload(device_id, rng))
+        if rate:
+            delay = started + (n + 1) / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+    published = time.perf_counter() - started
+    peak_backlog = broker.backlog()
+    broker.drain(timeout)
+    # Let the pipeline apply what is still queued per device
+    deadline = time.monotonic() + timeout
+    while agent.pipeline.stats()["queued"] and time.monotonic() < deadline:
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - started
+    pipeline = agent.pipeline.stats()
+    per_device = pipeline.pop("devices")
+    result["data"] = {
+        "published": messages,
+        "publish_s": round(published, 3),
+        "elapsed_s": round(elapsed, 3),
+        "routed": agent.router.routed - routed_before,
+        "applied_updates": managers.applied - applied_before,
+        "messages_per_sec": messages / elapsed if elapsed else None,
+        "cpu_s": round(cpu_seconds() - cpu, 3),
+        "broker_backlog_at_publish_end": peak_backlog,
+        "broker_delivery_lag": summarize(broker.delivery_lag[lag_before:]),
+        "pipeline": pipeline,
+        "coalesced": sum(d["coalesced"] for d in per_device.values()),
+        "dropped": sum(d["dropped"] for d in per_device.values()),
+        "mqtt_to_gatt": summarize([s for q in list(agent.pipeline.queues.values()) for s in q.latency]),
+    }
+    result["agent"] = {"cpu_s": round(cpu_seconds(), 3),
+                       "max_rss_kib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                       "threads": threading.active_count(),
+                       "router": agent.router.stats()}
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test BLE_agent with an in-process broker")
+    parser.add_argument("--devices", type=int, default=2000)
+    parser.add_argument("--batch", type=int, default=100, help="device_ids per /startdevice message")
+    parser.add_argument("--messages", type=int, default=20000, help="/data messages to publish")
+    parser.add_argument("--rate", type=float, default=0.0, help="/data messages per second (0 = flat out)")
+    parser.add_argument("--spec", default=DEFAULT_SPEC)
+    parser.add_argument("--spec-delay", type=float, default=0.0, help="backend /getspec response time")
+    parser.add_argument("--start-delay", type=float, default=0.05, help="fake device start time")
+    parser.add_argument("--apply-delay", type=float, default=0.001, help="fake GATT apply time")
+    parser.add_argument("--timeout", type=float, default=300.0)
+    parser.add_argument("--agent-log", default=os.devnull, help="where the agent's prints go")
+    parser.add_argument("--out", help="also write the JSON results to this file")
+    args = parser.parse_args(argv)
+
+    with open(args.agent_log, "w") as log, contextlib.redirect_stdout(log):
+        results = run_loadtest(args.devices, args.batch, args.messages, args.rate, args.spec,
+                               args.spec_delay, args.start_delay, args.apply_delay, args.timeout)
+    print(f"AGENT_LOADTEST {json.dumps(results, separators=(',', ':'))}", flush=True)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
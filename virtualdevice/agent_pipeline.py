@@ -0,0 +1,197 @@
+# agent_pipeline.py
+
+import json
+import time
+import asyncio
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from connection_lifecycle import summarize
+from metrics import get_metrics
+
+logger = logging.getLogger(__name__)
+
+
+class DeviceQueue:
+    """Pending updates for one device: last value per (service, characteristic) wins.
+
+    A payload without a {service: {characteristic: value}} "characteristics"
+    map has nothing to coalesce; it is handed to apply_fn whole, after the
+    values that arrived before it.
+    """
+
+    def __init__(self, device_id, max_pending):
+        self.device_id = device_id
+        self.max_pending = max_pending
+        self.pending = {}            # (service_uuid, char_uuid) -> value
+        self.oldest = None           # receive time of the oldest pending value
+        self.extra = {}              # other top-level fields of the latest message
+        self.outbox = deque()        # (payload, oldest) ready to apply, in arrival order
+        self.ready = asyncio.Event()
+        self.task = None
+        self.received = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.applied = 0
+        self.failed = 0
+        self.passed_through = 0
+        self.latency = deque(maxlen=1000)
+        self.metrics = get_metrics(device_id)
+
+    def put(self, data, received_at):
+        self.received += 1
+        services = data.get("characteristics")
+        if not isinstance(services, dict) or not all(isinstance(c, dict) for c in services.values()):
+            if len(self.pending) + len(self.outbox) >= self.max_pending:
+                self.dropped += 1
+                return
+            self._seal()
+            self.outbox.append((data, received_at))
+            self.passed_through += 1
+            self.ready.set()
+            return
+        for service_uuid, chars in services.items():
+            for uuid, value in chars.items():
+                key = (service_uuid, uuid)
+                if key in self.pending:
+                    self.coalesced += 1
+                elif len(self.pending) >= self.max_pending:
+                    self.dropped += 1
+                    continue
+                self.pending[key] = value
+        self.extra = {k: v for k, v in data.items() if k != "characteristics"}
+        if self.pending:
+            if self.oldest is None:
+                self.oldest = received_at
+            self.ready.set()
+
+    def _seal(self):
+        """Move the coalesced values into the outbox as one payload."""
+        if not self.pending:
+            return
+        characteristics = {}
+        for (service_uuid, uuid), value in self.pending.items():
+            characteristics.setdefault(service_uuid, {})[uuid] = value
+        self.outbox.append(({**self.extra, "device_id": self.device_id,
+                             "characteristics": characteristics}, self.oldest))
+        self.pending = {}
+        self.oldest = None
+
+    def drain(self):
+        """[(payload, oldest receive time)] to apply, in order."""
+        self._seal()
+        items = list(self.outbox)
+        self.outbox.clear()
+        self.ready.clear()
+        return items
+
+    def stats(self):
+        return {
+            "depth": len(self.pending) + len(self.outbox),
+            "received": self.received,
+            "coalesced": self.coalesced,
+            "dropped": self.dropped,
+            "applied": self.applied,
+            "failed": self.failed,
+            "passed_through": self.passed_through,
+            "mqtt_to_gatt": summarize(self.latency),
+        }
+
+
+class AgentPipeline:
+    """asyncio data path between the MQTT callback thread and the device managers.
+
+    The broker callback only hands the raw payload over (submit). Decoding,
+    coalescing and the (blocking) apply call happen on a private event loop,
+    one worker per device_id, so a slow device no longer stalls the others.
+    """
+
+    def __init__(self, apply_fn, max_pending=256, max_backlog=10000, workers=16):
+        self.apply_fn = apply_fn
+        self.max_pending = max_pending
+        self.max_backlog = max_backlog
+        self.queues = {}
+        self.backlog = 0
+        self.rejected = 0
+        self.decode_errors = 0
+        self._backlog_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="agent-apply")
+        self.loop = asyncio.new_event_loop()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.loop.run_forever, daemon=True,
+                                            name="agent-pipeline")
+            self._thread.start()
+        return self
+
+    def submit(self, payload, topic=None):
+        """Thread-safe; called from the MQTT callback. Never blocks."""
+        with self._backlog_lock:
+            if self.backlog >= self.max_backlog:
+                self.rejected += 1
+                return False
+            self.backlog += 1
+        self.loop.call_soon_threadsafe(self._ingest, payload, topic, time.perf_counter())
+        return True
+
+    def _ingest(self, payload, topic, received_at):
+        with self._backlog_lock:
+            self.backlog -= 1
+        started = time.perf_counter()
+        try:
+            if isinstance(payload, (bytes, bytearray)):
+                payload = payload.decode()
+            data = json.loads(payload)
+        except Exception as e:
+            self.decode_errors += 1
+            logger.error(f"[AGENT] Bad /data payload: {e}")
+            return
+        device_id = data.get("device_id")
+        if not device_id and topic:
+            # /<host>/<device_id>/data
+            device_id = topic.rstrip("/").split("/")[-2]
+        if not device_id:
+            self.decode_errors += 1
+            return
+        queue = self.queues.get(device_id)
+        if queue is None:
+            queue = self.queues[device_id] = DeviceQueue(device_id, self.max_pending)
+        queue.put(data, received_at)
+        if queue.task is None:
+            queue.task = self.loop.create_task(self._worker(queue))
+        queue.metrics.inc("agent_messages_total", kind="data")
+        queue.metrics.histogram("agent_ingest_seconds").observe(time.perf_counter() - started)
+
+    async def _worker(self, queue):
+        while True:
+            await queue.ready.wait()
+            for data, oldest in queue.drain():
+                started = time.perf_counter()
+                try:
+                    await self.loop.run_in_executor(self._executor, self.apply_fn, data)
+                    queue.applied += 1
+                    queue.metrics.histogram("agent_apply_seconds").observe(time.perf_counter() - started)
+                except Exception as e:
+                    queue.failed += 1
+                    logger.error(f"[AGENT] Update for {queue.device_id} failed: {e}")
+                if oldest is not None:
+                    queue.latency.append(time.perf_counter() - oldest)
+
+    def stats(self):
+        """Per-device queue depth, drops and MQTT-to-GATT latency (read from any thread)."""
+        devices = {device_id: q.stats() for device_id, q in list(self.queues.items())}
+        return {
+            "backlog": self.backlog,
+            "rejected": self.rejected,
+            "decode_errors": self.decode_errors,
+            "queued": sum(d["depth"] for d in devices.values()),
+            "devices": devices,
+        }
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,168 @@
+# connection_lifecycle.py
+
+import time
+import asyncio
+import logging
+from enum import Enum
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class LifecycleState(Enum):
+    IDLE = "idle"
+    ADVERTISING = "advertising"
+    CONNECTED = "connected"
+    DISCONNECTED = "disconnected"
+    READVERTISING = "re-advertising"
+
+
+def summarize(samples):
+    """avg/p50/p95/max in milliseconds for a sequence of seconds."""
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+    n = len(ordered)
+    return {
+        "count": n,
+        "avg_ms": sum(ordered) / n * 1e3,
+        "p50_ms": ordered[n // 2] * 1e3,
+        "p95_ms": ordered[min(n - 1, int(n * 0.95))] * 1e3,
+        "max_ms": ordered[-1] * 1e3,
+    }
+
+
+class ConnectionLifecycle:
+    """Per-device advertising -> connected -> disconnected -> re-advertising state machine.
+
+    Driven only by bumble's connection events and each connection's own
+    disconnection event (bumble does not report it on the device): no polling. A lost
+    connection re-advertises after `backoff_initial` seconds (0 = immediately);
+    failed advertising starts are retried with exponential backoff up to
+    `backoff_max`.
+    """
+
+    def __init__(self, device, backoff_initial=0.0, backoff_max=5.0, backoff_factor=2.0,
+                 history=1000, max_connections=1):
+        self.device = device
+        self.max_connections = max(1, int(max_connections))
+        # How to (re)start advertising; the AdvertisingEngine substitutes its own
+        self.advertise = device.start_advertising
+        self.backoff_initial = backoff_initial
+        self.backoff_max = backoff_max
+        self.backoff_factor = backoff_factor
+        self.state = LifecycleState.IDLE
+        self.listeners = []                 # callback(old_state, new_state)
+        self.advertising_restarts = 0
+        self.disconnect_to_readvertise = deque(maxlen=history)
+        self.advertise_to_connect = deque(maxlen=history)
+        self._advertising_since = None
+        self._disconnected_at = None
+        self._lock = asyncio.Lock()
+        self._task = None
+        self._closed = False
+        self._links = {}                    # connection handle -> (connection, disconnection listener)
+
+        device.on("connection", self._on_connection)
+
+    @classmethod
+    def from_config(cls, device, config):
+        """Backoff settings come from the spec's optional "reconnect" section."""
+        reconnect = config.get("reconnect", {})
+        return cls(device,
+                   backoff_initial=reconnect.get("backoff_initial", 0.0),
+                   backoff_max=reconnect.get("backoff_max", 5.0),
+                   backoff_factor=reconnect.get("backoff_factor", 2.0),
+                   max_connections=config.get("max_connections", 1))
+
+    def _set_state(self, state):
+        if state is self.state:
+            return
+        old, self.state = self.state, state
+        logger.debug(f"Lifecycle {old.value} -> {state.value}")
+        for listener in list(self.listeners):
+            try:
+                listener(old, state)
+            except Exception as e:
+                logger.error(f"Lifecycle listener failed: {e}")
+
+    def should_advertise(self):
+        # Stay connectable until the spec's "max_connections" centrals are linked
+        return len(self.device.connections) < self.max_connections
+
+    async def start_advertising(self):
+        """Start advertising once; concurrent callers share the same attempt."""
+        async with self._lock:
+            if self._closed or not self.should_advertise():
+                return False
+            if getattr(self.device, "is_advertising", False):
+                return True
+            await self.advertise()
+            now = time.perf_counter()
+            self._advertising_since = now
+            if self._disconnected_at is not None:
+                self.disconnect_to_readvertise.append(now - self._disconnected_at)
+                self._disconnected_at = None
+                self.advertising_restarts += 1
+            self._set_state(LifecycleState.ADVERTISING)
+            return True
+
+    async def _readvertise(self):
+        delay = self.backoff_initial
+        while True:
+            # Even a zero delay yields once, so bumble finishes its own
+            # disconnection bookkeeping before we look at device.connections
+            await asyncio.sleep(delay)
+            if self._closed or not self.should_advertise():
+                return
+            try:
+                await self.start_advertising()
+                return
+            except Exception as e:
+                delay = min(self.backoff_max, max(delay * self.backoff_factor, 0.05))
+                logger.warning(f"⚠️ Re-advertising failed ({e}), retrying in {delay:.2f}s")
+
+    def schedule_readvertise(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._readvertise())
+        return self._task
+
+    def _on_connection(self, connection):
+        if self._advertising_since is not None:
+            self.advertise_to_connect.append(time.perf_counter() - self._advertising_since)
+            self._advertising_since = None
+        self._set_state(LifecycleState.CONNECTED)
+
+        def on_link_disconnection(reason):
+            self._on_disconnection(connection, reason)
+        connection.on("disconnection", on_link_disconnection)
+        self._links[connection.handle] = (connection, on_link_disconnection)
+        if self.should_advertise():
+            self.schedule_readvertise()
+
+    def _on_disconnection(self, connection, reason):
+        connection, listener = self._links.pop(connection.handle, (connection, None))
+        if listener is not None:
+            connection.remove_listener("disconnection", listener)
+        self._disconnected_at = time.perf_counter()
+        self._set_state(LifecycleState.DISCONNECTED)
+        self._set_state(LifecycleState.READVERTISING)
+        self.schedule_readvertise()
+
+    def stats(self):
+        return {
+            "state": self.state.value,
+            "advertising_restarts": self.advertising_restarts,
+            "disconnect_to_readvertise": summarize(self.disconnect_to_readvertise),
+            "advertise_to_connect": summarize(self.advertise_to_connect),
+        }
+
+    def close(self):
+        self._closed = True
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self.device.remove_listener("connection", self._on_connection)
+        for connection, listener in self._links.values():
+            connection.remove_listener("disconnection", listener)
+        self._links.clear()
@@ -0,0 +1,80 @@
+# device_events.py
+#
+# Structured lifecycle events from a VirtualDevice process, one JSON object
+# per line on a dedicated fd (never mixed with log output):
+#
+#   {"event": "ready", "device_id": "...", "mode": "commissioning", "time": ...}
+#   {"event": "connected", ...}  {"event": "commissioned", ...}  {"event": "disconnected", ...}
+#
+# The parent creates the pipe with open_event_pipe() and hands the write end
+# to launch_device(); the device finds it through VIRTUAL_DEVICE_EVENT_FD.
+
+import os
+import json
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+EVENT_FD_ENV = "VIRTUAL_DEVICE_EVENT_FD"
+EVENTS = ("ready", "connected", "commissioned", "disconnected")
+
+
+class EventChannel:
+    def __init__(self, fd=None):
+        self.fd = fd
+        self.listeners = []
+        self.emitted = 0
+
+    @classmethod
+    def from_env(cls):
+        fd = os.environ.get(EVENT_FD_ENV)
+        return cls(int(fd) if fd else None)
+
+    def listen(self, callback):
+        """callback(event_dict) for every event emitted in this process."""
+        self.listeners.append(callback)
+
+    def emit(self, event, device_id, **fields):
+        record = {"event": event, "device_id": device_id, "time": time.time(), **fields}
+        self.emitted += 1
+        for callback in self.listeners:
+            try:
+                callback(record)
+            except Exception as e:
+                logger.error(f"Event listener failed for {event}: {e}")
+        if self.fd is not None:
+            try:
+                # One write per line, well under PIPE_BUF, so lines never interleave
+                os.write(self.fd, json.dumps(record).encode() + b"\n")
+            except OSError as e:
+                logger.warning(f"Event channel closed ({e}), events now local only")
+                self.fd = None
+        return record
+
+
+_channel = None
+
+
+def get_event_channel():
+    global _channel
+    if _channel is None:
+        _channel = EventChannel.from_env()
+    return _channel
+
+
+def open_event_pipe():
+    """(read_fd, write_fd) for a child's event channel; close write_fd after launching."""
+    read_fd, write_fd = os.pipe()
+    os.set_inheritable(write_fd, True)
+    return read_fd, write_fd
+
+
+def read_events(read_fd):
+    """Yield event dicts until every writer has closed the pipe."""
+    with os.fdopen(read_fd, "r") as stream:
+        for line in stream:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                logger.warning(f"Malformed event line: {line.strip()}")
@@ -0,0 +1,232 @@
+# device_host.py
+#
+# Runs many virtual devices in one asyncio process instead of one
+# VirtualDevice.py interpreter per device.
+#
+#   python device_host.py <hostfile.json> [transport]
+#
+# hostfile.json: {"devices": [{"device_id": "dev123", "spec": "Qubo_bulb12W_spec.json",
+#                              "readings": "Readings2.csv"}, ...]}
+#
+# Once running, JSON lines on stdin control the registry:
+#   {"cmd": "start", "device_id": "dev124", "spec": "...", "readings": "..."}
+#   {"cmd": "stop", "device_id": "dev124"}
+#   {"cmd": "update", "device_id": "dev124", "characteristics": {"00dd": {"dd01": "0x01"}}}
+#   {"cmd": "stats"}
+#   {"cmd": "loglevel", "device_id": "dev124", "level": "DEBUG"}   (level null: back to default)
+#   {"cmd": "logs", "device_id": "dev124", "limit": 200}           (dump recent records to stderr)
+#   {"cmd": "ping", "seq": 7}    (heartbeat reply with device count and CPU time, see fleet_supervisor.py)
+#
+# With VIRTUAL_DEVICE_METRICS_PORT set, every hosted device's metrics are
+# served at http://127.0.0.1:<port>/metrics[/<device_id>] (see metrics.py).
+#
+# Device lifecycle events (ready, connected, commissioned, disconnected) are
+# written to stdout as JSON lines alongside the host's own replies.
+#
+# Devices snapshot their state into the host state file (device_state.py);
+# the host decodes all snapshots in one read before starting its devices.
+
+import os
+import sys
+import json
+import time
+import signal
+import asyncio
+import logging
+import resource
+
+from bumble.transport import open_transport_or_link
+
+from startup_timing import StartupTimer
+from device_events import get_event_channel
+from metrics import start_metrics_server, METRICS_PORT_ENV
+from device_logging import set_device_level, dump_recent, install_signal_handlers, shutdown_logging
+from notification_scheduler import get_notification_scheduler
+from profile_cache import profile_cache
+from value_generators import get_generator_bank
+from device_state import preload_states
+from VirtualDevice import start_virtual_device, stop_virtual_device, apply_characteristic_updates
+
+logger = logging.getLogger(__name__)
+
+
+class HostedDevice:
+    def __init__(self, device_id, spec_path, readings_csv, transport, device, start_latency):
+        self.device_id = device_id
+        self.spec_path = spec_path
+        self.readings_csv = readings_csv
+        self.transport = transport
+        self.device = device
+        self.start_latency = start_latency
+        self.started_at = time.time()
+
+
+class VirtualDeviceHost:
+    """Registry of virtual devices sharing one event loop, keyed by device_id."""
+
+    def __init__(self, transport_path="android-netsim", readings_csv="Readings2.csv"):
+        self.transport_path = transport_path
+        self.readings_csv = readings_csv
+        self.devices = {}
+        self._starting = {}
+        get_event_channel().listen(lambda event: print(json.dumps(event), flush=True))
+
+    async def start_device(self, device_id, spec_path, readings_csv=None, transport_path=None):
+        if device_id in self.devices:
+            logger.warning(f"[HOST] {device_id} is already running")
+            return self.devices[device_id]
+        if device_id in self._starting:
+            return await self._starting[device_id]
+
+        future = asyncio.get_running_loop().create_future()
+        self._starting[device_id] = future
+        readings_csv = readings_csv or self.readings_csv
+        timer = StartupTimer(device_id)
+        transport = None
+        try:
+            transport = await open_transport_or_link(transport_path or self.transport_path)
+            timer.mark("transport_open")
+            device = await start_virtual_device(spec_path, readings_csv,
+                                                transport.source, transport.sink, device_id, timer)
+            hosted = HostedDevice(device_id, spec_path, readings_csv, transport, device,
+                                  timer.total())
+            self.devices[device_id] = hosted
+            logger.info(f"[HOST] ✅ {device_id} advertising after {hosted.start_latency * 1e3:.1f} ms")
+            print(json.dumps({"event": "deviceready", "device_id": device_id}), flush=True)
+            future.set_result(hosted)
+            return hosted
+        except Exception as e:
+            logger.error(f"[HOST] ❌ Failed to start {device_id}: {e}")
+            dump_recent(device_id)
+            if transport is not None:
+                await transport.close()
+            future.set_exception(e)
+            # Nobody else may be awaiting it; don't warn about an unretrieved exception
+            future.exception()
+            raise
+        finally:
+            del self._starting[device_id]
+
+    async def stop_device(self, device_id):
+        hosted = self.devices.pop(device_id, None)
+        if hosted is None:
+            return False
+        try:
+            await stop_virtual_device(hosted.device, hosted.spec_path)
+        finally:
+            await hosted.transport.close()
+        logger.info(f"[HOST] 🛑 {device_id} stopped")
+        return True
+
+    def update_device(self, device_id, updates):
+        hosted = self.devices.get(device_id)
+        if hosted is None:
+            logger.warning(f"[HOST] update for unknown device {device_id}")
+            return 0
+        return apply_characteristic_updates(hosted.device, updates)
+
+    async def stop_all(self):
+        for device_id in list(self.devices):
+            await self.stop_device(device_id)
+
+    def stats(self):
+        # ru_maxrss is KiB on Linux
+        rss_kib = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        latencies = sorted(h.start_latency for h in self.devices.values())
+        count = len(latencies)
+        return {
+            "devices": count,
+            "max_rss_kib": rss_kib,
+            "rss_kib_per_device": rss_kib / count if count else None,
+            "start_latency_ms_avg": sum(latencies) / count * 1e3 if count else None,
+            "start_latency_ms_max": latencies[-1] * 1e3 if count else None,
+        }
+
+    async def handle_command(self, command):
+        cmd = command.get("cmd")
+        device_id = command.get("device_id")
+        if cmd == "start":
+            await self.start_device(device_id, command["spec"], command.get("readings"),
+                                    command.get("transport"))
+        elif cmd == "stop":
+            await self.stop_device(device_id)
+        elif cmd == "update":
+            self.update_device(device_id, command)
+        elif cmd == "stats":
+            lifecycles = {device_id: h.device.lifecycle.stats() for device_id, h in self.devices.items()}
+            advertising = {device_id: h.device.advertiser.stats() for device_id, h in self.devices.items()}
+            sessions = {device_id: {**h.device.sessions.stats(), **h.device.long_values.stats()}
+                        for device_id, h in self.devices.items()}
+            notifications = get_notification_scheduler().stats()
+            print(json.dumps({"event": "stats", **self.stats(), "lifecycle": lifecycles,
+                              "notifications": notifications, "advertising": advertising,
+                              "sessions": sessions, "generators": get_generator_bank().stats(),
+                              "profiles": profile_cache.stats()}),
+                  flush=True)
+        elif cmd == "loglevel":
+            level = set_device_level(device_id, command.get("level"))
+            print(json.dumps({"event": "loglevel", "device_id": device_id, "level": level}), flush=True)
+        elif cmd == "logs":
+            dump_recent(device_id, command.get("limit", 200))
+        elif cmd == "ping":
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            print(json.dumps({"event": "heartbeat", "seq": command.get("seq"),
+                              "cpu_s": usage.ru_utime + usage.ru_stime, **self.stats()}), flush=True)
+        else:
+            logger.warning(f"[HOST] Unknown command: {command}")
+
+    async def serve_stdin(self):
+        """Read control commands from stdin without blocking the loop."""
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader()
+        try:
+            await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+        except (ValueError, OSError) as e:
+            logger.info(f"[HOST] stdin control channel unavailable: {e}")
+            return
+        while True:
+            line = await reader.readline()
+            if not line:
+                return
+            try:
+                await self.handle_command(json.loads(line))
+            except Exception as e:
+                logger.error(f"[HOST] ❌ Command failed: {e}")
+
+
+async def run_host(hostfile, transport_path):
+    with open(hostfile, "r") as f:
+        entries = json.load(f).get("devices", [])
+
+    if os.environ.get(METRICS_PORT_ENV):
+        start_metrics_server(os.environ[METRICS_PORT_ENV])
+    install_signal_handlers()
+    # SIGTERM (fleet_supervisor recycling a worker) stops the devices cleanly via the finally below
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    # One read of the host state file instead of one per device
+    try:
+        preload_states()
+    except Exception as e:
+        logger.error(f"[HOST] ❌ Could not preload device states: {e}")
+    host = VirtualDeviceHost(transport_path)
+    results = await asyncio.gather(
+        *(host.start_device(e["device_id"], e["spec"], e.get("readings"), e.get("transport"))
+          for e in entries),
+        return_exceptions=True)
+    failed = sum(isinstance(r, Exception) for r in results)
+    print(json.dumps({"event": "hostready", "failed": failed, **host.stats()}), flush=True)
+    try:
+        await host.serve_stdin()
+        await asyncio.Event().wait()
+    except asyncio.CancelledError:
+        pass
+    finally:
+        await host.stop_all()
+        shutdown_logging()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python device_host.py <hostfile.json> [transport]")
+        sys.exit(1)
+    asyncio.run(run_host(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else "android-netsim"))
@@ -0,0 +1,207 @@
+# device_logging.py
+#
+# Logging for device processes that never blocks the event loop:
+#
+#   - every record goes through a QueueHandler; one background thread
+#     formats it and does the (possibly blocking) pipe/terminal write
+#   - each device logs through its own child logger ("vdev.<device_id>"),
+#     so its level can be changed at runtime without touching the others
+#   - hot-path messages (per read/write) are rate limited per call site,
+#     with a count of what was suppressed on the next message that passes
+#   - a ring buffer keeps the most recent records for dump_recent(), which
+#     runs on errors, on SIGUSR2 and from the device_host "logs" command
+#
+# Levels come from VIRTUAL_DEVICE_LOG_LEVEL (ours, default INFO) and
+# VIRTUAL_DEVICE_BUMBLE_LOG_LEVEL (bumble's own loggers, default WARNING).
+
+import os
+import sys
+import time
+import atexit
+import queue
+import signal
+import logging
+import threading
+from collections import deque
+from logging.handlers import QueueHandler, QueueListener
+
+LOG_LEVEL_ENV = "VIRTUAL_DEVICE_LOG_LEVEL"
+BUMBLE_LOG_LEVEL_ENV = "VIRTUAL_DEVICE_BUMBLE_LOG_LEVEL"
+DEVICE_LOGGER = "vdev"
+FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+
+class RingBufferHandler(logging.Handler):
+    """Keeps the last `capacity` records; formatting is deferred until a dump."""
+
+    def __init__(self, capacity=1000):
+        super().__init__()
+        self.records = deque(maxlen=capacity)
+
+    def emit(self, record):
+        self.records.append(record)
+
+    def recent(self, device_id=None, limit=None):
+        records = list(self.records)
+        if device_id is not None:
+            name = f"{DEVICE_LOGGER}.{device_id}"
+            records = [r for r in records if r.name == name]
+        return records[-limit:] if limit else records
+
+
+class HotPathSampler(logging.Filter):
+    """At most `rate` records per second per call site (logger + line), bursts up to `burst`.
+
+    Only applies below WARNING; warnings and errors always pass.
+    """
+
+    def __init__(self, rate=5.0, burst=20):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self._buckets = {}    # (name, lineno) -> [tokens, last refill, suppressed]
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or not self.rate:
+            return True
+        key = (record.name, record.lineno)
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [float(self.burst), now, 0]
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if bucket[0] < 1.0:
+                bucket[2] += 1
+                return False
+            bucket[0] -= 1.0
+            suppressed, bucket[2] = bucket[2], 0
+        if suppressed:
+            record.msg = f"{record.msg} (+{suppressed} similar suppressed)"
+        return True
+
+
+class _DeferredQueueHandler(QueueHandler):
+    """Hands the record over as is: the writer thread formats it, not the caller."""
+
+    def prepare(self, record):
+        return record
+
+
+_listener = None
+_queue = None
+_ring = None
+_output = None
+_sampler = None
+
+
+def _start_listener():
+    global _listener
+    _listener = QueueListener(_queue, _output, respect_handler_level=True)
+    _listener.start()
+
+
+def _after_fork_in_child():
+    # The listener thread does not survive fork (device_spawner workers):
+    # start a fresh one on a fresh queue in the child
+    global _queue
+    if _listener is None:
+        return
+    _queue = queue.SimpleQueue()
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, QueueHandler):
+            handler.queue = _queue
+    _start_listener()
+
+
+def setup_logging(level=None, bumble_level=None, ring_capacity=1000, stream=None,
+                  sample_rate=5.0, sample_burst=20):
+    """Route all logging through a queue to a background writer. Idempotent."""
+    global _queue, _ring, _output, _sampler
+    level = (level or os.environ.get(LOG_LEVEL_ENV, "INFO")).upper()
+    bumble_level = (bumble_level or os.environ.get(BUMBLE_LOG_LEVEL_ENV, "WARNING")).upper()
+    root = logging.getLogger()
+    root.setLevel(level)
+    logging.getLogger("bumble").setLevel(bumble_level)
+    if _listener is not None:
+        return _ring
+
+    _queue = queue.SimpleQueue()
+    _output = logging.StreamHandler(stream or sys.stderr)
+    _output.setFormatter(logging.Formatter(FORMAT))
+    _ring = RingBufferHandler(ring_capacity)
+    _sampler = HotPathSampler(sample_rate, sample_burst)
+
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    # The ring sees every record at the caller (cheap append, no formatting);
+    # only the queue handler's records reach the writer thread
+    root.addHandler(_ring)
+    root.addHandler(_DeferredQueueHandler(_queue))
+    _start_listener()
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+    atexit.register(shutdown_logging)
+    return _ring
+
+
+def device_logger(device_id):
+    """Per-device logger; hot-path call sites on it are sampled."""
+    log = logging.getLogger(f"{DEVICE_LOGGER}.{device_id}")
+    if _sampler is not None and _sampler not in log.filters:
+        log.addFilter(_sampler)
+    return log
+
+
+def set_device_level(device_id, level):
+    """Change one device's log level at runtime (None: inherit the process level)."""
+    log = logging.getLogger(f"{DEVICE_LOGGER}.{device_id}")
+    log.setLevel(level.upper() if isinstance(level, str) else (level or logging.NOTSET))
+    return logging.getLevelName(log.getEffectiveLevel())
+
+
+def dump_recent(device_id=None, limit=200, stream=None):
+    """Write the ring buffer's most recent records (optionally one device's) synchronously."""
+    if _ring is None:
+        return 0
+    stream = stream or sys.stderr
+    records = _ring.recent(device_id, limit)
+    formatter = logging.Formatter(FORMAT)
+    stream.write(f"----- last {len(records)} log records"
+                 f"{f' for {device_id}' if device_id else ''} -----\n")
+    for record in records:
+        try:
+            stream.write(formatter.format(record) + "\n")
+        except Exception:
+            continue
+    stream.write("----- end of log dump -----\n")
+    stream.flush()
+    return len(records)
+
+
+def install_signal_handlers():
+    """SIGUSR2 dumps the ring buffer; SIGUSR1 toggles DEBUG for the whole process."""
+    def on_dump(signum, frame):
+        threading.Thread(target=dump_recent, daemon=True).start()
+
+    def on_toggle(signum, frame):
+        root = logging.getLogger()
+        if root.level == logging.DEBUG:
+            root.setLevel(os.environ.get(LOG_LEVEL_ENV, "INFO").upper())
+        else:
+            root.setLevel(logging.DEBUG)
+
+    try:
+        signal.signal(signal.SIGUSR2, on_dump)
+        signal.signal(signal.SIGUSR1, on_toggle)
+    except (ValueError, AttributeError):
+        pass   # not the main thread, or no such signals on this platform
+
+
+def shutdown_logging():
+    """Flush what is queued (for clean exits). Safe to call more than once."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
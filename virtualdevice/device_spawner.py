@@ -0,0 +1,242 @@
+# device_spawner.py
+#
+# Zygote / fork server for VirtualDevice workers. The server imports bumble
+# and VirtualDevice once, then forks a ready-to-run worker per request, so a
+# device skips interpreter start and the import phase entirely.
+#
+#   python device_spawner.py /tmp/virtual_device_spawner.sock
+#
+# Clients (BLE_Peripheral) use spawn_device() when VIRTUAL_DEVICE_SPAWNER
+# points at the socket, and fall back to subprocess.Popen otherwise.
+
+import os
+import sys
+import json
+import signal
+import socket
+import logging
+import selectors
+import subprocess
+
+from device_events import EVENT_FD_ENV
+
+logger = logging.getLogger(__name__)
+
+SPAWNER_ENV = "VIRTUAL_DEVICE_SPAWNER"
+
+
+def _run_worker(argv, cwd, env):
+    """Runs in the forked child: becomes one VirtualDevice.py process."""
+    import asyncio
+    import startup_timing
+    import VirtualDevice
+
+    os.chdir(cwd)
+    os.environ.update(env)
+    # Levels from this worker's env; the fork hook already restarted the log writer
+    VirtualDevice.setup_logging()
+    # Fresh timer: this worker paid neither interpreter start nor imports
+    startup_timing.process_timer = startup_timing.StartupTimer()
+    sys.argv = ["VirtualDevice.py"] + list(argv)
+    asyncio.run(VirtualDevice.setup_virtual_device(*argv[:4]))
+
+
+def _fork_worker(request, fds, listener, selector):
+    pid = os.fork()
+    if pid:
+        return pid
+    # Child
+    status = 0
+    try:
+        selector.close()
+        listener.close()
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        os.setsid()
+        devnull = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(devnull, 0)
+        env = request.get("env", {})
+        if request.get("events"):
+            # Event channel is always the last fd; it lands on fd 3
+            os.dup2(fds.pop(), 3)
+            env[EVENT_FD_ENV] = "3"
+        os.dup2(fds[0], 1)
+        os.dup2(fds[1] if len(fds) > 1 else fds[0], 2)
+        # Drop everything else inherited from the server (listener, other clients' sockets)
+        os.closerange(4 if request.get("events") else 3, 65536)
+        _run_worker(request["argv"], request.get("cwd", os.getcwd()), env)
+    except SystemExit as e:
+        status = e.code if isinstance(e.code, int) else 1
+    except BaseException:
+        import traceback
+        traceback.print_exc()
+        status = 1
+    finally:
+        try:
+            # os._exit skips atexit: drain the log writer ourselves
+            from device_logging import shutdown_logging
+            shutdown_logging()
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(status)
+
+
+def serve(socket_path, preload=("VirtualDevice",)):
+    """Fork server main loop. Single-threaded, so forking is safe."""
+    for module in preload:
+        __import__(module)
+    logger.info(f"[SPAWNER] Warmed: {', '.join(preload)}")
+
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(socket_path)
+    listener.listen(128)
+
+    # SIGCHLD wakes the selector through a self-pipe
+    wake_r, wake_w = os.pipe()
+    os.set_blocking(wake_r, False)
+    os.set_blocking(wake_w, False)
+    signal.set_wakeup_fd(wake_w)
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+
+    selector = selectors.DefaultSelector()
+    selector.register(listener, selectors.EVENT_READ, "accept")
+    selector.register(wake_r, selectors.EVENT_READ, "wake")
+    children = {}  # pid -> client connection waiting for the exit status
+    print(f"SPAWNER_READY {socket_path}", flush=True)
+
+    try:
+        while True:
+            for key, _ in selector.select():
+                if key.data == "accept":
+                    conn, _ = listener.accept()
+                    conn.setblocking(True)
+                    try:
+                        msg, fds, _, _ = socket.recv_fds(conn, 64 * 1024, 3)
+                        request = json.loads(msg)
+                        pid = _fork_worker(request, fds, listener, selector)
+                        for fd in fds:
+                            os.close(fd)
+                        conn.sendall(json.dumps({"pid": pid}).encode() + b"\n")
+                        children[pid] = conn
+                    except Exception as e:
+                        logger.error(f"[SPAWNER] ❌ Spawn failed: {e}")
+                        conn.close()
+                elif key.data == "wake":
+                    try:
+                        os.read(wake_r, 4096)
+                    except BlockingIOError:
+                        pass
+                    while children:
+                        try:
+                            pid, status = os.waitpid(-1, os.WNOHANG)
+                        except ChildProcessError:
+                            break
+                        if pid == 0:
+                            break
+                        conn = children.pop(pid, None)
+                        if conn is not None:
+                            try:
+                                conn.sendall(json.dumps({"exit": os.waitstatus_to_exitcode(status)}).encode() + b"\n")
+                            except OSError:
+                                pass
+                            conn.close()
+    finally:
+        selector.close()
+        listener.close()
+        os.unlink(socket_path)
+
+
+class SpawnedDevice:
+    """Popen-like handle for a worker forked by the spawner."""
+
+    def __init__(self, conn, reader, pid, stdout):
+        self._conn = conn
+        self._reader = reader
+        self.pid = pid
+        self.stdout = stdout
+        self.returncode = None
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self):
+        if self.returncode is None:
+            line = self._reader.readline()
+            self.returncode = json.loads(line).get("exit", -1) if line else -1
+            self._reader.close()
+            self._conn.close()
+        return self.returncode
+
+    def send_signal(self, sig):
+        if self.returncode is None:
+            try:
+                os.kill(self.pid, sig)
+            except ProcessLookupError:
+                pass
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+
+def spawn_device(argv, socket_path, capture_stdout=False, env=None, event_fd=None):
+    """Ask the fork server for a VirtualDevice worker running `argv`.
+
+    With capture_stdout the worker's stdout/stderr come back through a pipe
+    (like stdout=PIPE, stderr=STDOUT); otherwise it writes to ours. event_fd
+    is the write end of an event pipe (see device_events.py).
+    """
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.connect(socket_path)
+    read_end = None
+    if capture_stdout:
+        read_end, write_end = os.pipe()
+        fds = [write_end]
+    else:
+        fds = [sys.stdout.fileno(), sys.stderr.fileno()]
+    if event_fd is not None:
+        fds.append(event_fd)
+    request = {"argv": list(argv), "cwd": os.getcwd(), "env": env or {}, "events": event_fd is not None}
+    try:
+        socket.send_fds(conn, [json.dumps(request).encode()], fds)
+    finally:
+        if capture_stdout:
+            os.close(write_end)
+    reader = conn.makefile("r")
+    reply = reader.readline()
+    if not reply:
+        reader.close()
+        conn.close()
+        raise RuntimeError("spawner closed the connection")
+    pid = json.loads(reply)["pid"]
+    stdout = os.fdopen(read_end, "r") if capture_stdout else None
+    return SpawnedDevice(conn, reader, pid, stdout)
+
+
+def launch_device(argv, capture_stdout=False, env=None, event_fd=None):
+    """Start a VirtualDevice worker through the spawner if one is configured, else via Popen."""
+    socket_path = os.environ.get(SPAWNER_ENV)
+    if socket_path and os.path.exists(socket_path):
+        try:
+            return spawn_device(argv, socket_path, capture_stdout, env, event_fd)
+        except (OSError, RuntimeError) as e:
+            print(f"[SPAWNER] ⚠️ Spawner unavailable ({e}), starting a fresh interpreter")
+    kwargs = {"stdin": subprocess.DEVNULL, "env": {**os.environ, **(env or {})}}
+    if event_fd is not None:
+        kwargs["pass_fds"] = (event_fd,)
+        kwargs["env"][EVENT_FD_ENV] = str(event_fd)
+    if capture_stdout:
+        kwargs.update(stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    return subprocess.Popen([sys.executable, "VirtualDevice.py"] + list(argv), **kwargs)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    path = sys.argv[1] if len(sys.argv) > 1 else os.environ.get(SPAWNER_ENV, "/tmp/virtual_device_spawner.sock")
+    serve(path)
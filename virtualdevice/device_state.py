@@ -0,0 +1,472 @@
+# device_state.py
+#
+# Compact binary snapshots of per-device state, one mmap'd file per host
+# ($VIRTUAL_DEVICE_STATE_FILE, default device_state.bin in the working
+# directory) with a fixed slot per device:
+#
+#   header: magic, version, slot_count, slot_size, used_slots, generation
+#   slot:   device_id[48], saves u32, flags u32, length u32, saved_ns u64,
+#           reset_value[16], body[slot_size]
+#   body:   address[6], name (u8 length), values (u16 count, then per
+#           characteristic u8 uuid length, uuid, u16 length, encoded bytes),
+#           bonds (u32 length, compact JSON of bumble PairingKeys dicts)
+#
+# Setup status and a pending reset live in the slot header, so flipping
+# them rewrites a few bytes instead of the pretty-printed spec. A host reads
+# every slot with one copy under a shared lock (preload_states); writers take
+# an exclusive flock, so device processes and BLE_Peripheral can share a file.
+#
+# The spec JSON stays the source of the GATT structure. Snapshot values are
+# applied only if the spec has not been modified since the snapshot was
+# taken; the spec's own journal is replayed on top of them.
+
+import os
+import json
+import mmap
+import time
+import fcntl
+import struct
+import asyncio
+import logging
+from contextlib import contextmanager
+
+from persistence_journal import enable_spec_journal
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"VDDS"
+VERSION = 1
+HEADER = struct.Struct("<4sHHIIQ")           # magic, version, slot_count, slot_size, used_slots, generation
+HEADER_SIZE = 64
+SLOT_HEADER = struct.Struct("<48sIIIQ16s")   # device_id, saves, flags, length, saved_ns, reset_value
+FLAGS_OFFSET = 52
+RESET_OFFSET = 68
+
+FLAG_SETUP_COMPLETE = 0x1
+FLAG_VALUES_RESET = 0x2
+FLAG_HAS_VALUES = 0x4
+
+STATE_FILE_ENV = "VIRTUAL_DEVICE_STATE_FILE"
+DEFAULT_STATE_FILE = "device_state.bin"
+
+
+class DeviceState:
+    """What a device needs to come back as itself: setup, values, bonds, advertising identity."""
+
+    __slots__ = ("device_id", "setup_complete", "address", "local_name", "values", "bonds",
+                 "reset_value", "saved_ns", "saves")
+
+    def __init__(self, device_id, setup_complete=False, address=None, local_name=None, values=None,
+                 bonds=None, reset_value=None, saved_ns=0, saves=0):
+        self.device_id = device_id
+        self.setup_complete = setup_complete
+        self.address = address
+        self.local_name = local_name
+        self.values = values          # {normalized uuid: encoded bytes}, None if not captured
+        self.bonds = bonds or {}      # {peer: PairingKeys.to_dict()}
+        self.reset_value = reset_value
+        self.saved_ns = saved_ns
+        self.saves = saves
+
+    def flags(self):
+        flags = FLAG_SETUP_COMPLETE if self.setup_complete else 0
+        if self.reset_value is not None:
+            flags |= FLAG_VALUES_RESET
+        if self.values is not None:
+            flags |= FLAG_HAS_VALUES
+        return flags
+
+
+def _pack_address(address):
+    if not address:
+        return bytes(6)
+    return bytes.fromhex(str(address).split("/")[0].replace(":", ""))[:6].ljust(6, b"\0")
+
+
+def _unpack_address(data):
+    if not any(data):
+        return None
+    return ":".join(f"{b:02X}" for b in data)
+
+
+def encode_body(state, with_values=True, with_bonds=True):
+    name = (state.local_name or "").encode("utf-8")[:255]
+    parts = [_pack_address(state.address), bytes((len(name),)), name]
+    values = state.values if with_values and state.values is not None else {}
+    parts.append(struct.pack("<H", len(values)))
+    for uuid, data in values.items():
+        key = uuid.encode()[:255]
+        parts += [bytes((len(key),)), key, struct.pack("<H", len(data)), data]
+    bonds = json.dumps(state.bonds, separators=(",", ":")).encode() if with_bonds and state.bonds else b""
+    parts += [struct.pack("<I", len(bonds)), bonds]
+    return b"".join(parts)
+
+
+def decode_body(state, body, flags):
+    view = memoryview(body)
+    state.address = _unpack_address(view[:6])
+    pos = 6
+    name_len = view[pos]
+    state.local_name = bytes(view[pos + 1:pos + 1 + name_len]).decode("utf-8", errors="replace") or None
+    pos += 1 + name_len
+    count, = struct.unpack_from("<H", view, pos)
+    pos += 2
+    values = {}
+    for _ in range(count):
+        key_len = view[pos]
+        uuid = bytes(view[pos + 1:pos + 1 + key_len]).decode()
+        pos += 1 + key_len
+        length, = struct.unpack_from("<H", view, pos)
+        values[uuid] = bytes(view[pos + 2:pos + 2 + length])
+        pos += 2 + length
+    state.values = values if flags & FLAG_HAS_VALUES else None
+    bonds_len, = struct.unpack_from("<I", view, pos)
+    state.bonds = json.loads(bytes(view[pos + 4:pos + 4 + bonds_len])) if bonds_len else {}
+    return state
+
+
+class DeviceStateFile:
+    """Fixed-slot snapshot file shared by every device of a host, keyed by device_id."""
+
+    def __init__(self, path, slot_count=1024, slot_size=4096):
+        self.path = path
+        self.pid = os.getpid()
+        if not os.path.exists(path):
+            size = HEADER_SIZE + slot_count * (SLOT_HEADER.size + slot_size)
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as f:
+                f.truncate(size)
+                f.seek(0)
+                f.write(HEADER.pack(MAGIC, VERSION, slot_count, slot_size, 0, 0))
+            # link() rather than replace(): a file another process created first wins
+            try:
+                os.link(tmp, path)
+            except FileExistsError:
+                pass
+            finally:
+                os.unlink(tmp)
+        self._file = open(path, "r+b")
+        self._map = mmap.mmap(self._file.fileno(), 0)
+        magic, version, self.slot_count, self.slot_size, _, _ = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a device state file")
+        self.stride = SLOT_HEADER.size + self.slot_size
+        self._index = {}        # device_id -> slot number
+        self._indexed = 0
+        self.saves = 0
+
+    @contextmanager
+    def _locked(self, exclusive=True):
+        fcntl.flock(self._file.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+
+    def _slot_offset(self, slot):
+        return HEADER_SIZE + slot * self.stride
+
+    def _refresh_index(self):
+        used = HEADER.unpack_from(self._map, 0)[4]
+        for slot in range(self._indexed, used):
+            device_id = SLOT_HEADER.unpack_from(self._map, self._slot_offset(slot))[0]
+            self._index[device_id.rstrip(b"\0").decode()] = slot
+        self._indexed = used
+
+    def _slot(self, device_id, allocate=False):
+        """Slot offset for a device (call with the lock held); None if absent and not allocating."""
+        self._refresh_index()
+        slot = self._index.get(device_id)
+        if slot is None:
+            if not allocate:
+                return None
+            magic, version, count, size, used, generation = HEADER.unpack_from(self._map, 0)
+            if used >= count:
+                raise OverflowError(f"{self.path}: all {count} device slots in use")
+            slot = used
+            SLOT_HEADER.pack_into(self._map, self._slot_offset(slot), device_id.encode()[:48], 0, 0, 0, 0, b"")
+            HEADER.pack_into(self._map, 0, magic, version, count, size, used + 1, generation)
+            self._index[device_id] = slot
+            self._indexed = used + 1
+        return self._slot_offset(slot)
+
+    def _bump_generation(self):
+        struct.pack_into("<Q", self._map, 16, struct.unpack_from("<Q", self._map, 16)[0] + 1)
+
+    # Writers -------------------------------------------------------------------
+
+    def save(self, state):
+        """Write a full snapshot; values, then bonds, are left out if the slot is too small."""
+        body = encode_body(state)
+        flags = state.flags()
+        if len(body) > self.slot_size:
+            body = encode_body(state, with_values=False)
+            flags &= ~FLAG_HAS_VALUES
+            logger.warning(f"⚠️ {state.device_id}: values do not fit a {self.slot_size} byte state slot")
+        if len(body) > self.slot_size:
+            body = encode_body(state, with_values=False, with_bonds=False)
+        reset = (state.reset_value or "").encode()[:16]
+        with self._locked():
+            offset = self._slot(state.device_id, allocate=True)
+            saves = SLOT_HEADER.unpack_from(self._map, offset)[1] + 1
+            start = offset + SLOT_HEADER.size
+            self._map[start:start + len(body)] = body
+            SLOT_HEADER.pack_into(self._map, offset, state.device_id.encode()[:48], saves, flags, len(body),
+                                  time.time_ns(), reset)
+            self._bump_generation()
+        self.saves += 1
+
+    def _update_flags(self, device_id, set_bits=0, clear_bits=0, reset_value=None):
+        with self._locked():
+            offset = self._slot(device_id, allocate=True)
+            flags = struct.unpack_from("<I", self._map, offset + FLAGS_OFFSET)[0]
+            struct.pack_into("<I", self._map, offset + FLAGS_OFFSET, (flags | set_bits) & ~clear_bits)
+            if reset_value is not None:
+                struct.pack_into("16s", self._map, offset + RESET_OFFSET, reset_value.encode()[:16])
+            self._bump_generation()
+
+    def set_setup(self, device_id, complete):
+        if complete:
+            self._update_flags(device_id, set_bits=FLAG_SETUP_COMPLETE)
+        else:
+            self._update_flags(device_id, clear_bits=FLAG_SETUP_COMPLETE)
+
+    def reset(self, device_id, value="0x00"):
+        """Back to commissioning with every value set to `value` on the next start."""
+        self._update_flags(device_id, set_bits=FLAG_VALUES_RESET, clear_bits=FLAG_SETUP_COMPLETE,
+                           reset_value=value)
+
+    def clear_reset(self, device_id):
+        self._update_flags(device_id, clear_bits=FLAG_VALUES_RESET)
+
+    # Readers -------------------------------------------------------------------
+
+    def flags(self, device_id):
+        """Slot flags without decoding the body; None if the device has no slot."""
+        with self._locked(exclusive=False):
+            offset = self._slot(device_id)
+            if offset is None:
+                return None
+            return struct.unpack_from("<I", self._map, offset + FLAGS_OFFSET)[0]
+
+    @staticmethod
+    def _decode(buffer, offset):
+        device_id, saves, flags, length, saved_ns, reset = SLOT_HEADER.unpack_from(buffer, offset)
+        state = DeviceState(device_id.rstrip(b"\0").decode(),
+                            setup_complete=bool(flags & FLAG_SETUP_COMPLETE),
+                            reset_value=reset.rstrip(b"\0").decode() if flags & FLAG_VALUES_RESET else None,
+                            saved_ns=saved_ns, saves=saves)
+        if length:
+            start = offset + SLOT_HEADER.size
+            decode_body(state, buffer[start:start + length], flags)
+        return state
+
+    def load(self, device_id):
+        with self._locked(exclusive=False):
+            offset = self._slot(device_id)
+            if offset is None:
+                return None
+            return self._decode(bytes(self._map[offset:offset + self.stride]), 0)
+
+    def load_all(self):
+        """Every device's state from one copy of the used slots."""
+        with self._locked(exclusive=False):
+            used = HEADER.unpack_from(self._map, 0)[4]
+            buffer = bytes(self._map[HEADER_SIZE:HEADER_SIZE + used * self.stride])
+        states = {}
+        for slot in range(used):
+            try:
+                state = self._decode(buffer, slot * self.stride)
+            except (ValueError, struct.error, IndexError) as e:
+                logger.warning(f"⚠️ Skipping unreadable state slot {slot} in {self.path}: {e}")
+                continue
+            states[state.device_id] = state
+        return states
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+
+_state_file = None
+_preloaded = {}
+
+
+def state_file_path():
+    return os.environ.get(STATE_FILE_ENV, DEFAULT_STATE_FILE)
+
+
+def get_state_file():
+    """This process's handle on the host state file (reopened after fork: flock is per open file)."""
+    global _state_file
+    if _state_file is None or _state_file.pid != os.getpid():
+        _state_file = DeviceStateFile(state_file_path())
+    return _state_file
+
+
+def preload_states():
+    """Decode every snapshot at once; restore_state() then hands them out without touching the file."""
+    started = time.perf_counter()
+    _preloaded.update(get_state_file().load_all())
+    logger.info(f"💾 Preloaded {len(_preloaded)} device states in "
+                f"{(time.perf_counter() - started) * 1e3:.1f} ms")
+    return len(_preloaded)
+
+
+def restore_state(device_id):
+    state = _preloaded.pop(device_id, None)
+    if state is None:
+        state = get_state_file().load(device_id)
+    return state
+
+
+def apply_state(value_store, config, state):
+    """Bring a device's spec view in line with its snapshot before the GATT server is built.
+
+    Returns the number of characteristic values restored or reset.
+    """
+    apply_identity(config, state)
+    config["setup_complete"] = "YES" if state.setup_complete else "NO"
+    restored = apply_values(value_store, state)
+    # A journal left by a crash is newer than any snapshot: it is replayed on top
+    journal = enable_spec_journal(value_store)
+    for uuid, value in restored.items():
+        if value_store.get(uuid) == value:
+            # The spec file catches up on the next journal flush
+            journal.append(uuid, value)
+    reset = apply_reset(value_store, state)
+    if reset:
+        get_state_file().clear_reset(state.device_id)
+        logger.info(f"♻️ {state.device_id}: {reset} values reset to {state.reset_value}")
+    return len(restored) + reset
+
+
+def apply_identity(config, state):
+    """Fill in the advertising identity from a snapshot where the spec leaves it open."""
+    if state.address and not config.get("address"):
+        config["address"] = state.address
+    if state.local_name and not config.get("advertisement", {}).get("local_name"):
+        config.setdefault("advertisement", {})["local_name"] = state.local_name
+
+
+def apply_values(value_store, state):
+    """Snapshot values for a spec not modified since the snapshot; returns {uuid: spec value} applied."""
+    if not state.values:
+        return {}
+    try:
+        spec_mtime = os.stat(value_store.json_file).st_mtime_ns
+    except OSError:
+        return {}
+    if spec_mtime > state.saved_ns:
+        return {}
+    applied = {}
+    for uuid, data in state.values.items():
+        if uuid not in value_store:
+            continue
+        value = value_store.codec(uuid).decode(data)
+        if value_store.get(uuid) != value:
+            value_store.set(uuid, value, persist=False)
+            applied[uuid] = value
+    return applied
+
+
+def apply_reset(value_store, state):
+    """Apply a reset recorded by BLE_Peripheral --reset; returns the number of values reset."""
+    if state.reset_value is None:
+        return 0
+    for uuid in value_store.uuids():
+        value_store.set(uuid, state.reset_value)
+    return len(value_store.uuids())
+
+
+async def restore_bonds(device, state):
+    keystore = getattr(device, "keystore", None)
+    if keystore is None or not state.bonds:
+        return 0
+    from bumble.keys import PairingKeys
+    for name, keys in state.bonds.items():
+        await keystore.update(name, PairingKeys.from_dict(keys))
+    return len(state.bonds)
+
+
+async def capture_state(device, device_id, config, setup_complete):
+    store = device.value_store
+    values = {}
+    for uuid in store.uuids():
+        try:
+            # The persistent value, not whatever a live source is serving right now
+            values[uuid] = store.codec(uuid).encode(store.get(uuid))
+        except (ValueError, TypeError, struct.error):
+            continue
+    bonds = {}
+    keystore = getattr(device, "keystore", None)
+    if keystore is not None:
+        try:
+            bonds = {name: keys.to_dict() for name, keys in await keystore.get_all()}
+        except Exception as e:
+            logger.warning(f"⚠️ Could not read bonds of {device_id}: {e}")
+    address = config.get("address") or str(getattr(device, "random_address", "") or "")
+    local_name = config.get("advertisement", {}).get("local_name")
+    return DeviceState(device_id, setup_complete=setup_complete, address=address, local_name=local_name,
+                       values=values, bonds=bonds)
+
+
+class StateSaver:
+    """Keeps one device's snapshot current: after value changes (coalesced) and on close."""
+
+    def __init__(self, device, device_id, config, state_file=None, interval=5.0):
+        self.device = device
+        self.device_id = device_id
+        self.config = config
+        self.state_file = state_file or get_state_file()
+        self.interval = interval
+        self.saves = 0
+        self._dirty = asyncio.Event()
+        self._task = None
+        device.value_store.add_listener(self._on_value)
+
+    def _on_value(self, uuid):
+        self._dirty.set()
+
+    async def save(self):
+        state = await capture_state(self.device, self.device_id, self.config,
+                                    setup_complete=not self.device.commissioning)
+        self.state_file.save(state)
+        self.saves += 1
+
+    async def _run(self):
+        while True:
+            await self._dirty.wait()
+            self._dirty.clear()
+            try:
+                await self.save()
+            except Exception as e:
+                logger.error(f"❌ State snapshot of {self.device_id} failed: {e}")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self._task is None:
+            self._dirty.set()     # first snapshot right away
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        return self._task
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self.device.value_store.remove_listener(self._on_value)
+        await self.save()
+
+
+if __name__ == "__main__":
+    import sys
+    path = sys.argv[1] if len(sys.argv) > 1 else state_file_path()
+    if not os.path.exists(path):
+        print(f"No state file at {path}")
+        sys.exit(1)
+    states = DeviceStateFile(path).load_all()
+    print(json.dumps({device_id: {"setup_complete": s.setup_complete, "address": s.address,
+                                  "local_name": s.local_name, "reset_value": s.reset_value,
+                                  "values": {u: v.hex() for u, v in (s.values or {}).items()},
+                                  "bonds": len(s.bonds), "saves": s.saves}
+                      for device_id, s in states.items()}, indent=4))
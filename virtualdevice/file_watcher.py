@@ -0,0 +1,190 @@
+# file_watcher.py
+
+import os
+import errno
+import struct
+import ctypes
+import ctypes.util
+import asyncio
+import logging
+import threading
+import select
+
+logger = logging.getLogger(__name__)
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# Watch directories rather than files: atomic writers replace the inode.
+# Only completed writes/renames count, never a half-written file.
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO
+
+_EVENT_HEADER = struct.Struct("iIII")
+
+
+def _load_inotify():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+
+class FileWatcher:
+    """Calls callback(path) whenever a watched file changes.
+
+    Uses inotify where available, so an idle watcher costs nothing; otherwise
+    falls back to stat() polling every poll_interval seconds.
+    """
+
+    def __init__(self, poll_interval=1.0, use_inotify=True):
+        self.poll_interval = poll_interval
+        self._callbacks = {}     # abspath -> [callback]
+        self._dirs = {}          # dir -> watch descriptor
+        self._wd_dirs = {}       # watch descriptor -> dir
+        self._signatures = {}    # abspath -> (mtime_ns, size), polling mode only
+        self._lock = threading.Lock()
+        self._fd = None
+        self._loop = None
+        self._closed = False
+        self._libc = _load_inotify() if use_inotify else None
+        if self._libc is not None:
+            fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd >= 0:
+                self._fd = fd
+            else:
+                logger.warning(f"inotify unavailable ({os.strerror(ctypes.get_errno())}), polling instead")
+
+    @property
+    def uses_inotify(self):
+        return self._fd is not None
+
+    def watch(self, path, callback):
+        path = os.path.abspath(path)
+        directory = os.path.dirname(path)
+        with self._lock:
+            self._callbacks.setdefault(path, []).append(callback)
+            self._signatures[path] = self._stat(path)
+            if self._fd is not None and directory not in self._dirs:
+                wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), WATCH_MASK)
+                if wd < 0:
+                    raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {directory}")
+                self._dirs[directory] = wd
+                self._wd_dirs[wd] = directory
+
+    def unwatch(self, path):
+        path = os.path.abspath(path)
+        directory = os.path.dirname(path)
+        with self._lock:
+            self._callbacks.pop(path, None)
+            self._signatures.pop(path, None)
+            still_used = any(os.path.dirname(p) == directory for p in self._callbacks)
+            if self._fd is not None and not still_used and directory in self._dirs:
+                wd = self._dirs.pop(directory)
+                self._wd_dirs.pop(wd, None)
+                self._libc.inotify_rm_watch(self._fd, wd)
+
+    @staticmethod
+    def _stat(path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def _read_events(self):
+        """Drain the inotify fd and return the set of watched paths that changed."""
+        changed = set()
+        while True:
+            try:
+                data = os.read(self._fd, 64 * 1024)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            if not data:
+                break
+            offset = 0
+            while offset + _EVENT_HEADER.size <= len(data):
+                wd, mask, cookie, length = _EVENT_HEADER.unpack_from(data, offset)
+                offset += _EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip(b"\0")
+                offset += length
+                directory = self._wd_dirs.get(wd)
+                if directory and name:
+                    path = os.path.join(directory, os.fsdecode(name))
+                    if path in self._callbacks:
+                        changed.add(path)
+        return changed
+
+    def _poll_changes(self):
+        changed = set()
+        with self._lock:
+            paths = list(self._callbacks)
+        for path in paths:
+            signature = self._stat(path)
+            if signature != self._signatures.get(path):
+                self._signatures[path] = signature
+                if signature is not None:
+                    changed.add(path)
+        return changed
+
+    def _dispatch(self, changed):
+        for path in changed:
+            for callback in list(self._callbacks.get(path, ())):
+                try:
+                    callback(path)
+                except Exception as e:
+                    logger.error(f"❌ Watch callback failed for {path}: {e}")
+
+    def check(self):
+        """Process pending changes once (non-blocking)."""
+        changed = self._read_events() if self._fd is not None else self._poll_changes()
+        self._dispatch(changed)
+        return changed
+
+    def start(self):
+        """Watch from a daemon thread; blocks in select() between events."""
+        def loop():
+            while not self._closed:
+                if self._fd is not None:
+                    try:
+                        ready, _, _ = select.select([self._fd], [], [], None)
+                    except (OSError, ValueError):
+                        return
+                    if ready:
+                        self.check()
+                else:
+                    self.check()
+                    threading.Event().wait(self.poll_interval)
+        thread = threading.Thread(target=loop, daemon=True)
+        thread.start()
+        return thread
+
+    def attach(self, loop=None):
+        """Watch from an asyncio loop without a thread."""
+        loop = loop or asyncio.get_running_loop()
+        if self._fd is not None:
+            self._loop = loop
+            loop.add_reader(self._fd, self.check)
+            return None
+
+        async def poll():
+            while not self._closed:
+                self.check()
+                await asyncio.sleep(self.poll_interval)
+        return loop.create_task(poll())
+
+    def close(self):
+        self._closed = True
+        if self._fd is not None:
+            if self._loop is not None:
+                self._loop.remove_reader(self._fd)
+                self._loop = None
+            os.close(self._fd)
+            self._fd = None
@@ -0,0 +1,430 @@
+# fleet_supervisor.py
+#
+# Runs a fleet of virtual devices over a pool of device_host.py worker
+# processes, one per core by default:
+#
+#   python fleet_supervisor.py <hostfile.json> [--workers N] [--transport android-netsim]
+#                              [--memory-mb 1024] [--heartbeat 2] [--report 10]
+#
+# hostfile.json is the device_host.py format ({"devices": [...]}). Devices
+# are sharded over the workers; each worker starts its shard from a hostfile
+# of its own and later assignments arrive on its stdin control channel.
+#
+#   placement    worker i is pinned to CPU i (mod the CPUs we may use)
+#   memory       --memory-mb caps the worker's data segment (RLIMIT_DATA) and
+#                a worker whose RSS passes 90% of it is recycled
+#   health       a "ping" every --heartbeat seconds; a worker that has not
+#                answered for HEARTBEAT_MISSES intervals is killed
+#   restarts     exponential backoff (RestartBackoff), reset once a worker
+#                has stayed up for a while
+#   rebalance    a dead worker's devices move to the least loaded live
+#                workers at once; when it is back, devices move from the
+#                busiest workers until device counts are even
+#
+# Worker events are relayed to stdout with a "worker" field, and a "fleet"
+# line reports per-worker load every --report seconds. stdin takes the
+# device_host commands (start/stop/update are routed to the device's
+# worker, stats goes to all of them) plus {"cmd": "fleet"}.
+
+import os
+import sys
+import json
+import time
+import signal
+import shutil
+import asyncio
+import logging
+import argparse
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+HEARTBEAT_MISSES = 3
+STARTUP_TIMEOUT = 120.0          # seconds a worker may take to start its shard
+RSS_RECYCLE_RATIO = 0.9
+
+
+class RestartBackoff:
+    """Exponential restart delay that resets after a run of at least `reset_after` seconds."""
+
+    def __init__(self, base=0.5, cap=30.0, reset_after=60.0):
+        self.base = base
+        self.cap = cap
+        self.reset_after = reset_after
+        self.delay = base
+
+    def next(self, uptime):
+        if uptime >= self.reset_after:
+            self.delay = self.base
+        delay = self.delay
+        self.delay = min(self.cap, self.delay * 2)
+        return delay
+
+
+def usable_cpus():
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def _rss_kib(pid):
+    try:
+        with open(f"/proc/{pid}/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class Worker:
+    """One device_host.py process and the devices assigned to it."""
+
+    def __init__(self, index, cpu):
+        self.index = index
+        self.cpu = cpu
+        self.process = None
+        self.state = "stopped"        # starting, ready, dead, stopped
+        self.devices = {}             # device_id -> hostfile entry
+        self.restarts = 0
+        self.backoff = RestartBackoff()
+        self.started_at = 0.0
+        self.last_heartbeat = 0.0
+        self.heartbeat = {}
+        self.cpu_percent = None
+        self._cpu_sample = None       # (monotonic, cpu seconds) of the previous heartbeat
+
+    @property
+    def alive(self):
+        return self.state in ("starting", "ready")
+
+    def send(self, command):
+        if self.process is None or self.process.stdin is None or self.process.stdin.is_closing():
+            return False
+        self.process.stdin.write((json.dumps(command) + "\n").encode())
+        return True
+
+    def on_heartbeat(self, event):
+        now = time.monotonic()
+        cpu_s = event.get("cpu_s")
+        if cpu_s is not None and self._cpu_sample is not None and now > self._cpu_sample[0]:
+            self.cpu_percent = (cpu_s - self._cpu_sample[1]) / (now - self._cpu_sample[0]) * 100
+        if cpu_s is not None:
+            self._cpu_sample = (now, cpu_s)
+        self.heartbeat = event
+        self.last_heartbeat = now
+
+    def report(self):
+        pid = self.process.pid if self.process is not None else None
+        return {
+            "worker": self.index,
+            "pid": pid,
+            "cpu": self.cpu,
+            "state": self.state,
+            "devices": len(self.devices),
+            "running": self.heartbeat.get("devices"),
+            "cpu_percent": round(self.cpu_percent, 1) if self.cpu_percent is not None else None,
+            "rss_kib": _rss_kib(pid) if pid and self.alive else None,
+            "restarts": self.restarts,
+            "uptime_s": round(time.monotonic() - self.started_at, 1) if self.alive else None,
+            "heartbeat_age_s": (round(time.monotonic() - self.last_heartbeat, 1)
+                                if self.last_heartbeat else None),
+        }
+
+
+class FleetSupervisor:
+    def __init__(self, entries, workers=None, transport="android-netsim", memory_mb=None,
+                 heartbeat=2.0, report_interval=10.0):
+        cpus = usable_cpus()
+        count = workers or len(cpus)
+        self.workers = [Worker(i, cpus[i % len(cpus)]) for i in range(count)]
+        self.entries = {e["device_id"]: e for e in entries}
+        self.owner = {}               # device_id -> Worker
+        self.transport = transport
+        self.memory_mb = memory_mb
+        self.heartbeat_interval = heartbeat
+        self.report_interval = report_interval
+        self.moves = 0
+        self.workdir = tempfile.mkdtemp(prefix="fleet_")
+        self._tasks = set()
+        self._closing = False
+
+    # Placement -------------------------------------------------------------
+
+    def _least_loaded(self, exclude=None):
+        live = [w for w in self.workers if w.alive and w is not exclude]
+        return min(live, key=lambda w: len(w.devices)) if live else None
+
+    def _assign(self, device_id, worker, send=True):
+        entry = self.entries[device_id]
+        previous = self.owner.get(device_id)
+        if previous is not None:
+            previous.devices.pop(device_id, None)
+        worker.devices[device_id] = entry
+        self.owner[device_id] = worker
+        if send:
+            worker.send({"cmd": "start", "device_id": device_id, "spec": entry["spec"],
+                         "readings": entry.get("readings"), "transport": entry.get("transport")})
+
+    def _move(self, device_id, target):
+        source = self.owner.get(device_id)
+        if source is not None and source.alive:
+            source.send({"cmd": "stop", "device_id": device_id})
+        self._assign(device_id, target)
+        self.moves += 1
+
+    def rebalance(self):
+        """Move devices from the busiest to the idlest live worker until counts differ by at most one."""
+        moved = 0
+        while True:
+            live = [w for w in self.workers if w.state == "ready"]
+            if len(live) < 2:
+                return moved
+            busiest = max(live, key=lambda w: len(w.devices))
+            idlest = min(live, key=lambda w: len(w.devices))
+            if len(busiest.devices) - len(idlest.devices) <= 1:
+                return moved
+            self._move(next(iter(busiest.devices)), idlest)
+            moved += 1
+
+    # Worker processes ------------------------------------------------------
+
+    def _preexec(self, worker):
+        cpu, memory_mb = worker.cpu, self.memory_mb
+
+        def setup():
+            # Runs in the child between fork and exec
+            os.setpgid(0, 0)
+            if hasattr(os, "sched_setaffinity"):
+                os.sched_setaffinity(0, {cpu})
+            if memory_mb:
+                import resource
+                limit = int(memory_mb) * 1024 * 1024
+                resource.setrlimit(resource.RLIMIT_DATA, (limit, limit))
+        return setup
+
+    async def spawn(self, worker):
+        shard = os.path.join(self.workdir, f"worker{worker.index}.json")
+        with open(shard, "w") as f:
+            json.dump({"devices": list(worker.devices.values())}, f)
+        worker.process = await asyncio.create_subprocess_exec(
+            sys.executable, "device_host.py", shard, self.transport,
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+            preexec_fn=self._preexec(worker))
+        worker.state = "starting"
+        worker.started_at = time.monotonic()
+        worker.last_heartbeat = 0.0
+        worker.heartbeat = {}
+        worker._cpu_sample = None
+        logger.info(f"[FLEET] worker {worker.index} pid {worker.process.pid} on cpu {worker.cpu} "
+                    f"with {len(worker.devices)} devices")
+        self._spawn_task(self._read(worker, worker.process))
+        self._spawn_task(self._watch(worker, worker.process))
+
+    def _spawn_task(self, coro):
+        task = asyncio.get_running_loop().create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def _read(self, worker, process):
+        while True:
+            line = await process.stdout.readline()
+            if not line:
+                return
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue
+            kind = event.get("event")
+            if kind == "heartbeat":
+                worker.on_heartbeat(event)
+                continue
+            if kind == "hostready" and worker.process is process:
+                worker.state = "ready"
+                worker.last_heartbeat = time.monotonic()
+                self.rebalance()
+            print(json.dumps({**event, "worker": worker.index}), flush=True)
+
+    async def _watch(self, worker, process):
+        code = await process.wait()
+        if worker.process is not process or self._closing:
+            return
+        uptime = time.monotonic() - worker.started_at
+        worker.state = "dead"
+        logger.error(f"[FLEET] ❌ worker {worker.index} (pid {process.pid}) exited with {code} "
+                     f"after {uptime:.1f}s, {len(worker.devices)} devices to move")
+        print(json.dumps({"event": "workerexit", "worker": worker.index, "code": code,
+                          "devices": len(worker.devices)}), flush=True)
+        # Survivors take the devices now; the restarted worker gets its share back by rebalancing
+        for device_id in list(worker.devices):
+            target = self._least_loaded(exclude=worker)
+            if target is None:
+                break
+            self._assign(device_id, target)
+            self.moves += 1
+        delay = worker.backoff.next(uptime)
+        await asyncio.sleep(delay)
+        if self._closing:
+            return
+        worker.restarts += 1
+        try:
+            await self.spawn(worker)
+        except Exception as e:
+            logger.error(f"[FLEET] ❌ Could not restart worker {worker.index}: {e}")
+            self._spawn_task(self._watch(worker, process))
+
+    def _recycle(self, worker, reason):
+        logger.warning(f"[FLEET] ⚠️ recycling worker {worker.index}: {reason}")
+        try:
+            if reason == "unresponsive":
+                worker.process.kill()
+            else:
+                # Graceful: device_host stops its devices (journals, snapshots) on SIGTERM
+                worker.process.terminate()
+        except ProcessLookupError:
+            pass
+
+    async def _health_loop(self):
+        seq = 0
+        limit_kib = self.memory_mb * 1024 * RSS_RECYCLE_RATIO if self.memory_mb else None
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            seq += 1
+            now = time.monotonic()
+            for worker in self.workers:
+                if worker.state == "starting":
+                    if now - worker.started_at > STARTUP_TIMEOUT:
+                        self._recycle(worker, "unresponsive")
+                    continue
+                if worker.state != "ready":
+                    continue
+                if now - worker.last_heartbeat > self.heartbeat_interval * HEARTBEAT_MISSES:
+                    self._recycle(worker, "unresponsive")
+                    continue
+                rss = _rss_kib(worker.process.pid)
+                if limit_kib and rss and rss > limit_kib:
+                    self._recycle(worker, f"rss {rss} KiB over {limit_kib:.0f} KiB")
+                    continue
+                worker.send({"cmd": "ping", "seq": seq})
+
+    def report(self):
+        workers = [w.report() for w in self.workers]
+        return {"event": "fleet", "devices": len(self.entries),
+                "live_workers": sum(w.alive for w in self.workers), "moves": self.moves,
+                "cpu_percent": round(sum(w["cpu_percent"] or 0 for w in workers), 1),
+                "workers": workers}
+
+    async def _report_loop(self):
+        while True:
+            await asyncio.sleep(self.report_interval)
+            print(json.dumps(self.report()), flush=True)
+
+    # Control ---------------------------------------------------------------
+
+    async def handle_command(self, command):
+        cmd = command.get("cmd")
+        device_id = command.get("device_id")
+        if cmd == "start":
+            self.entries[device_id] = {k: command.get(k) for k in ("device_id", "spec", "readings", "transport")}
+            owner = self.owner.get(device_id)
+            target = owner if owner is not None and owner.alive else self._least_loaded()
+            if target is None:
+                logger.warning(f"[FLEET] no live worker for {device_id}")
+                return
+            self._assign(device_id, target)
+        elif cmd in ("stop", "update", "loglevel", "logs"):
+            owner = self.owner.get(device_id)
+            if owner is None:
+                logger.warning(f"[FLEET] unknown device {device_id}")
+                return
+            owner.send(command)
+            if cmd == "stop":
+                owner.devices.pop(device_id, None)
+                self.owner.pop(device_id, None)
+                self.entries.pop(device_id, None)
+        elif cmd == "stats":
+            for worker in self.workers:
+                worker.send(command)
+        elif cmd == "fleet":
+            print(json.dumps(self.report()), flush=True)
+        else:
+            logger.warning(f"[FLEET] Unknown command: {command}")
+
+    async def serve_stdin(self):
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader()
+        try:
+            await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+        except (ValueError, OSError) as e:
+            logger.info(f"[FLEET] stdin control channel unavailable: {e}")
+            return
+        while True:
+            line = await reader.readline()
+            if not line:
+                return
+            try:
+                await self.handle_command(json.loads(line))
+            except Exception as e:
+                logger.error(f"[FLEET] ❌ Command failed: {e}")
+
+    async def start(self):
+        # Round robin keeps shards even and similar devices spread over cores
+        for n, device_id in enumerate(self.entries):
+            self._assign(device_id, self.workers[n % len(self.workers)], send=False)
+        await asyncio.gather(*(self.spawn(w) for w in self.workers))
+        self._spawn_task(self._health_loop())
+        self._spawn_task(self._report_loop())
+
+    async def stop(self):
+        self._closing = True
+        for task in list(self._tasks):
+            task.cancel()
+        for worker in self.workers:
+            if worker.process is not None and worker.process.returncode is None:
+                worker.process.terminate()
+        for worker in self.workers:
+            if worker.process is None:
+                continue
+            try:
+                await asyncio.wait_for(worker.process.wait(), 10)
+            except asyncio.TimeoutError:
+                worker.process.kill()
+            worker.state = "stopped"
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+async def run_fleet(hostfile, workers=None, transport="android-netsim", memory_mb=None,
+                    heartbeat=2.0, report_interval=10.0):
+    with open(hostfile, "r") as f:
+        entries = json.load(f).get("devices", [])
+    supervisor = FleetSupervisor(entries, workers, transport, memory_mb, heartbeat, report_interval)
+    loop = asyncio.get_running_loop()
+    main = asyncio.current_task()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, main.cancel)
+    await supervisor.start()
+    try:
+        await supervisor.serve_stdin()
+        await asyncio.Event().wait()
+    except asyncio.CancelledError:
+        pass
+    finally:
+        await supervisor.stop()
+        print(json.dumps(supervisor.report()), flush=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Supervise device_host.py workers across CPU cores")
+    parser.add_argument("hostfile")
+    parser.add_argument("--workers", type=int, help="worker processes (default: one per usable CPU)")
+    parser.add_argument("--transport", default="android-netsim")
+    parser.add_argument("--memory-mb", type=int, help="per-worker memory limit")
+    parser.add_argument("--heartbeat", type=float, default=2.0, help="seconds between health pings")
+    parser.add_argument("--report", type=float, default=10.0, help="seconds between load reports")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(run_fleet(args.hostfile, args.workers, args.transport, args.memory_mb,
+                          args.heartbeat, args.report))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,369 @@
+# gatt_benchmark.py
+#
+# GATT performance benchmark on bumble's in-process local link: no netsim,
+# no phone. Every virtual device (start_virtual_device on its own
+# Controller) gets scripted centrals (--centrals, all linked at once) that
+# connect, exchange MTU, discover, then time reads, writes and a
+# notification burst; then disconnect, reconnect once the device advertises
+# again, and subscribe to a second notifiable characteristic that the
+# notification scheduler streams at --stream-hz.
+#
+#   python gatt_benchmark.py [spec.json] [readings.csv] [--devices 1,10,100]
+#                            [--centrals 1] [--ops 200] [--notifications 500]
+#                            [--stream-hz 20] [--stream-seconds 1.0]
+#                            [--commissioning] [--out results.json]
+#
+# The spec and readings CSV are copied per run into a scratch directory, so
+# benchmark writes never touch the real files. Results are one JSON document
+# (also printed as a "GATT_BENCHMARK {...}" line) with a round per device
+# count: connect, MTU exchange, reconnect, read and write latency
+# percentiles, read and write throughput across all centrals, notification
+# burst and stream throughput, and the expected counts that were not met.
+# The exit status is 1 if any round has such failures.
+
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import tempfile
+
+# Before VirtualDevice configures logging: per-read INFO lines would dominate the timings
+os.environ.setdefault("VIRTUAL_DEVICE_LOG_LEVEL", "WARNING")
+# Benchmark devices must not restore from, or leave slots in, the real host state file
+BENCH_STATE_FILE = os.path.join(tempfile.gettempdir(), f"gatt_bench_{os.getpid()}.state")
+os.environ.setdefault("VIRTUAL_DEVICE_STATE_FILE", BENCH_STATE_FILE)
+
+from bumble.controller import Controller
+from bumble.device import Device, Peer
+from bumble.hci import Address
+from bumble.link import LocalLink
+from bumble.transport.common import AsyncPipeSink
+
+from connection_lifecycle import summarize
+from value_store import normalize_uuid
+from VirtualDevice import start_virtual_device, stop_virtual_device
+
+MTU = 247
+
+
+def pick_characteristics(config):
+    """First readable, writable and notifiable characteristic UUIDs in the spec.
+
+    "stream" is the next notifiable one, left to the notification scheduler so
+    its notifications are never mixed up with the burst.
+    """
+    picked = {}
+    for service in config.get("gatt", {}).get("services", []):
+        for char in service.get("characteristics", []):
+            props = [p.lower() for p in char.get("properties", [])]
+            for role, prop in (("read", "read"), ("write", "write"), ("notify", "notify")):
+                if prop in props:
+                    picked.setdefault(role, char["uuid"])
+            if "notify" in props and picked["notify"] != char["uuid"]:
+                picked.setdefault("stream", char["uuid"])
+    return picked
+
+
+def prepare_spec(spec_path, workdir, index, centrals=1, stream_hz=0, setup_complete="YES"):
+    """Copy of the spec for one benchmark device, with its own static address.
+
+    With setup_complete "NO" the device starts in commissioning mode, which
+    the first disconnect (the reconnect round) completes.
+    """
+    with open(spec_path, "r") as f:
+        config = json.load(f)
+    config["address"] = f"C0:00:00:00:{index >> 8:02X}:{index & 0xFF:02X}"
+    config["max_connections"] = max(centrals, config.get("max_connections", 1))
+    config["setup_complete"] = setup_complete
+    stream = pick_characteristics(config).get("stream")
+    for service in config.get("gatt", {}).get("services", []):
+        for char in service.get("characteristics", []):
+            char.pop("notify", None)
+            if stream_hz and char["uuid"] == stream:
+                char["notify"] = {"rate_hz": stream_hz, "source": "counter"}
+    path = os.path.join(workdir, f"bench{index:03d}_spec.json")
+    with open(path, "w") as f:
+        json.dump(config, f, indent=4)
+    return path, config
+
+
+class BenchmarkPair:
+    """One virtual device and the scripted central(s) driving it."""
+
+    def __init__(self, index, link, spec_path, readings_csv, centrals=1):
+        self.index = index
+        self.link = link
+        self.spec_path = spec_path
+        self.readings_csv = readings_csv
+        self.central_count = centrals
+        self.device = None
+        self.centrals = []
+        self.peers = []
+        self.samples = {"startup": [], "connect": [], "mtu_exchange": [], "reconnect": [],
+                        "read": [], "write": []}
+        self.notifications_sent = 0
+        self.notifications_received = 0
+        self.notify_seconds = 0.0
+        self.stream_received = 0
+
+    async def start(self, config):
+        controller = Controller(f"P{self.index}", link=self.link)
+        started = time.perf_counter()
+        self.device = await start_virtual_device(self.spec_path, self.readings_csv, controller,
+                                                 AsyncPipeSink(controller), f"bench{self.index:03d}")
+        self.samples["startup"].append(time.perf_counter() - started)
+        self.address = Address(config["address"])
+
+        for n in range(self.central_count):
+            central_controller = Controller(f"C{self.index}.{n}", link=self.link)
+            central = Device.with_hci(f"central{self.index}.{n}",
+                                      Address(f"D0:00:00:{n:02X}:{self.index >> 8:02X}:{self.index & 0xFF:02X}"),
+                                      central_controller, AsyncPipeSink(central_controller))
+            await central.power_on()
+            self.centrals.append(central)
+
+    async def connect(self, sample="connect"):
+        # One after the other: the device re-advertises after each link while below max_connections
+        for central in self.centrals:
+            started = time.perf_counter()
+            connection = await central.connect(self.address)
+            self.samples[sample].append(time.perf_counter() - started)
+            peer = Peer(connection)
+
+            started = time.perf_counter()
+            await peer.request_mtu(MTU)
+            self.samples["mtu_exchange"].append(time.perf_counter() - started)
+
+            await peer.discover_services()
+            await peer.discover_characteristics()
+            self.peers.append(peer)
+
+    def remote(self, peer, uuid):
+        found = peer.get_characteristics_by_uuid(self.device.characteristics_by_uuid[
+            normalize_uuid(uuid)].uuid)
+        return found[0] if found else None
+
+    async def _reads(self, peer, uuid, ops):
+        char = self.remote(peer, uuid)
+        if char is None:
+            return
+        for _ in range(ops):
+            started = time.perf_counter()
+            await peer.read_value(char)
+            self.samples["read"].append(time.perf_counter() - started)
+
+    async def _writes(self, peer, uuid, ops, value):
+        char = self.remote(peer, uuid)
+        if char is None:
+            return
+        for _ in range(ops):
+            started = time.perf_counter()
+            await peer.write_value(char, value, with_response=True)
+            self.samples["write"].append(time.perf_counter() - started)
+
+    async def run_reads(self, uuid, ops):
+        await asyncio.gather(*(self._reads(peer, uuid, ops) for peer in self.peers))
+
+    async def run_writes(self, uuid, ops):
+        # Write back the device's own value so the codec always accepts it
+        value = bytes(self.device.characteristics_by_uuid[normalize_uuid(uuid)].value)
+        await asyncio.gather(*(self._writes(peer, uuid, ops, value) for peer in self.peers))
+
+    async def run_notifications(self, uuid, count, timeout=10.0):
+        if count <= 0 or not self.peers:
+            return
+        expected = count * len(self.peers)
+        done = asyncio.Event()
+
+        def on_value(value):
+            self.notifications_received += 1
+            if self.notifications_received >= expected:
+                done.set()
+
+        for peer in self.peers:
+            char = self.remote(peer, uuid)
+            if char is None:
+                return
+            await peer.subscribe(char, on_value)
+        server_char = self.device.characteristics_by_uuid[normalize_uuid(uuid)]
+        value = bytes(server_char.value)
+        started = time.perf_counter()
+        for _ in range(count):
+            await self.device.notify_subscribers(server_char, value)
+            self.notifications_sent += len(self.peers)
+        try:
+            await asyncio.wait_for(done.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self.notify_seconds = time.perf_counter() - started
+
+    async def reconnect(self, timeout=10.0):
+        """Drop every link, then connect again once the device is back on the air."""
+        for peer in self.peers:
+            await peer.connection.disconnect()
+        self.peers = []
+        await asyncio.wait_for(self.connect("reconnect"), timeout)
+
+    async def run_stream(self, uuid, seconds):
+        """Subscribe every central to the scheduler's stream and count what arrives."""
+        def on_value(value):
+            self.stream_received += 1
+
+        for peer in self.peers:
+            char = self.remote(peer, uuid)
+            if char is None:
+                return
+            await peer.subscribe(char, on_value)
+        await asyncio.sleep(seconds)
+        for peer in self.peers:
+            await peer.unsubscribe(self.remote(peer, uuid), on_value)
+
+    async def stop(self):
+        for peer in self.peers:
+            try:
+                await peer.connection.disconnect()
+            except Exception:
+                pass
+        if self.device is not None:
+            await stop_virtual_device(self.device, self.spec_path)
+
+
+def check_round(result, ops, notifications, stream_hz, stream_seconds, tolerance=0.75):
+    """Expected counts this round did not reach, as readable strings."""
+    links = result["devices"] * result["centrals_per_device"]
+    chars = result["characteristics"]
+    expected = {"connect": links, "mtu_exchange": links, "reconnect": links}
+    if "read" in chars:
+        expected["read"] = ops * links
+    if "write" in chars:
+        expected["write"] = ops * links
+    failures = [f"{name}: {result[name]['count']} of {count}"
+                for name, count in expected.items() if result[name]["count"] < count]
+    if "notify" in chars and notifications > 0:
+        burst = notifications * links
+        if result["notify"]["received"] < burst:
+            failures.append(f"notify: {result['notify']['received']} of {burst}")
+    if stream_hz and "stream" in chars:
+        floor = int(stream_hz * stream_seconds * tolerance) * links
+        if result["stream"]["received"] < floor:
+            failures.append(f"stream: {result['stream']['received']} of at least {floor}")
+    if result["commissioning_left"]:
+        failures.append(f"commissioning: {result['commissioning_left']} devices still commissioning")
+    return failures
+
+
+async def run_round(spec_path, readings_csv, count, ops, notifications, centrals=1,
+                    stream_hz=20, stream_seconds=1.0, setup_complete="YES"):
+    """Benchmark `count` devices side by side on one local link."""
+    workdir = tempfile.mkdtemp(prefix="gatt_bench_")
+    try:
+        csv_copy = os.path.join(workdir, os.path.basename(readings_csv))
+        shutil.copyfile(readings_csv, csv_copy)
+        link = LocalLink()
+        pairs, configs = [], []
+        for index in range(count):
+            path, config = prepare_spec(spec_path, workdir, index, centrals, stream_hz, setup_complete)
+            pairs.append(BenchmarkPair(index, link, path, csv_copy, centrals))
+            configs.append(config)
+        chars = pick_characteristics(configs[0])
+
+        phases = {}
+        started = time.perf_counter()
+        try:
+            await asyncio.gather(*(pair.start(config) for pair, config in zip(pairs, configs)))
+            await asyncio.gather(*(pair.connect() for pair in pairs))
+            if "read" in chars:
+                phase = time.perf_counter()
+                await asyncio.gather(*(pair.run_reads(chars["read"], ops) for pair in pairs))
+                phases["read"] = time.perf_counter() - phase
+            if "write" in chars:
+                phase = time.perf_counter()
+                await asyncio.gather(*(pair.run_writes(chars["write"], ops) for pair in pairs))
+                phases["write"] = time.perf_counter() - phase
+            if "notify" in chars:
+                await asyncio.gather(*(pair.run_notifications(chars["notify"], notifications)
+                                       for pair in pairs))
+            await asyncio.gather(*(pair.reconnect() for pair in pairs), return_exceptions=True)
+            if stream_hz and "stream" in chars:
+                phase = time.perf_counter()
+                await asyncio.gather(*(pair.run_stream(chars["stream"], stream_seconds) for pair in pairs))
+                phases["stream"] = time.perf_counter() - phase
+            commissioning_left = sum(1 for pair in pairs if pair.device.commissioning)
+        finally:
+            await asyncio.gather(*(pair.stop() for pair in pairs), return_exceptions=True)
+        elapsed = time.perf_counter() - started
+
+        result = {"devices": count, "centrals_per_device": centrals, "elapsed_s": round(elapsed, 3),
+                  "characteristics": chars}
+        for name in ("startup", "connect", "mtu_exchange", "reconnect", "read", "write"):
+            samples = [s for pair in pairs for s in pair.samples[name]]
+            result[name] = summarize(samples)
+            if name in phases and phases[name]:
+                result[name]["per_sec"] = len(samples) / phases[name]
+        sent = sum(pair.notifications_sent for pair in pairs)
+        received = sum(pair.notifications_received for pair in pairs)
+        window = max((pair.notify_seconds for pair in pairs), default=0.0)
+        result["notify"] = {"sent": sent, "received": received,
+                            "per_sec": received / window if window else None}
+        streamed = sum(pair.stream_received for pair in pairs)
+        result["stream"] = {"rate_hz": stream_hz, "received": streamed,
+                            "per_sec": streamed / phases["stream"] if phases.get("stream") else None}
+        result["commissioning_left"] = commissioning_left
+        result["failures"] = check_round(result, ops, notifications, stream_hz, stream_seconds)
+        return result
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+async def run_benchmark(spec_path, readings_csv, device_counts, ops, notifications, centrals=1,
+                        stream_hz=20, stream_seconds=1.0, setup_complete="YES"):
+    rounds = []
+    for count in device_counts:
+        rounds.append(await run_round(spec_path, readings_csv, count, ops, notifications, centrals,
+                                      stream_hz, stream_seconds, setup_complete))
+    return {"spec": os.path.basename(spec_path), "ops": ops, "notifications": notifications,
+            "centrals": centrals, "stream_hz": stream_hz, "setup_complete": setup_complete,
+            "mtu": MTU, "rounds": rounds}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="GATT benchmark on an in-process bumble link")
+    parser.add_argument("spec", nargs="?", default="Qubo_bulb12W_spec.json")
+    parser.add_argument("readings", nargs="?", default="Readings2.csv")
+    parser.add_argument("--devices", default="1,10,100", help="comma separated device counts")
+    parser.add_argument("--centrals", type=int, default=1, help="concurrent centrals per device")
+    parser.add_argument("--ops", type=int, default=200, help="reads and writes per central")
+    parser.add_argument("--notifications", type=int, default=500, help="notifications per device")
+    parser.add_argument("--stream-hz", type=float, default=20, help="scheduler stream rate (0: no stream)")
+    parser.add_argument("--stream-seconds", type=float, default=1.0, help="how long to count the stream")
+    parser.add_argument("--commissioning", action="store_true",
+                        help="start devices in commissioning mode (setup_complete NO)")
+    parser.add_argument("--out", help="also write the JSON results to this file")
+    args = parser.parse_args(argv)
+
+    counts = [int(c) for c in args.devices.split(",") if c.strip()]
+    try:
+        results = asyncio.run(run_benchmark(args.spec, args.readings, counts, args.ops, args.notifications,
+                                            args.centrals, args.stream_hz, args.stream_seconds,
+                                            "NO" if args.commissioning else "YES"))
+    finally:
+        if os.path.exists(BENCH_STATE_FILE):
+            os.unlink(BENCH_STATE_FILE)
+    line = json.dumps(results, separators=(",", ":"))
+    print(f"GATT_BENCHMARK {line}", flush=True)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+    failures = [f"{r['devices']} devices: {failure}" for r in results["rounds"] for failure in r["failures"]]
+    for failure in failures:
+        print(f"GATT_BENCHMARK FAILED {failure}", file=sys.stderr, flush=True)
+    if failures:
+        sys.exit(1)
+    return results
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,154 @@
+# gatt_sessions.py
+#
+# Per-connection GATT state for devices that serve several centrals at once
+# (say a phone app and a hub). Characteristic values stay shared in the
+# value store; what differs per link lives in a GattSession hung on the
+# bumble connection as `connection.gatt_session`:
+#
+#   mtu                  negotiated ATT MTU of this link
+#   subscriptions        {uuid: (notify, indicate)} from this central's CCCD writes
+#   indication_pending   ATT allows one outstanding indication per link
+#   reads / writes       operation and byte counts, for throughput
+#   blob_snapshots, reading_blob
+#                        long read state (long_values.py)
+#
+# The device keeps advertising connectably until "max_connections" (spec,
+# default 1) links are up; see ConnectionLifecycle.should_advertise.
+
+import time
+import logging
+
+from value_store import normalize_uuid
+
+logger = logging.getLogger(__name__)
+
+
+class GattSession:
+    __slots__ = ("handle", "peer", "mtu", "subscriptions", "indication_pending", "reads", "writes",
+                 "read_bytes", "write_bytes", "opened_at", "blob_snapshots", "reading_blob")
+
+    def __init__(self, connection):
+        self.handle = connection.handle
+        self.peer = str(connection.peer_address)
+        self.mtu = getattr(connection, "att_mtu", 23)
+        self.subscriptions = {}
+        self.indication_pending = False
+        self.reads = 0
+        self.writes = 0
+        self.read_bytes = 0
+        self.write_bytes = 0
+        self.opened_at = time.perf_counter()
+        self.blob_snapshots = {}      # attribute handle -> bytes served to Read Blob
+        self.reading_blob = False
+
+    def record_read(self, size):
+        self.reads += 1
+        self.read_bytes += size
+
+    def record_write(self, size):
+        self.writes += 1
+        self.write_bytes += size
+
+    def stats(self):
+        elapsed = time.perf_counter() - self.opened_at
+        return {
+            "peer": self.peer,
+            "mtu": self.mtu,
+            "subscriptions": len(self.subscriptions),
+            "reads": self.reads,
+            "writes": self.writes,
+            "reads_per_second": self.reads / elapsed if elapsed else 0.0,
+            "writes_per_second": self.writes / elapsed if elapsed else 0.0,
+            "read_bytes": self.read_bytes,
+            "write_bytes": self.write_bytes,
+        }
+
+
+def get_session(connection):
+    """The connection's session, created on first use (None for internal calls without a link)."""
+    if connection is None:
+        return None
+    # ATT handlers get a bearer: the connection itself, or an EATT channel on it
+    connection = getattr(connection, "connection", connection)
+    session = getattr(connection, "gatt_session", None)
+    if session is None:
+        session = connection.gatt_session = GattSession(connection)
+    return session
+
+
+class SessionManager:
+    """Opens and closes a GattSession per connection of one device."""
+
+    def __init__(self, device, max_connections=1):
+        self.device = device
+        self.max_connections = max(1, int(max_connections))
+        self.sessions = {}            # connection handle -> GattSession
+        self._link_listeners = {}     # connection handle -> (connection, {event: listener})
+        self.peak_connections = 0
+        self.closed_sessions = 0
+        device.on("connection", self._on_connection)
+        device.on("disconnection", self._on_disconnection)
+        device.gatt_server.on("characteristic_subscription", self._on_subscription)
+
+    @classmethod
+    def from_config(cls, device, config):
+        return cls(device, config.get("max_connections", 1))
+
+    def _on_connection(self, connection):
+        session = get_session(connection)
+        self.sessions[connection.handle] = session
+        self.peak_connections = max(self.peak_connections, len(self.sessions))
+
+        def on_mtu_update():
+            session.mtu = connection.att_mtu
+
+        def on_link_disconnection(reason):
+            self._on_disconnection(connection, reason)
+        # Newer bumble only reports the disconnection on the connection itself
+        listeners = {"connection_att_mtu_update": on_mtu_update, "disconnection": on_link_disconnection}
+        for event, listener in listeners.items():
+            connection.on(event, listener)
+        self._link_listeners[connection.handle] = (connection, listeners)
+        logger.info(f"GATT session {connection.handle} opened for {session.peer} "
+                    f"({len(self.sessions)}/{self.max_connections})")
+
+    def _remove_link_listeners(self, handle):
+        connection, listeners = self._link_listeners.pop(handle, (None, {}))
+        for event, listener in listeners.items():
+            connection.remove_listener(event, listener)
+
+    def _on_disconnection(self, connection, reason):
+        self._remove_link_listeners(connection.handle)
+        if self.sessions.pop(connection.handle, None) is not None:
+            self.closed_sessions += 1
+
+    def _on_subscription(self, connection, characteristic, notify_enabled, indicate_enabled):
+        session = get_session(connection)
+        uuid = normalize_uuid(getattr(characteristic, "uuid_str", characteristic.uuid))
+        if notify_enabled or indicate_enabled:
+            session.subscriptions[uuid] = (notify_enabled, indicate_enabled)
+        else:
+            session.subscriptions.pop(uuid, None)
+
+    def accepting(self):
+        """True while another central may connect."""
+        return len(self.device.connections) < self.max_connections
+
+    def stats(self):
+        sessions = {handle: s.stats() for handle, s in self.sessions.items()}
+        return {
+            "connections": len(sessions),
+            "max_connections": self.max_connections,
+            "peak_connections": self.peak_connections,
+            "closed_sessions": self.closed_sessions,
+            "reads_per_second": sum(s["reads_per_second"] for s in sessions.values()),
+            "writes_per_second": sum(s["writes_per_second"] for s in sessions.values()),
+            "sessions": sessions,
+        }
+
+    def close(self):
+        self.device.remove_listener("connection", self._on_connection)
+        self.device.remove_listener("disconnection", self._on_disconnection)
+        self.device.gatt_server.remove_listener("characteristic_subscription", self._on_subscription)
+        for handle in list(self._link_listeners):
+            self._remove_link_listeners(handle)
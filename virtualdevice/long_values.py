@@ -0,0 +1,98 @@
+# long_values.py
+#
+# Large characteristic values (credentials, config blobs such as ee01) on
+# top of bumble's ATT server, per connection (see gatt_sessions.py):
+#
+#   Read / Read Blob     a read at offset 0 of a value longer than one PDU
+#                        snapshots the encoded bytes in the session; the Read
+#                        Blob requests that follow are served from that
+#                        snapshot instead of going back through read_value
+#   Prepare / Execute    left to bumble's own per-bearer queue, which applies
+#   Write                the reassembled value as ONE write_value on execute,
+#                        so nothing intermediate is journaled
+#   MTU                  with "preferred_mtu" in the spec the device starts
+#                        the MTU exchange itself as soon as a central connects
+#
+# install_long_values(device, config) wraps the device's GATT server once.
+
+import asyncio
+import logging
+
+from bumble.device import Peer
+
+from gatt_sessions import get_session
+
+logger = logging.getLogger(__name__)
+
+def snapshot_for(connection, attribute):
+    """Snapshot a Read Blob may use for this attribute on this connection, else None."""
+    session = get_session(connection)
+    if session is None or not session.reading_blob:
+        return None
+    return session.blob_snapshots.get(attribute.handle)
+
+
+def remember_snapshot(connection, attribute, value):
+    """Keep an offset-0 read of a long value for the Read Blob requests that follow."""
+    session = get_session(connection)
+    if session is None:
+        return
+    if len(value) > session.mtu - 1:
+        session.blob_snapshots[attribute.handle] = value
+    else:
+        session.blob_snapshots.pop(attribute.handle, None)
+
+
+class LongValueServer:
+    """Blob-read snapshots for one device's GATT server."""
+
+    def __init__(self, device, preferred_mtu=None):
+        self.device = device
+        self.server = device.gatt_server
+        self.preferred_mtu = preferred_mtu
+        self.snapshot_reads = 0
+        self._original_read = self.server.on_att_read_request
+        self._original_read_blob = self.server.on_att_read_blob_request
+        # Instance attributes shadow the server's methods; its dispatcher looks them up by name
+        self.server.on_att_read_request = self.on_read
+        self.server.on_att_read_blob_request = self.on_read_blob
+        if preferred_mtu:
+            device.on("connection", self._on_connection)
+
+    # Reads ---------------------------------------------------------------
+
+    def on_read(self, bearer, request):
+        get_session(bearer).reading_blob = False
+        return self._original_read(bearer, request)
+
+    def on_read_blob(self, bearer, request):
+        session = get_session(bearer)
+        session.reading_blob = True
+        if request.attribute_handle in session.blob_snapshots:
+            self.snapshot_reads += 1
+        return self._original_read_blob(bearer, request)
+
+    # MTU -------------------------------------------------------------------
+
+    def _on_connection(self, connection):
+        async def exchange():
+            try:
+                mtu = await Peer(connection).request_mtu(self.preferred_mtu)
+                get_session(connection).mtu = mtu
+                logger.info(f"📏 MTU {mtu} negotiated with {connection.peer_address}")
+            except Exception as e:
+                logger.warning(f"⚠️ MTU exchange with {connection.peer_address} failed: {e}")
+        asyncio.ensure_future(exchange())
+
+    def stats(self):
+        return {"snapshot_reads": self.snapshot_reads}
+
+    def close(self):
+        for name in ("on_att_read_request", "on_att_read_blob_request"):
+            self.server.__dict__.pop(name, None)
+        if self.preferred_mtu:
+            self.device.remove_listener("connection", self._on_connection)
+
+
+def install_long_values(device, config):
+    return LongValueServer(device, config.get("preferred_mtu"))
@@ -0,0 +1,280 @@
+# metrics.py
+#
+# Counters and fixed-bucket latency histograms with a Prometheus text
+# export. Recording is a bisect plus two additions under a per-metric lock;
+# formatting only happens when something scrapes.
+#
+#   metrics = get_metrics("dev123")            # labels every series with device="dev123"
+#   with metrics.time("gatt_read_seconds"):
+#       ...
+#   metrics.inc("connections_total")
+#
+#   GET http://127.0.0.1:<port>/metrics          every device in this process
+#   GET http://127.0.0.1:<port>/metrics/dev123   one device
+#
+# Values that already live elsewhere (lifecycle restarts, scheduler counts)
+# are exported through collectors, which are only called at scrape time.
+
+import time
+import logging
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+PREFIX = "vdev_"
+METRICS_PORT_ENV = "VIRTUAL_DEVICE_METRICS_PORT"
+# 50 us .. 10 s, roughly x2.5 per step
+DEFAULT_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+HELP = {
+    "gatt_read_seconds": "GATT read handling time",
+    "gatt_write_seconds": "GATT write handling time",
+    "json_io_seconds": "Value store (device spec JSON) access time",
+    "csv_io_seconds": "Readings CSV access time",
+    "connections_total": "BLE connections accepted",
+    "disconnections_total": "BLE disconnections",
+    "notifications_total": "Notifications and indications sent",
+    "advertising_restarts_total": "Advertising restarts after a disconnect",
+    "advertising_updates_total": "Advertising payload updates pushed in place",
+    "agent_messages_total": "MQTT messages handled by the agent",
+    "agent_ingest_seconds": "Agent /data decode and enqueue time",
+    "agent_apply_seconds": "Agent time to apply an update to a device",
+    "agent_device_start_seconds": "Agent time from /spec to a started device",
+}
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+
+class Counter:
+    __slots__ = ("value", "_lock")
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class Histogram:
+    __slots__ = ("bounds", "counts", "sum", "count", "_lock")
+
+    def __init__(self, bounds=DEFAULT_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        i = bisect_left(self.bounds, seconds)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += seconds
+            self.count += 1
+
+    def snapshot(self):
+        with self._lock:
+            return list(self.counts), self.sum, self.count
+
+    def quantile(self, q):
+        """Upper bucket bound holding the q-th observation (None if empty)."""
+        counts, _, count = self.snapshot()
+        if not count:
+            return None
+        rank = q * count
+        seen = 0
+        for bound, n in zip(self.bounds + (float("inf"),), counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+class _Timer:
+    __slots__ = ("histogram", "started")
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started)
+        return False
+
+
+class MetricsRegistry:
+    """All series of this process, keyed by (name, sorted label pairs)."""
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.collectors = []
+        self._lock = threading.Lock()
+
+    def counter(self, name, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        counter = self.counters.get(key)
+        if counter is None:
+            with self._lock:
+                counter = self.counters.setdefault(key, Counter())
+        return counter
+
+    def histogram(self, name, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.setdefault(key, Histogram())
+        return histogram
+
+    def add_collector(self, collector):
+        """collector() -> iterable of (name, labels dict, value), read as counters at scrape time."""
+        self.collectors.append(collector)
+
+    def remove_collector(self, collector):
+        if collector in self.collectors:
+            self.collectors.remove(collector)
+
+    def render(self, device=None):
+        """Prometheus text exposition format, optionally for one device only."""
+        def wanted(labels):
+            return device is None or dict(labels).get("device") == device
+
+        families = {}
+        for (name, labels), counter in list(self.counters.items()):
+            if wanted(labels):
+                families.setdefault((name, "counter"), []).append((labels, counter.value))
+        for collector in list(self.collectors):
+            try:
+                for name, labels, value in collector():
+                    labels = tuple(sorted(labels.items()))
+                    if wanted(labels):
+                        families.setdefault((name, "counter"), []).append((labels, value))
+            except Exception as e:
+                logger.warning(f"Metrics collector failed: {e}")
+        for (name, labels), histogram in list(self.histograms.items()):
+            if wanted(labels):
+                families.setdefault((name, "histogram"), []).append((labels, histogram))
+
+        lines = []
+        for (name, kind), series in sorted(families.items()):
+            full = PREFIX + name
+            lines.append(f"# HELP {full} {HELP.get(name, name)}")
+            lines.append(f"# TYPE {full} {kind}")
+            for labels, value in series:
+                if kind == "counter":
+                    lines.append(f"{full}{_format_labels(labels)} {value}")
+                    continue
+                counts, total, count = value.snapshot()
+                cumulative = 0
+                for bound, n in zip(value.bounds + ("+Inf",), counts):
+                    cumulative += n
+                    lines.append(f"{full}_bucket{_format_labels(labels + (('le', bound),))} {cumulative}")
+                lines.append(f"{full}_sum{_format_labels(labels)} {total}")
+                lines.append(f"{full}_count{_format_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def devices(self):
+        """Every device label with at least one recorded series."""
+        keys = list(self.counters) + list(self.histograms)
+        return sorted({dict(labels)["device"] for _, labels in keys if "device" in dict(labels)})
+
+    def summary(self, device=None):
+        """Compact JSON-friendly view: counters and p50/p95/p99 bucket bounds per histogram."""
+        out = {}
+        for (name, labels), counter in list(self.counters.items()):
+            if device is None or dict(labels).get("device") == device:
+                out[name + _format_labels(labels)] = counter.value
+        for (name, labels), histogram in list(self.histograms.items()):
+            if device is None or dict(labels).get("device") == device:
+                out[name + _format_labels(labels)] = {
+                    "count": histogram.count, "sum": histogram.sum,
+                    "p50": histogram.quantile(0.5), "p95": histogram.quantile(0.95),
+                    "p99": histogram.quantile(0.99)}
+        return out
+
+
+class DeviceMetrics:
+    """Registry view that labels everything with one device_id."""
+
+    def __init__(self, registry, device_id):
+        self.registry = registry
+        self.device_id = device_id
+
+    def histogram(self, name, **labels):
+        return self.registry.histogram(name, device=self.device_id, **labels)
+
+    def time(self, name, **labels):
+        return _Timer(self.histogram(name, **labels))
+
+    def inc(self, name, amount=1, **labels):
+        self.registry.counter(name, device=self.device_id, **labels).inc(amount)
+
+
+_registry = MetricsRegistry()
+
+
+def get_registry():
+    return _registry
+
+
+def get_metrics(device_id):
+    return DeviceMetrics(_registry, device_id)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = self.path.rstrip("/")
+        if path == "/metrics":
+            device = None
+        elif path.startswith("/metrics/"):
+            device = path[len("/metrics/"):]
+        else:
+            self.send_error(404)
+            return
+        body = _registry.render(device).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_server = None
+
+
+def start_metrics_server(port, host="127.0.0.1"):
+    """Serve /metrics on a daemon thread; returns the bound port (port 0 picks one), or None."""
+    global _server
+    if _server is not None:
+        return _server.server_address[1]
+    try:
+        _server = ThreadingHTTPServer((host, int(port)), _MetricsHandler)
+    except OSError as e:
+        logger.warning(f"⚠️ Metrics server not started on {host}:{port}: {e}")
+        return None
+    _server.daemon_threads = True
+    threading.Thread(target=_server.serve_forever, daemon=True, name="metrics-http").start()
+    bound = _server.server_address[1]
+    logger.info(f"📈 Metrics on http://{host}:{bound}/metrics")
+    return bound
+
+
+def metrics_port():
+    """Port of this process's metrics server, or None if it is not running."""
+    return _server.server_address[1] if _server is not None else None
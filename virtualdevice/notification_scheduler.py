@@ -0,0 +1,289 @@
+# notification_scheduler.py
+
+import time
+import asyncio
+import logging
+from collections import deque
+
+from value_store import normalize_uuid
+from gatt_sessions import get_session
+
+logger = logging.getLogger(__name__)
+
+# CCCD bits as stored by bumble's GATT server per subscriber
+CCCD_NOTIFY = 0x0001
+CCCD_INDICATE = 0x0002
+
+
+def source_store(stream):
+    """Current value from the device's value store."""
+    return stream.device.value_store.get_bytes(stream.uuid, stream.characteristic.value)
+
+
+def source_counter(stream):
+    """Incrementing counter, width taken from the current value (at least one byte)."""
+    width = max(1, len(stream.characteristic.value or b""))
+    stream.counter = (stream.counter + 1) % (1 << (8 * width))
+    return stream.counter.to_bytes(width, "little")
+
+
+def source_csv(stream):
+    """Latest row of the readings CSV for this characteristic."""
+    return bytes([stream.characteristic.read_csv_data() & 0xFF])
+
+
+# name -> callable(stream) -> bytes; other modules register their own sources here
+VALUE_SOURCES = {
+    "store": source_store,
+    "counter": source_counter,
+    "csv": source_csv,
+}
+
+
+class NotificationStream:
+    """One notify/indicate characteristic on one device, fired every `period` seconds."""
+
+    def __init__(self, device, characteristic, rate_hz, source):
+        self.device = device
+        self.characteristic = characteristic
+        self.uuid = normalize_uuid(characteristic.uuid_str)
+        self.period = 1.0 / rate_hz
+        self.source = source
+        self.counter = 0
+        self.due = 0.0
+        self.active = True
+
+
+class ConnectionBudget:
+    """Token bucket sized to what fits into the connection events of one link."""
+
+    def __init__(self, per_event):
+        self.per_event = per_event
+        self.tokens = float(per_event)
+        self.updated = time.perf_counter()
+
+    def take(self, connection, now):
+        interval = getattr(getattr(connection, "parameters", None), "connection_interval", None) or 30.0
+        # connection_interval is in ms; refill per_event tokens every interval
+        self.tokens = min(self.per_event,
+                          self.tokens + (now - self.updated) * 1000.0 / interval * self.per_event)
+        self.updated = now
+        if self.tokens >= 1.0:
+            self.tokens -= 1.0
+            return True
+        return False
+
+
+class NotificationScheduler:
+    """Single timer wheel driving every notification stream in the process.
+
+    Each tick collects the streams that are due, groups the resulting PDUs per
+    connection and sends them back to back so they ride the same connection
+    event. A per-connection token bucket keeps us within what the link can
+    carry; values are trimmed to the negotiated ATT MTU.
+
+    Ticks are numbered from a fixed origin and a stream is filed under the
+    tick nearest its due time, so periods do not drift by a tick per firing.
+    A stream faster than the tick rate (or one that fell behind) fires once
+    per period it owes in that tick.
+    """
+
+    def __init__(self, tick=0.01, slots=512, per_event=4):
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]
+        self.per_event = per_event
+        self.streams = {}             # device -> [NotificationStream]
+        self.budgets = {}             # connection -> ConnectionBudget (handles repeat across devices)
+        self.sent = 0
+        self.dropped = 0
+        self.sent_by_device = {}
+        self.recent = deque(maxlen=4096)   # (timestamp, count) per tick
+        self.started = None
+        self._origin = time.perf_counter()
+        self._cursor = 0              # number of the tick being / last processed
+        self._task = None
+
+    # Registration -------------------------------------------------------
+
+    def add_device(self, device, characteristics, config):
+        """Create streams for characteristics whose spec has a "notify" section with a rate."""
+        specs = {normalize_uuid(c.get("uuid", "")): c.get("notify", {})
+                 for s in config.get("gatt", {}).get("services", [])
+                 for c in s.get("characteristics", [])}
+        streams = []
+        for char in characteristics:
+            spec = specs.get(normalize_uuid(char.uuid_str)) or {}
+            rate = float(spec.get("rate_hz", 0) or 0)
+            if rate <= 0:
+                continue
+            source = VALUE_SOURCES.get(spec.get("source", "store"))
+            if source is None:
+                logger.warning(f"Unknown notify source {spec.get('source')!r} for {char.uuid_str}")
+                continue
+            stream = NotificationStream(device, char, rate, source)
+            streams.append(stream)
+            self._schedule(stream, time.perf_counter() + stream.period)
+        if streams:
+            self.streams.setdefault(device, []).extend(streams)
+            self.sent_by_device.setdefault(device, 0)
+            logger.info(f"📡 {len(streams)} notification streams scheduled")
+            self.start()
+        return streams
+
+    def remove_device(self, device):
+        for stream in self.streams.pop(device, []):
+            stream.active = False
+        self.sent_by_device.pop(device, None)
+
+    def _tick_of(self, t):
+        return round((t - self._origin) / self.tick)
+
+    def _schedule(self, stream, due):
+        stream.due = due
+        if self._task is None or self._task.done():
+            self._cursor = self._tick_of(time.perf_counter())
+        # Never the tick being processed; streams slower than one wheel turn
+        # sit in the farthest slot and get re-checked
+        target = min(max(self._tick_of(due), self._cursor + 1), self._cursor + len(self.slots) - 1)
+        self.slots[target % len(self.slots)].append(stream)
+
+    # Sending ------------------------------------------------------------
+
+    def _subscribers(self, device, characteristic):
+        server = device.gatt_server
+        # Keyed by bearer (the connection, or an EATT channel on it); older bumble used the handle
+        for bearer, subscriptions in list(getattr(server, "subscribers", {}).items()):
+            cccd = subscriptions.get(characteristic.handle)
+            if not cccd:
+                continue
+            bits = int.from_bytes(bytes(cccd)[:2], "little")
+            if isinstance(bearer, int):
+                bearer = device.lookup_connection(bearer)
+            if bearer is not None and bits & (CCCD_NOTIFY | CCCD_INDICATE):
+                yield bearer, bits
+
+    def _budget(self, connection):
+        budget = self.budgets.get(connection)
+        if budget is None:
+            budget = self.budgets[connection] = ConnectionBudget(self.per_event)
+            # Released with the link; bumble reports that on the connection only
+            connection.once("disconnection", lambda reason: self.on_disconnection(connection))
+        return budget
+
+    def _send(self, bearer, stream, value, bits, now):
+        connection = getattr(bearer, "connection", bearer)
+        budget = self._budget(connection)
+        if not budget.take(connection, now):
+            self.dropped += 1
+            return False
+        # Each central negotiated its own MTU
+        mtu = get_session(connection).mtu
+        value = value[:mtu - 3]
+        server = stream.device.gatt_server
+        if bits & CCCD_NOTIFY:
+            asyncio.ensure_future(server.notify_subscriber(bearer, stream.characteristic, value))
+        else:
+            # One outstanding indication per connection, as ATT requires
+            session = get_session(connection)
+            if session.indication_pending:
+                self.dropped += 1
+                return False
+            session.indication_pending = True
+            task = asyncio.ensure_future(server.indicate_subscriber(bearer, stream.characteristic, value))
+
+            def on_confirmed(_task, session=session):
+                session.indication_pending = False
+            task.add_done_callback(on_confirmed)
+        self.sent += 1
+        self.sent_by_device[stream.device] = self.sent_by_device.get(stream.device, 0) + 1
+        return True
+
+    def _fire(self, due, now):
+        # Group by connection first so each link's PDUs go out together
+        batches = {}
+        for stream in due:
+            try:
+                value = stream.source(stream)
+            except Exception as e:
+                logger.error(f"Notification source failed for {stream.uuid}: {e}")
+                continue
+            stream.characteristic.value = value
+            for connection, bits in self._subscribers(stream.device, stream.characteristic):
+                batches.setdefault(connection, []).append((stream, value, bits))
+        sent = 0
+        for connection, items in batches.items():
+            for stream, value, bits in items:
+                sent += self._send(connection, stream, value, bits, now)
+        if sent:
+            self.recent.append((now, sent))
+
+    async def _run(self):
+        self.started = time.perf_counter()
+        tick_no = self._tick_of(self.started)
+        while True:
+            tick_no += 1
+            delay = self._origin + tick_no * self.tick - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            now = time.perf_counter()
+            self._cursor = tick_no
+            slot = tick_no % len(self.slots)
+            bucket = self.slots[slot]
+            self.slots[slot] = []
+            due = []
+            for stream in bucket:
+                if not stream.active:
+                    continue
+                # Every period that fell due fires, so the rate holds above the tick rate
+                while stream.due <= now + self.tick / 2:
+                    due.append(stream)
+                    stream.due += stream.period
+                self._schedule(stream, stream.due)
+            if due:
+                self._fire(due, now)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        return self._task
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def on_disconnection(self, connection):
+        self.budgets.pop(connection, None)
+
+    # Reporting ----------------------------------------------------------
+
+    def rate(self, window=5.0):
+        """Notifications per second over the last `window` seconds."""
+        now = time.perf_counter()
+        return sum(n for t, n in self.recent if now - t <= window) / window
+
+    def stats(self, device=None):
+        elapsed = time.perf_counter() - self.started if self.started else 0.0
+        if device is not None:
+            sent = self.sent_by_device.get(device, 0)
+            return {"streams": len(self.streams.get(device, [])), "sent": sent,
+                    "per_second": sent / elapsed if elapsed else 0.0}
+        return {
+            "devices": len(self.streams),
+            "streams": sum(len(s) for s in self.streams.values()),
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "per_second": self.sent / elapsed if elapsed else 0.0,
+            "per_second_recent": self.rate(),
+        }
+
+
+_scheduler = None
+
+
+def get_notification_scheduler():
+    """Process-wide scheduler shared by every hosted device."""
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = NotificationScheduler()
+    return _scheduler
@@ -0,0 +1,239 @@
+# persistence_journal.py
+
+import os
+import csv
+import json
+import atexit
+import asyncio
+import logging
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def atomic_write(path, write_fn, mode="w", **open_kwargs):
+    """Write a file through a temp file in the same directory and rename it into place."""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, mode, **open_kwargs) as f:
+            write_fn(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+class WriteBehindJournal:
+    """Append-only journal of key -> value writes, coalesced and flushed in the background.
+
+    Every write is appended as one compact JSON line before it is acknowledged,
+    so a crash loses nothing: the next start replays the journal. flush() hands
+    the coalesced values (last value per key wins) to flush_fn, which must
+    persist them atomically, and only then truncates the journal.
+    """
+
+    def __init__(self, target_path, flush_fn, journal_path=None, interval=2.0, fsync=False):
+        self.target_path = target_path
+        self.journal_path = journal_path or f"{target_path}.journal"
+        self.flush_fn = flush_fn
+        self.interval = interval
+        self.fsync = fsync
+        self.pending = {}
+        self.appended = 0
+        self.flushes = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._file = None
+        self._task = None
+        atexit.register(self.close)
+
+    def _open(self):
+        if self._file is None:
+            self._file = open(self.journal_path, "a", encoding="utf-8")
+        return self._file
+
+    def append(self, key, value):
+        """Record a write in memory and in the journal."""
+        line = json.dumps({"k": key, "v": value}, separators=(",", ":"))
+        with self._lock:
+            self.pending[key] = value
+            f = self._open()
+            f.write(line + "\n")
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+            self.appended += 1
+
+    def replay(self):
+        """Read back entries left over from a previous run, coalesced per key."""
+        entries = {}
+        try:
+            with open(self.journal_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Torn last line from a crash mid-append
+                        continue
+                    entries[entry["k"]] = entry["v"]
+        except FileNotFoundError:
+            return {}
+        if entries:
+            logger.info(f"Replaying {len(entries)} journaled writes for {self.target_path}")
+        with self._lock:
+            for key, value in entries.items():
+                self.pending.setdefault(key, value)
+        return entries
+
+    def flush(self):
+        """Persist coalesced writes via flush_fn, then start a fresh journal."""
+        with self._flush_lock:
+            with self._lock:
+                if not self.pending:
+                    return 0
+                pending = dict(self.pending)
+            # flush_fn runs without our lock so writers are never blocked on disk I/O
+            try:
+                self.flush_fn(pending)
+            except Exception as e:
+                logger.error(f"❌ Failed to flush journal for {self.target_path}: {e}")
+                return 0
+            with self._lock:
+                # Values are safely in the target now; anything written meanwhile
+                # is re-journaled so the new journal stays complete
+                self.pending = {k: v for k, v in self.pending.items()
+                                if k not in pending or pending[k] != v}
+                if self._file is not None:
+                    self._file.close()
+                    self._file = None
+                atomic_write(self.journal_path, lambda f: f.writelines(
+                    json.dumps({"k": k, "v": v}, separators=(",", ":")) + "\n"
+                    for k, v in self.pending.items()))
+                self.flushes += 1
+            return len(pending)
+
+    async def _flush_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.interval)
+            if self.pending:
+                await loop.run_in_executor(None, self.flush)
+
+    def start(self):
+        """Flush periodically from the running event loop."""
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._flush_loop())
+        return self._task
+
+    def close(self):
+        """Final flush on shutdown."""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self.flush()
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def enable_spec_journal(value_store, interval=2.0):
+    """Make a CharacteristicValueStore write-behind and replay any journal left by a crash."""
+    if value_store.journal is not None:
+        return value_store.journal
+    journal = WriteBehindJournal(value_store.json_file,
+                                 lambda pending: value_store.save(),
+                                 interval=interval)
+    for uuid, value in journal.replay().items():
+        value_store.set(uuid, value, persist=False)
+    value_store.journal = journal
+    journal.flush()
+    return journal
+
+
+def _flush_readings_csv(csv_file, pending):
+    rows = []
+    fieldnames = ["uuid", "value"]
+    try:
+        with open(csv_file, "r", newline="") as f:
+            reader = csv.DictReader(f)
+            fieldnames = reader.fieldnames or fieldnames
+            rows = list(reader)
+    except FileNotFoundError:
+        pass
+
+    remaining = dict(pending)
+    for row in rows:
+        uuid = row.get("uuid")
+        if uuid in remaining:
+            row["value"] = remaining.pop(uuid)
+    for uuid, value in remaining.items():
+        rows.append({"uuid": uuid, "value": value})
+
+    def write(f):
+        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(rows)
+
+    atomic_write(csv_file, write, newline="")
+
+
+_readings_journals = {}
+_readings_users = {}               # csv path -> running devices holding its journal
+_readings_lock = threading.Lock()
+
+
+def get_readings_journal(csv_file, interval=2.0):
+    """Shared write-behind journal for 'uuid,value' rows in a readings CSV."""
+    key = os.path.abspath(csv_file)
+    with _readings_lock:
+        journal = _readings_journals.get(key)
+        if journal is None:
+            journal = WriteBehindJournal(csv_file,
+                                         lambda pending: _flush_readings_csv(csv_file, pending),
+                                         interval=interval)
+            journal.replay()
+            journal.flush()
+            _readings_journals[key] = journal
+        return journal
+
+
+def open_readings_journal(csv_file, interval=2.0):
+    """get_readings_journal for a device that calls close_readings_journal when it stops."""
+    journal = get_readings_journal(csv_file, interval)
+    key = os.path.abspath(csv_file)
+    with _readings_lock:
+        _readings_users[key] = _readings_users.get(key, 0) + 1
+    return journal
+
+
+def close_readings_journal(csv_file):
+    """Release one device's hold; the last one flushes, closes and unregisters the journal."""
+    key = os.path.abspath(csv_file)
+    with _readings_lock:
+        users = _readings_users.get(key, 0) - 1
+        if users > 0:
+            _readings_users[key] = users
+            return
+        _readings_users.pop(key, None)
+        journal = _readings_journals.pop(key, None)
+    if journal is not None:
+        journal.close()
+        atexit.unregister(journal.close)
+
+
+def start_journals():
+    """Start the periodic flush of every journal created so far."""
+    from value_store import _stores
+    for store in list(_stores.values()):
+        if store.journal is not None:
+            store.journal.start()
+    for journal in list(_readings_journals.values()):
+        journal.start()
@@ -0,0 +1,140 @@
+# profile_cache.py
+#
+# Compiled, shareable parts of a device spec, cached by content hash so 500
+# identical bulbs compile their model once:
+#
+#   GattProfile          services -> characteristic templates (normalized
+#                        UUIDs, property/permission lists and flags, codec),
+#                        keyed by the "gatt" section minus the values. Each
+#                        spec file remembers its parsed section, so the hash
+#                        is only computed again after the file was re-read
+#   AdvertisingProfile   static advertising fields (see advertising_engine.py),
+#                        keyed by the "advertisement" section minus local_name
+#
+# Per-device data (address, name, setup state, characteristic values) is not
+# part of either key; start_virtual_device applies it on top when it builds
+# the device's own bumble objects from the templates.
+
+import os
+import json
+import hashlib
+import logging
+import threading
+
+from bumble.core import AdvertisingData
+
+from advertising_engine import static_fields
+from value_codecs import compile_codec
+from value_store import normalize_uuid
+
+logger = logging.getLogger(__name__)
+
+# Advertisement keys that differ between otherwise identical devices
+PER_DEVICE_ADVERTISING = ("local_name",)
+
+
+def spec_hash(section):
+    """Stable content hash of a JSON-able spec section."""
+    blob = json.dumps(section, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha1(blob.encode()).hexdigest()
+
+
+class CharacteristicTemplate:
+    __slots__ = ("uuid", "key", "properties", "permissions", "prop_flags", "perm_flags", "codec")
+
+    def __init__(self, char_data, property_map, permission_map):
+        self.uuid = char_data["uuid"]
+        self.key = normalize_uuid(self.uuid)
+        self.properties = [p.lower() for p in char_data.get("properties", [])]
+        self.permissions = [p.lower() for p in char_data.get("permissions", [])]
+        self.prop_flags = sum(property_map.get(p, 0) for p in self.properties)
+        self.perm_flags = sum(permission_map.get(p, 0) for p in self.permissions)
+        self.codec = compile_codec(char_data.get("format"))
+
+
+class GattProfile:
+    def __init__(self, key, gatt, property_map, permission_map):
+        self.key = key
+        self.services = []     # [(service_uuid, [CharacteristicTemplate])]
+        for service_data in gatt.get("services", []):
+            templates = [CharacteristicTemplate(c, property_map, permission_map)
+                         for c in service_data.get("characteristics", [])]
+            self.services.append((service_data["uuid"], templates))
+        self.characteristic_count = sum(len(t) for _, t in self.services)
+
+
+class AdvertisingProfile:
+    def __init__(self, key, advertisement):
+        self.key = key
+        # Static fields only; live ones are added per device by the AdvertisingEngine.
+        # The name is a placeholder here, see fields_for()
+        self.fields = static_fields(advertisement)
+        self.name_index = next(i for i, (ad_type, _) in enumerate(self.fields)
+                               if ad_type == AdvertisingData.COMPLETE_LOCAL_NAME)
+
+    def fields_for(self, local_name):
+        """The static fields with this device's name in place."""
+        fields = list(self.fields)
+        fields[self.name_index] = (AdvertisingData.COMPLETE_LOCAL_NAME, local_name.encode("utf-8"))
+        return fields
+
+
+def _strip_values(gatt):
+    """The gatt section without characteristic values: those are per device."""
+    services = []
+    for service_data in gatt.get("services", []):
+        chars = [{k: v for k, v in c.items() if k != "initial_value"}
+                 for c in service_data.get("characteristics", [])]
+        services.append({**service_data, "characteristics": chars})
+    return {**gatt, "services": services}
+
+
+class ProfileCache:
+    def __init__(self):
+        self._gatt = {}
+        self._advertising = {}
+        self._sources = {}     # spec path -> (parsed "gatt" section, GattProfile)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _get(self, table, cls, section, *args):
+        key = spec_hash(section)
+        profile = table.get(key)
+        if profile is not None:
+            self.hits += 1
+            return profile
+        with self._lock:
+            profile = table.get(key)
+            if profile is None:
+                profile = table[key] = cls(key, section, *args)
+                self.misses += 1
+                logger.info(f"Compiled {cls.__name__} {key[:12]}")
+            else:
+                self.hits += 1
+        return profile
+
+    def gatt(self, value_store, property_map, permission_map):
+        """Templates for the store's spec, flags from the given name -> flag maps."""
+        gatt = value_store.config.get("gatt", {})
+        source = os.path.abspath(value_store.json_file)
+        seen = self._sources.get(source)
+        if seen is not None and seen[0] is gatt:
+            # Same parsed section as last time: no need to hash it again
+            self.hits += 1
+            return seen[1]
+        profile = self._get(self._gatt, GattProfile, _strip_values(gatt), property_map, permission_map)
+        self._sources[source] = (gatt, profile)
+        return profile
+
+    def advertising(self, config):
+        advertisement = config.get("advertisement", {})
+        shared = {k: v for k, v in advertisement.items() if k not in PER_DEVICE_ADVERTISING}
+        return self._get(self._advertising, AdvertisingProfile, shared)
+
+    def stats(self):
+        return {"gatt_profiles": len(self._gatt), "advertising_profiles": len(self._advertising),
+                "hits": self.hits, "misses": self.misses}
+
+
+profile_cache = ProfileCache()
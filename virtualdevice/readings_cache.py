@@ -0,0 +1,171 @@
+# readings_cache.py
+
+import io
+import os
+import csv
+import mmap
+import logging
+import threading
+from array import array
+
+logger = logging.getLogger(__name__)
+
+# Files above this size are memory-mapped instead of read into a Python string
+MMAP_THRESHOLD = 1 << 20
+
+
+def _to_number(text):
+    try:
+        return float(text)
+    except (TypeError, ValueError):
+        return None
+
+
+class ReadingsTable:
+    """Column-oriented, append-aware parse of one readings CSV."""
+
+    def __init__(self, csv_file):
+        self.csv_file = csv_file
+        self.header = []
+        self.columns = {}       # name -> list of raw strings
+        self.numeric = {}       # name -> array('d') while every cell parses as a number
+        self.uuid_index = {}    # uuid -> row index of its first occurrence
+        self.rows = 0
+        self.parses = 0
+        self._signature = None
+        self._offset = 0        # bytes consumed so far
+        self._tail = b""        # last consumed line, used to detect rewrites vs appends
+
+    def _stat_signature(self):
+        st = os.stat(self.csv_file)
+        return (st.st_mtime_ns, st.st_size)
+
+    def refresh(self):
+        """Re-read the file only if mtime/size changed; parse just the tail if it only grew."""
+        try:
+            signature = self._stat_signature()
+        except OSError as e:
+            logger.error(f"Error reading CSV: {e}")
+            return False
+        if signature == self._signature:
+            return False
+        size = signature[1]
+        if self._signature is not None and size > self._offset and self._still_prefix():
+            self._parse(self._offset, size)
+        else:
+            self._reset()
+            self._parse(0, size)
+        self._signature = signature
+        return True
+
+    def _reset(self):
+        self.header = []
+        self.columns = {}
+        self.numeric = {}
+        self.uuid_index = {}
+        self.rows = 0
+        self._offset = 0
+        self._tail = b""
+
+    def _still_prefix(self):
+        # Cheap append detection: the last line we parsed must still sit where we left it
+        if not self._tail:
+            return False
+        start = self._offset - len(self._tail)
+        with open(self.csv_file, "rb") as f:
+            f.seek(start)
+            return f.read(len(self._tail)) == self._tail
+
+    def _read_range(self, start, end):
+        with open(self.csv_file, "rb") as f:
+            if end - start >= MMAP_THRESHOLD:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                    return m[start:end]
+            f.seek(start)
+            return f.read(end - start)
+
+    def _parse(self, start, end):
+        data = self._read_range(start, end)
+        # Only consume whole lines; a half-written last line is picked up next time
+        cut = data.rfind(b"\n") + 1
+        if cut == 0:
+            return
+        data = data[:cut]
+        reader = csv.reader(io.StringIO(data.decode("utf-8", errors="replace"), newline=""))
+        if not self.header:
+            self.header = [h.strip() for h in next(reader, [])]
+            for name in self.header:
+                self.columns[name] = []
+                self.numeric[name] = array("d")
+        for row in reader:
+            if not row:
+                continue
+            index = self.rows
+            for i, name in enumerate(self.header):
+                cell = row[i] if i < len(row) else ""
+                self.columns[name].append(cell)
+                numbers = self.numeric.get(name)
+                if numbers is not None:
+                    number = _to_number(cell) if cell != "" else float("nan")
+                    if number is None:
+                        del self.numeric[name]
+                    else:
+                        numbers.append(number)
+            uuid = row[0] if self.header and self.header[0] == "uuid" and row else None
+            if uuid is not None:
+                self.uuid_index.setdefault(uuid, index)
+            self.rows += 1
+        last_newline = data.rfind(b"\n", 0, len(data) - 1) + 1
+        self._tail = data[last_newline:]
+        self._offset = start + cut
+        self.parses += 1
+
+    def value_for_uuid(self, uuid, column="value"):
+        """Raw cell for the first row with this uuid, or None."""
+        index = self.uuid_index.get(uuid)
+        if index is None or column not in self.columns:
+            return None
+        return self.columns[column][index]
+
+    def as_dict(self, key="uuid", column="value"):
+        """{key: value} like a dict built row by row: the last row for a key wins."""
+        if key not in self.columns or column not in self.columns:
+            return {}
+        return dict(zip(self.columns[key], self.columns[column]))
+
+    def latest(self, column):
+        """Last non-empty value in a column; a float for numeric columns."""
+        numbers = self.numeric.get(column)
+        if numbers is not None:
+            for i in range(len(numbers) - 1, -1, -1):
+                if numbers[i] == numbers[i]:  # skip NaN
+                    return numbers[i]
+            return None
+        cells = self.columns.get(column)
+        if cells is None:
+            return None
+        for cell in reversed(cells):
+            if cell != "":
+                return cell
+        return None
+
+
+class ReadingsCache:
+    """Process-wide cache of parsed readings CSVs, shared by every characteristic."""
+
+    def __init__(self):
+        self._tables = {}
+        self._lock = threading.Lock()
+
+    def table(self, csv_file):
+        key = os.path.abspath(csv_file)
+        with self._lock:
+            table = self._tables.get(key)
+            if table is None:
+                table = ReadingsTable(csv_file)
+                self._tables[key] = table
+            table.refresh()
+            return table
+
+
+readings_cache = ReadingsCache()
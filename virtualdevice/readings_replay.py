@@ -0,0 +1,155 @@
+# readings_replay.py
+#
+# Plays a recorded readings trace back into a running device. The CSV has a
+# timestamp column plus one column per characteristic UUID:
+#
+#   timestamp,dd03,dd04
+#   2025-06-09T10:00:00.000,0x01,23.5
+#   2025-06-09T10:00:00.250,0x02,23.6
+#
+# Enabled per spec with {"replay": {"csv": "trace.csv", "speed": 4, "loop": true}}.
+
+import time
+import asyncio
+import logging
+
+from readings_cache import readings_cache
+from value_store import normalize_uuid, encode_spec_value
+
+logger = logging.getLogger(__name__)
+
+TIMESTAMP_COLUMNS = ("timestamp", "time", "ts")
+
+
+def _numpy():
+    # Replay is optional; only devices that use it pay for the NumPy import
+    import numpy as np
+    return np
+
+
+class ReadingsReplay:
+    """A trace loaded once: relative timestamps plus every row pre-encoded per characteristic."""
+
+    def __init__(self, csv_file, uuids=None, encoders=None):
+        np = _numpy()
+        table = readings_cache.table(csv_file)
+        time_column = next((c for c in TIMESTAMP_COLUMNS if c in table.columns), None)
+        if time_column is None:
+            raise ValueError(f"{csv_file} has no timestamp column")
+
+        self.csv_file = csv_file
+        self.times = self._seconds(np, table, time_column)
+        self.rows = len(self.times)
+        self.duration = float(self.times[-1]) if self.rows else 0.0
+        # uuid -> (payload blob, offsets); row i is blob[offsets[i]:offsets[i + 1]]
+        self.frames = {}
+        encoders = encoders or {}
+        wanted = {normalize_uuid(u) for u in uuids} if uuids is not None else None
+        for column in table.header:
+            if column == time_column:
+                continue
+            uuid = normalize_uuid(column)
+            if wanted is not None and uuid not in wanted:
+                continue
+            encode = encoders.get(uuid, encode_spec_value)
+            payloads = [encode(cell) for cell in table.columns[column]]
+            lengths = np.fromiter((len(p) for p in payloads), dtype=np.int64, count=len(payloads))
+            offsets = np.zeros(len(payloads) + 1, dtype=np.int64)
+            np.cumsum(lengths, out=offsets[1:])
+            self.frames[uuid] = (b"".join(payloads), offsets)
+        logger.info(f"🎞️ Loaded {self.rows} rows x {len(self.frames)} characteristics from {csv_file}")
+
+    @staticmethod
+    def _seconds(np, table, column):
+        numbers = table.numeric.get(column)
+        if numbers is not None:
+            # Epoch seconds; array('d') is viewed, not copied
+            times = np.frombuffer(numbers, dtype=np.float64).copy()
+        else:
+            stamps = np.array(table.columns[column], dtype="datetime64[ns]")
+            times = (stamps - stamps[0]).astype(np.int64) / 1e9
+        if len(times):
+            times -= times[0]
+        return times
+
+    def frame(self, uuid, row):
+        blob, offsets = self.frames[uuid]
+        return blob[offsets[row]:offsets[row + 1]]
+
+    def row_at(self, elapsed):
+        """Index of the last row whose timestamp is <= elapsed (trace seconds), or -1."""
+        return int(_numpy().searchsorted(self.times, elapsed, side="right")) - 1
+
+
+class ReplayPlayer:
+    """Feeds a ReadingsReplay into a device's value store in real time or at N× speed."""
+
+    def __init__(self, device, replay, speed=1.0, loop=False, publish=None):
+        self.device = device
+        self.replay = replay
+        self.speed = speed
+        self.loop = loop
+        self.publish = publish        # callback(device, uuid) after a value changes
+        self.frames_applied = 0
+        self.rows_skipped = 0
+        self._task = None
+
+    def _apply(self, row):
+        store = self.device.value_store
+        for uuid in self.replay.frames:
+            store.set_live(uuid, self.replay.frame(uuid, row))
+            if self.publish is not None:
+                self.publish(self.device, uuid)
+        self.frames_applied += 1
+
+    async def _run(self):
+        replay = self.replay
+        if not replay.rows:
+            return
+        while True:
+            start = time.perf_counter()
+            row = -1
+            while row < replay.rows - 1:
+                next_at = replay.times[row + 1] / self.speed
+                delay = next_at - (time.perf_counter() - start)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                # Jump straight to the latest due row if we fell behind
+                due = min(replay.rows - 1, replay.row_at((time.perf_counter() - start) * self.speed))
+                due = max(due, row + 1)
+                self.rows_skipped += due - row - 1
+                row = due
+                self._apply(row)
+            if not self.loop:
+                return
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        return self._task
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def stats(self):
+        return {"rows": self.replay.rows, "frames_applied": self.frames_applied,
+                "rows_skipped": self.rows_skipped, "speed": self.speed}
+
+
+def start_replay(device, config, publish=None):
+    """Start the replay described by the spec's "replay" section, if any."""
+    settings = config.get("replay")
+    if not settings or not settings.get("csv"):
+        return None
+    store = device.value_store
+    encoders = {uuid: store.codec(uuid).encode for uuid in device.characteristics_by_uuid}
+    replay = ReadingsReplay(settings["csv"], uuids=device.characteristics_by_uuid.keys(),
+                            encoders=encoders)
+    player = ReplayPlayer(device, replay,
+                          speed=float(settings.get("speed", 1.0)),
+                          loop=bool(settings.get("loop", False)),
+                          publish=publish)
+    player.start()
+    return player
@@ -0,0 +1,319 @@
+# shared_values.py
+#
+# mmap-backed characteristic table shared between the agent (single writer)
+# and a device process (reader). One file per device in /dev/shm:
+#
+#   header: magic, version, slot_count, slot_size, used_slots, generation
+#   slot:   uuid[36], seq u32, length u32, flags u32, data[slot_size]
+#
+# Each slot is a seqlock: the writer makes seq odd, writes, makes it even
+# again; readers retry if seq was odd or moved while they copied. The
+# header generation bumps on every write, so an idle reader only checks
+# one integer. Values too large for a slot spill to a side file named after
+# the UUID and sequence number, which is all the slot then holds; a spill
+# file is deleted once it is replaced.
+#
+# mmap writes raise no inotify events, so after each update the writer also
+# rewrites an empty "<table>.bell" file; the device waits for that through
+# its FileWatcher instead of polling the table.
+
+import os
+import glob
+import json
+import mmap
+import struct
+import logging
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"VDSV"
+VERSION = 1
+HEADER = struct.Struct("<4sHHIIQ")     # magic, version, slot_count, slot_size, used_slots, generation
+HEADER_SIZE = 64
+SLOT_HEADER = struct.Struct("<36sIII")  # uuid, seq, length, flags
+SEQ_OFFSET = 36
+LENGTH_OFFSET = 40
+FLAG_SPILL = 0x1
+MAX_SPILL_FILES = 64                    # per device, oldest removed first
+MAX_READ_RETRIES = 100                  # torn / in-progress slot reads before giving up
+
+SHM_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+
+
+def shared_table_path(device_id):
+    return os.path.join(SHM_DIR, f"vdev_{device_id}.values")
+
+
+def bell_path(table_path):
+    return f"{table_path}.bell"
+
+
+def ring(table_path):
+    """Wake the table's reader: a completed write of the bell file is an inotify event."""
+    with open(bell_path(table_path), "wb"):
+        pass
+
+
+class SharedValueTable:
+    """Fixed-slot value table for one device, keyed by characteristic UUID."""
+
+    def __init__(self, path, slot_count=64, slot_size=256, create=False):
+        self.path = path
+        self.spills = 0
+        if create and not os.path.exists(path):
+            size = HEADER_SIZE + slot_count * (SLOT_HEADER.size + slot_size)
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as f:
+                f.truncate(size)
+                f.seek(0)
+                f.write(HEADER.pack(MAGIC, VERSION, slot_count, slot_size, 0, 0))
+            os.replace(tmp, path)
+        self._file = open(path, "r+b")
+        self._map = mmap.mmap(self._file.fileno(), 0)
+        magic, version, self.slot_count, self.slot_size, _, _ = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a shared value table")
+        self.stride = SLOT_HEADER.size + self.slot_size
+        self._index = {}        # uuid -> slot number
+        self._indexed = 0
+
+    # Header ----------------------------------------------------------------
+
+    def _header(self):
+        return HEADER.unpack_from(self._map, 0)
+
+    @property
+    def generation(self):
+        return self._header()[5]
+
+    def _slot_offset(self, slot):
+        return HEADER_SIZE + slot * self.stride
+
+    def _refresh_index(self):
+        used = self._header()[4]
+        for slot in range(self._indexed, used):
+            uuid = SLOT_HEADER.unpack_from(self._map, self._slot_offset(slot))[0]
+            self._index[uuid.rstrip(b"\0").decode()] = slot
+        self._indexed = used
+
+    def uuids(self):
+        self._refresh_index()
+        return list(self._index)
+
+    # Writer (agent) ----------------------------------------------------------
+
+    def write(self, uuid, data):
+        """Store bytes for a UUID; single writer only."""
+        uuid = uuid.lower()
+        self._refresh_index()
+        slot = self._index.get(uuid)
+        magic, version, count, size, used, generation = self._header()
+        if slot is None:
+            if used >= count:
+                raise OverflowError(f"{self.path}: all {count} slots in use")
+            slot = used
+            SLOT_HEADER.pack_into(self._map, self._slot_offset(slot), uuid.encode()[:36], 0, 0, 0)
+            HEADER.pack_into(self._map, 0, magic, version, count, size, used + 1, generation)
+            self._index[uuid] = slot
+            self._indexed = used + 1
+
+        offset = self._slot_offset(slot)
+        _, seq, _, old_flags = SLOT_HEADER.unpack_from(self._map, offset)
+        flags = 0
+        if len(data) > self.slot_size:
+            self._spill(uuid, seq + 2, data)
+            data = struct.pack("<I", seq + 2)
+            flags = FLAG_SPILL
+        old_spill = self._spill_path(uuid, seq) if old_flags & FLAG_SPILL else None
+
+        struct.pack_into("<I", self._map, offset + SEQ_OFFSET, seq + 1)          # odd: write in progress
+        self._map[offset + SLOT_HEADER.size:offset + SLOT_HEADER.size + len(data)] = data
+        struct.pack_into("<II", self._map, offset + LENGTH_OFFSET, len(data), flags)
+        struct.pack_into("<I", self._map, offset + SEQ_OFFSET, seq + 2)          # even: stable
+        struct.pack_into("<Q", self._map, 16, self.generation + 1)
+
+        if old_spill:
+            try:
+                os.unlink(old_spill)
+            except OSError:
+                pass
+
+    def _spill_path(self, uuid, seq):
+        return f"{self.path}.{uuid}.{seq}.spill"
+
+    def _spill(self, uuid, seq, data):
+        with open(self._spill_path(uuid, seq), "wb") as f:
+            f.write(data)
+        self.spills += 1
+        cleanup_spill_files(self.path)
+
+    # Reader (device) ---------------------------------------------------------
+
+    def read_view(self, uuid):
+        """(seq, memoryview) without copying; the view is only valid until the next write.
+
+        (None, None) if the slot is absent, or still mid-write after
+        MAX_READ_RETRIES attempts (a writer that died halfway leaves it odd).
+        """
+        self._refresh_index()
+        slot = self._index.get(uuid.lower())
+        if slot is None:
+            return None, None
+        offset = self._slot_offset(slot)
+        view = memoryview(self._map)
+        for _ in range(MAX_READ_RETRIES):
+            _, seq, length, flags = SLOT_HEADER.unpack_from(self._map, offset)
+            if seq & 1:
+                continue
+            start = offset + SLOT_HEADER.size
+            data = view[start:start + min(length, self.slot_size)]
+            if struct.unpack_from("<I", self._map, offset + SEQ_OFFSET)[0] == seq:
+                return seq, (data, flags)
+        return None, None
+
+    def read(self, uuid):
+        """(seq, bytes) for a UUID, following spill files; (None, None) if absent or busy.
+
+        The bytes are None if the value's spill file has been cleaned up.
+        """
+        while True:
+            seq, entry = self.read_view(uuid)
+            if entry is None:
+                return None, None
+            data, flags = entry
+            if not flags & FLAG_SPILL:
+                return seq, bytes(data)
+            spill_seq = struct.unpack("<I", data[:4])[0]
+            try:
+                with open(self._spill_path(uuid.lower(), spill_seq), "rb") as f:
+                    return seq, f.read()
+            except FileNotFoundError:
+                # Replaced between our read and the open: take the newer value,
+                # unless nothing changed and the file was removed by cleanup
+                if self.read_view(uuid)[0] == seq:
+                    return seq, None
+
+    def seqs(self):
+        self._refresh_index()
+        return {uuid: SLOT_HEADER.unpack_from(self._map, self._slot_offset(slot))[1]
+                for uuid, slot in self._index.items()}
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+
+def cleanup_spill_files(table_path, keep=MAX_SPILL_FILES):
+    """Keep only the newest `keep` spill files of a table."""
+    files = glob.glob(f"{glob.escape(table_path)}.*.spill")
+    if len(files) <= keep:
+        return 0
+    files.sort(key=lambda p: os.stat(p).st_mtime_ns if os.path.exists(p) else 0)
+    removed = 0
+    for path in files[:-keep]:
+        try:
+            os.unlink(path)
+            removed += 1
+        except OSError:
+            pass
+    return removed
+
+
+def remove_table(device_id):
+    """Delete a device's table, bell and spill files (the device has stopped)."""
+    path = shared_table_path(device_id)
+    for leftover in glob.glob(f"{glob.escape(path)}.*.spill") + [bell_path(path), path]:
+        try:
+            os.unlink(leftover)
+        except OSError:
+            pass
+
+
+class SharedValueWriter:
+    """Agent side: one table per device, values stored as compact JSON of the spec value."""
+
+    def __init__(self, slot_count=64, slot_size=256):
+        self.slot_count = slot_count
+        self.slot_size = slot_size
+        self.tables = {}
+
+    def table(self, device_id):
+        table = self.tables.get(device_id)
+        if table is not None and not os.path.exists(table.path):
+            # Removed when the device stopped; a restarted device looks for a new file
+            table.close()
+            table = None
+        if table is None:
+            table = SharedValueTable(shared_table_path(device_id), self.slot_count,
+                                     self.slot_size, create=True)
+            self.tables[device_id] = table
+        return table
+
+    def write_update(self, device_id, data):
+        """Write {service: {uuid: value}} (optionally wrapped in "characteristics")."""
+        table = self.table(device_id)
+        written = 0
+        for service_uuid, chars in data.get("characteristics", data).items():
+            if not isinstance(chars, dict):
+                continue
+            for uuid, value in chars.items():
+                table.write(uuid, json.dumps(value, separators=(",", ":")).encode())
+                written += 1
+        if written:
+            ring(table.path)
+        return table.path, written
+
+
+class SharedValueReader:
+    """Device side: notices changed slots by sequence number."""
+
+    def __init__(self, device_id):
+        self.device_id = device_id
+        self.path = shared_table_path(device_id)
+        self.bell_path = bell_path(self.path)
+        self.table = None
+        self._generation = None
+        self._seqs = {}
+
+    def _attach(self):
+        if self.table is None and os.path.exists(self.path):
+            self.table = SharedValueTable(self.path)
+        return self.table
+
+    def changes(self):
+        """{uuid: spec value} for every slot written since the last call."""
+        table = self._attach()
+        if table is None:
+            return {}
+        generation = table.generation
+        if generation == self._generation:
+            return {}
+        self._generation = generation
+        changed = {}
+        for uuid, seq in table.seqs().items():
+            if self._seqs.get(uuid) == seq:
+                continue
+            seq, data = table.read(uuid)
+            if seq is None:
+                # Slot busy: look at this table again on the next poll
+                self._generation = None
+                continue
+            self._seqs[uuid] = seq
+            if data is None:
+                continue
+            try:
+                changed[uuid] = json.loads(data)
+            except ValueError:
+                logger.error(f"Corrupt shared value for {uuid} in {self.path}")
+        return changed
+
+    @property
+    def busy(self):
+        """A slot was mid-write on the last changes(): call again soon rather than wait."""
+        return self.table is not None and self._generation is None
+
+    def close(self):
+        if self.table is not None:
+            self.table.close()
+            self.table = None
@@ -0,0 +1,67 @@
+# startup_timing.py
+
+import os
+import json
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Order in which phases are reported; anything else is appended after
+PHASES = ["interpreter", "import", "transport_open", "power_on", "gatt_load", "first_advertisement"]
+
+
+def process_age():
+    """Seconds since this process was created (Linux), or None."""
+    try:
+        with open("/proc/self/stat", "r") as f:
+            # Field 22 is starttime in clock ticks; split after the ')' of the comm field
+            fields = f.read().rsplit(")", 1)[1].split()
+        start_ticks = int(fields[19])
+        with open("/proc/uptime", "r") as f:
+            uptime = float(f.read().split()[0])
+        return max(0.0, uptime - start_ticks / os.sysconf("SC_CLK_TCK"))
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class StartupTimer:
+    """Records how long each startup phase of a device took."""
+
+    def __init__(self, device_id=None, started=None):
+        self.device_id = device_id
+        self.started = time.perf_counter() if started is None else started
+        self._last = self.started
+        self.phases = {}
+
+    def mark(self, phase):
+        """Close the current phase: time since the previous mark is booked to `phase`."""
+        now = time.perf_counter()
+        self.phases[phase] = self.phases.get(phase, 0.0) + (now - self._last)
+        self._last = now
+        return now
+
+    def total(self):
+        return self._last - self.started + self.phases.get("interpreter", 0.0)
+
+    def report(self):
+        ordered = {p: round(self.phases[p] * 1e3, 2) for p in PHASES if p in self.phases}
+        ordered.update({p: round(v * 1e3, 2) for p, v in self.phases.items() if p not in ordered})
+        return {"device_id": self.device_id, "phases_ms": ordered, "total_ms": round(self.total() * 1e3, 2)}
+
+    def emit(self):
+        """Print the report as one machine-readable line and log it."""
+        report = self.report()
+        line = json.dumps(report, separators=(",", ":"))
+        print(f"STARTUP_TIMING {line}", flush=True)
+        logger.info(f"⏱️ Startup timing: {line}")
+        return report
+
+
+# Module-level timer for the classic one-device-per-process entry point.
+# VirtualDevice marks "import" on it once its own imports are done.
+process_timer = StartupTimer()
+_age = process_age()
+if _age is not None:
+    # Time spent before the first line of Python ran (interpreter start, site imports)
+    process_timer.phases["interpreter"] = max(0.0, _age - (time.perf_counter() - process_timer.started))
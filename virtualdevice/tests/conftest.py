@@ -0,0 +1,73 @@
+# conftest.py
+#
+# Virtual devices on bumble's in-process local link (no netsim, no phone),
+# each with a scripted central, for tests that need real GATT traffic.
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import contextlib
+
+import pytest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PACKAGE = os.path.dirname(HERE)
+sys.path.insert(0, PACKAGE)
+
+os.environ.setdefault("VIRTUAL_DEVICE_LOG_LEVEL", "WARNING")
+# Never restore from, or leave slots in, the real host state file
+os.environ["VIRTUAL_DEVICE_STATE_FILE"] = os.path.join(tempfile.mkdtemp(prefix="vdev_tests_"), "host.state")
+
+from bumble.controller import Controller
+from bumble.device import Device
+from bumble.hci import Address
+from bumble.link import LocalLink
+from bumble.transport.common import AsyncPipeSink
+
+from VirtualDevice import start_virtual_device, stop_virtual_device
+
+SPEC = os.path.join(PACKAGE, "Qubo_bulb12W_spec.json")
+READINGS = os.path.join(PACKAGE, "Readings2.csv")
+
+
+@pytest.fixture
+def local_device(tmp_path):
+    """async with local_device(device_id, configure=None, **spec_overrides) as (device, central, address).
+
+    configure(config), if given, edits the parsed spec before the device starts.
+    """
+
+    @contextlib.asynccontextmanager
+    async def start(device_id, configure=None, **overrides):
+        with open(SPEC, "r") as f:
+            config = json.load(f)
+        config["address"] = "C0:00:00:00:00:01"
+        config["setup_complete"] = "YES"
+        config.update(overrides)
+        if configure is not None:
+            configure(config)
+        spec_path = str(tmp_path / f"{device_id}_spec.json")
+        with open(spec_path, "w") as f:
+            json.dump(config, f, indent=4)
+        readings = str(tmp_path / "readings.csv")
+        shutil.copyfile(READINGS, readings)
+
+        link = LocalLink()
+        controller = Controller("peripheral", link=link)
+        device = await start_virtual_device(spec_path, readings, controller,
+                                            AsyncPipeSink(controller), device_id)
+        central_controller = Controller("central", link=link)
+        central = Device.with_hci("central", Address("D0:00:00:00:00:01"),
+                                  central_controller, AsyncPipeSink(central_controller))
+        await central.power_on()
+        try:
+            yield device, central, Address(config["address"])
+        finally:
+            for connection in list(central.connections.values()):
+                with contextlib.suppress(Exception):
+                    await connection.disconnect()
+            await stop_virtual_device(device, spec_path)
+
+    return start
@@ -0,0 +1,38 @@
+import asyncio
+
+from bumble.core import AdvertisingData
+
+
+def manufacturer_from_dd01(config):
+    # Short name: the live field then rides in the advertising PDU itself, since
+    # bumble's simulated controller echoes that as the scan response too
+    config["advertisement"]["local_name"] = "Q"
+    config["advertisement"]["dynamic"] = {
+        "manufacturer_data": {"company_id": "0x0075", "characteristics": ["dd01"]},
+        "max_rate_hz": 50,
+    }
+
+
+def test_live_value_reaches_the_air(local_device):
+    async def run():
+        async with local_device("advertising", configure=manufacturer_from_dd01) as (device, central, address):
+            seen = set()
+
+            def on_advertisement(advertisement):
+                if str(advertisement.address) == str(address):
+                    for data in advertisement.data.get_all(AdvertisingData.MANUFACTURER_SPECIFIC_DATA):
+                        seen.add(bytes(data[1]) if isinstance(data, tuple) else bytes(data))
+
+            central.on("advertisement", on_advertisement)
+            await central.start_scanning(active=True)
+            device.value_store.set("dd01", "0xabcd")
+            for _ in range(200):
+                if any(b"\xab\xcd" in data for data in seen):
+                    break
+                await asyncio.sleep(0.01)
+            await central.stop_scanning()
+
+            assert any(b"\xab\xcd" in data for data in seen), f"on air: {[d.hex() for d in seen]}"
+            assert device.advertiser.updates >= 1
+
+    asyncio.run(run())
@@ -0,0 +1,29 @@
+import json
+import asyncio
+
+from device_events import get_event_channel
+from device_state import get_state_file, FLAG_SETUP_COMPLETE
+
+
+def test_first_disconnect_completes_commissioning(local_device):
+    events = []
+    get_event_channel().listen(lambda record: events.append(record)
+                               if record["device_id"] == "commissioning" else None)
+
+    async def run():
+        async with local_device("commissioning", setup_complete="NO") as (device, central, address):
+            assert device.commissioning
+            connection = await asyncio.wait_for(central.connect(address), 5.0)
+            await connection.disconnect()
+            for _ in range(200):
+                if any(e["event"] == "commissioned" for e in events):
+                    break
+                await asyncio.sleep(0.01)
+
+            assert [e["event"] for e in events] == ["ready", "connected", "disconnected", "commissioned"]
+            assert not device.commissioning
+            with open(device.value_store.json_file, "r") as f:
+                assert json.load(f)["setup_complete"] == "YES"
+            assert get_state_file().flags("commissioning") & FLAG_SETUP_COMPLETE
+
+    asyncio.run(run())
@@ -0,0 +1,30 @@
+import asyncio
+
+from connection_lifecycle import LifecycleState
+
+
+async def wait_for(predicate, timeout=2.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not predicate():
+        if asyncio.get_running_loop().time() > deadline:
+            return False
+        await asyncio.sleep(0.01)
+    return True
+
+
+def test_reconnect_after_disconnect(local_device):
+    async def run():
+        async with local_device("lifecycle") as (device, central, address):
+            for _ in range(2):
+                connection = await asyncio.wait_for(central.connect(address), 5.0)
+                assert device.lifecycle.state is LifecycleState.CONNECTED
+                await connection.disconnect()
+                assert await wait_for(lambda: device.is_advertising), "device did not re-advertise"
+                assert device.lifecycle.state is LifecycleState.ADVERTISING
+
+            # Found again after the second disconnect too
+            connection = await asyncio.wait_for(central.connect(address), 5.0)
+            assert device.lifecycle.advertising_restarts == 2
+            assert list(device.lifecycle._links) == [connection.handle]
+
+    asyncio.run(run())
@@ -0,0 +1,39 @@
+import asyncio
+
+from bumble.device import Peer
+
+from notification_scheduler import get_notification_scheduler
+
+
+def stream_dd02(config):
+    for service in config["gatt"]["services"]:
+        for char in service["characteristics"]:
+            if char["uuid"] == "dd02":
+                char["notify"] = {"rate_hz": 20, "source": "counter"}
+
+
+def test_subscribed_central_receives_scheduled_notifications(local_device):
+    async def run():
+        async with local_device("notify", configure=stream_dd02) as (device, central, address):
+            scheduler = get_notification_scheduler()
+            connection = await asyncio.wait_for(central.connect(address), 5.0)
+            peer = Peer(connection)
+            await peer.discover_services()
+            await peer.discover_characteristics()
+            received = []
+            await peer.subscribe(peer.get_characteristics_by_uuid(
+                device.characteristics_by_uuid["dd02"].uuid)[0], received.append)
+
+            await asyncio.sleep(1.0)
+            # 20 Hz for a second, minus the subscription round trip
+            assert len(received) >= 15
+            assert scheduler.sent_by_device[device] >= len(received)
+            assert len(set(received)) == len(received), "counter values repeat"
+
+            link, = device.connections.values()
+            assert link in scheduler.budgets
+            await connection.disconnect()
+            await asyncio.sleep(0.1)
+            assert link not in scheduler.budgets
+
+    asyncio.run(run())
@@ -0,0 +1,25 @@
+import os
+import asyncio
+
+from shared_values import SharedValueWriter, shared_table_path
+
+
+def test_agent_write_wakes_an_idle_device(local_device):
+    writer = SharedValueWriter()
+
+    async def run():
+        async with local_device("shared") as (device, central, address):
+            # Let the follower go idle: only its bell can now deliver the value within a second
+            await asyncio.sleep(0.1)
+
+            writer.write_update("shared", {"characteristics": {"dd00": {"dd01": "0x1234"}}})
+            for _ in range(100):
+                if device.value_store.get("dd01") == "0x1234":
+                    break
+                await asyncio.sleep(0.01)
+            assert device.value_store.get("dd01") == "0x1234"
+
+        assert not os.path.exists(shared_table_path("shared")), "table left behind after stop"
+        assert not os.path.exists(shared_table_path("shared") + ".bell")
+
+    asyncio.run(run())
@@ -0,0 +1,87 @@
+# topic_router.py
+
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class _Node:
+    __slots__ = ("children", "handlers")
+
+    def __init__(self):
+        self.children = {}
+        self.handlers = []
+
+
+class TopicRouter:
+    """MQTT topic trie: subscribe to a few wildcards at the broker, route per device here.
+
+    Patterns use MQTT syntax ('+' one level, '#' the rest). dispatch() has the
+    paho on_message signature, so it can be the callback of every wildcard
+    subscription. Every message is routed, including repeats of the same
+    payload: an unchanged reading sent again is still an update.
+    """
+
+    def __init__(self):
+        self.root = _Node()
+        self._lock = threading.Lock()
+        self.routed = 0
+        self.unrouted = 0
+
+    def add(self, pattern, handler):
+        """Route topics matching `pattern` to handler(client, userdata, msg). Idempotent."""
+        with self._lock:
+            node = self.root
+            for level in pattern.split("/"):
+                node = node.children.setdefault(level, _Node())
+            if handler not in node.handlers:
+                node.handlers.append(handler)
+
+    def remove(self, pattern, handler=None):
+        with self._lock:
+            node = self.root
+            for level in pattern.split("/"):
+                node = node.children.get(level)
+                if node is None:
+                    return
+            if handler is None:
+                node.handlers.clear()
+            elif handler in node.handlers:
+                node.handlers.remove(handler)
+
+    def match(self, topic):
+        """Handlers for every pattern matching `topic`, without duplicates."""
+        levels = topic.split("/")
+        found = []
+        stack = [(self.root, 0)]
+        while stack:
+            node, depth = stack.pop()
+            multi = node.children.get("#")
+            if multi is not None:
+                found.extend(multi.handlers)
+            if depth == len(levels):
+                found.extend(node.handlers)
+                continue
+            exact = node.children.get(levels[depth])
+            if exact is not None:
+                stack.append((exact, depth + 1))
+            single = node.children.get("+")
+            if single is not None:
+                stack.append((single, depth + 1))
+        return list(dict.fromkeys(found))
+
+    def dispatch(self, client, userdata, msg):
+        handlers = self.match(msg.topic)
+        if not handlers:
+            self.unrouted += 1
+            return
+        self.routed += 1
+        for handler in handlers:
+            try:
+                handler(client, userdata, msg)
+            except Exception as e:
+                logger.error(f"Handler for {msg.topic} failed: {e}")
+
+    def stats(self):
+        return {"routed": self.routed, "unrouted": self.unrouted}
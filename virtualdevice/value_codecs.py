@@ -0,0 +1,150 @@
+# value_codecs.py
+#
+# Per-characteristic value formats, declared in device_spec.json:
+#
+#   {"uuid": "dd03", "format": "uint16le", "initial_value": 300, ...}
+#   {"uuid": "dd05", "format": {"struct": "<HBB"}, "initial_value": [300, 1, 2], ...}
+#
+# Formats: uint8, int8, uint16le/be, int16le/be, uint32le/be, int32le/be,
+# utf8, hex, {"struct": "<fmt>"}. Without a format the legacy rule applies:
+# "0x.." strings are hex bytes, anything else is UTF-8 text.
+#
+# Each format compiles once into a ValueCodec whose encode() turns the spec
+# representation into ATT bytes and decode() turns written bytes back into
+# the spec representation.
+
+import struct
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def _parse_int(value):
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, int):
+        return value
+    if isinstance(value, float):
+        return int(value)
+    text = str(value).strip()
+    try:
+        return int(text, 0)
+    except ValueError:
+        return int(float(text))
+
+
+def _hex_bytes(value):
+    if isinstance(value, (bytes, bytearray)):
+        return bytes(value)
+    text = str(value).strip()
+    if text[:2].lower() == "0x":
+        text = text[2:]
+    text = text.replace(":", "").replace(" ", "")
+    if len(text) % 2:
+        text = "0" + text
+    return bytes.fromhex(text)
+
+
+class ValueCodec:
+    def __init__(self, name, encode, decode, size=None):
+        self.name = name
+        self.encode = encode      # spec value -> bytes
+        self.decode = decode      # bytes -> spec value
+        self.size = size          # fixed encoded size, if any
+
+    def __repr__(self):
+        return f"ValueCodec({self.name})"
+
+
+def _int_codec(name, size, signed, byteorder):
+    def encode(value):
+        if isinstance(value, (bytes, bytearray)):
+            return bytes(value)
+        number = _parse_int(value)
+        # Wrap rather than raise, the way a real device register would
+        number &= (1 << (8 * size)) - 1
+        if signed and number >= 1 << (8 * size - 1):
+            number -= 1 << (8 * size)
+        return number.to_bytes(size, byteorder, signed=signed)
+
+    def decode(data):
+        return int.from_bytes(bytes(data[:size]).ljust(size, b"\0"), byteorder, signed=signed)
+
+    return ValueCodec(name, encode, decode, size)
+
+
+def _legacy_encode(value):
+    if isinstance(value, (bytes, bytearray)):
+        return bytes(value)
+    if isinstance(value, bool):
+        return bytes([int(value)])
+    if isinstance(value, int):
+        # Smallest little-endian form, never the N zero bytes bytes(int) gives
+        return value.to_bytes(max(1, (value.bit_length() + 7) // 8), "little")
+    text = str(value)
+    if text[:2].lower() == "0x":
+        return _hex_bytes(text)
+    return text.encode()
+
+
+def _legacy_decode(data):
+    data = bytes(data)
+    try:
+        text = data.decode("utf-8")
+    except UnicodeDecodeError:
+        return "0x" + data.hex()
+    # Raw register bytes that happen to be valid UTF-8 still round-trip as hex
+    return text if text.isprintable() else "0x" + data.hex()
+
+
+def _struct_codec(layout):
+    packer = struct.Struct(layout)
+
+    def encode(value):
+        if isinstance(value, (bytes, bytearray)):
+            return bytes(value)
+        if isinstance(value, str):
+            return _hex_bytes(value)
+        if not isinstance(value, (list, tuple)):
+            value = [value]
+        return packer.pack(*value)
+
+    def decode(data):
+        return list(packer.unpack(bytes(data[:packer.size]).ljust(packer.size, b"\0")))
+
+    return ValueCodec(f"struct:{layout}", encode, decode, packer.size)
+
+
+BUILTIN_CODECS = {
+    "legacy": ValueCodec("legacy", _legacy_encode, _legacy_decode),
+    "utf8": ValueCodec("utf8",
+                       lambda v: bytes(v) if isinstance(v, (bytes, bytearray)) else str(v).encode("utf-8"),
+                       lambda d: bytes(d).decode("utf-8", errors="replace")),
+    "hex": ValueCodec("hex", _hex_bytes, lambda d: "0x" + bytes(d).hex()),
+    "uint8": _int_codec("uint8", 1, False, "little"),
+    "int8": _int_codec("int8", 1, True, "little"),
+}
+for _bits in (16, 32):
+    for _signed in (False, True):
+        for _order, _suffix in (("little", "le"), ("big", "be")):
+            _name = f"{'int' if _signed else 'uint'}{_bits}{_suffix}"
+            BUILTIN_CODECS[_name] = _int_codec(_name, _bits // 8, _signed, _order)
+
+_struct_cache = {}
+
+
+def compile_codec(fmt):
+    """ValueCodec for a spec "format" entry; None or unknown formats get the legacy codec."""
+    if fmt is None:
+        return BUILTIN_CODECS["legacy"]
+    if isinstance(fmt, dict) and "struct" in fmt:
+        layout = fmt["struct"]
+        codec = _struct_cache.get(layout)
+        if codec is None:
+            codec = _struct_cache[layout] = _struct_codec(layout)
+        return codec
+    codec = BUILTIN_CODECS.get(str(fmt).lower().replace("-", "").replace("_", ""))
+    if codec is None:
+        logger.warning(f"⚠️ Unknown value format {fmt!r}, using legacy encoding")
+        return BUILTIN_CODECS["legacy"]
+    return codec
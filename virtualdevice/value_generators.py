@@ -0,0 +1,441 @@
+# value_generators.py
+#
+# Synthetic, changing characteristic values for soak tests, declared per
+# characteristic in device_spec.json instead of authored as CSV:
+#
+#   {"uuid": "dd03", "format": "uint16le",
+#    "generator": {"type": "sine", "offset": 22.5, "amplitude": 3, "period_s": 600,
+#                  "noise": 0.2, "scale": 10}}
+#
+#   random_walk   start, step (std dev per tick), drift
+#   sine          offset, amplitude, period_s, phase, seasonal_amplitude, seasonal_period_s
+#   markov        states [values], transitions [[p]] or stay (probability), start (index)
+#   step          levels [values], dwell_s: cycles through the levels
+#   noise         mean, std
+#
+# Every type also takes noise (std dev added on top), min / max (clip),
+# scale (multiplied in before integer formats are rounded), decimals (text
+# formats) and seed. Randomness is counter based (splitmix64 of seed and
+# tick), so a characteristic replays the same sequence whatever else runs
+# beside it; the default seed comes from the spec path and UUID.
+#
+# All generators of a process live in one GeneratorBank: parameters and
+# state are NumPy arrays over every (device, characteristic) row, and one
+# tick evaluates and encodes them all in a handful of array operations.
+# Only rows whose encoded bytes changed go through set_live() and publish.
+# The tick interval is the smallest "generators": {"interval": ...} of the
+# devices currently registered (1 s for a device that sets none).
+
+import time
+import zlib
+import asyncio
+import logging
+
+from value_store import normalize_uuid
+
+logger = logging.getLogger(__name__)
+
+KINDS = {"random_walk": 0, "sine": 1, "markov": 2, "step": 3, "noise": 4}
+WALK, SINE, MARKOV, STEP, NOISE = range(5)
+MAX_STATES = 16
+DEFAULT_INTERVAL = 1.0
+
+_GOLDEN = 0x9E3779B97F4A7C15
+_MIX1 = 0xBF58476D1CE4E5B9
+_MIX2 = 0x94D049BB133111EB
+
+
+def _numpy():
+    # Generators are optional; only processes that use them pay for the NumPy import
+    import numpy as np
+    return np
+
+
+def _mix(np, z):
+    """splitmix64 finalizer over a uint64 array (wrapping arithmetic)."""
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(_MIX1)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(_MIX2)
+    return z ^ (z >> np.uint64(31))
+
+
+def _uniform(np, seeds, counters, lane):
+    """Uniform [0, 1) per row, a pure function of (seed, counter, lane)."""
+    z = _mix(np, seeds + (counters * np.uint64(4) + np.uint64(lane)) * np.uint64(_GOLDEN))
+    return (z >> np.uint64(11)).astype(np.float64) * (1.0 / (1 << 53))
+
+
+_normal_quantiles = None
+
+
+def _normal(np, seeds, counters, lane):
+    """Standard normal per row: the hashed counter picks one of 4096 normal quantiles."""
+    global _normal_quantiles
+    if _normal_quantiles is None:
+        # Cheaper than Box-Muller's log/sqrt/cos per row, and plenty for synthetic sensors
+        sample = np.sort(np.random.default_rng(0).standard_normal(1 << 20))
+        _normal_quantiles = sample[(1 << 7)::(1 << 8)].copy()
+    z = _mix(np, seeds + (counters * np.uint64(4) + np.uint64(lane)) * np.uint64(_GOLDEN))
+    return _normal_quantiles[z >> np.uint64(52)]
+
+
+def _dtype(np, codec):
+    """NumPy dtype matching a fixed-width numeric codec, or None (encoded per row)."""
+    name = codec.name
+    if name in ("uint8", "int8"):
+        return np.dtype(name)
+    if name[-2:] in ("le", "be") and name[:-2] in ("uint16", "int16", "uint32", "int32"):
+        return np.dtype(name[:-2]).newbyteorder("<" if name.endswith("le") else ">")
+    if name.startswith("struct:"):
+        layout = name[len("struct:"):]
+        order, char = (layout[0], layout[1:]) if layout[:1] in "<>!=@" else ("@", layout)
+        if len(char) == 1 and char in "bBhHiIqQefd":
+            return np.dtype({"!": ">", "@": "="}.get(order, order) + char)
+    return None
+
+
+class _Row:
+    """One generated characteristic; its live state is kept in the bank's arrays."""
+
+    __slots__ = ("owner", "store", "key", "codec", "publish", "spec", "kind", "seed",
+                 "x", "state", "counter")
+
+    def __init__(self, owner, store, key, spec, codec, publish):
+        self.owner = owner
+        self.store = store
+        self.key = key
+        self.codec = codec
+        self.publish = publish
+        self.spec = spec
+        self.kind = KINDS[spec.get("type", "noise")]
+        self.seed = int(spec.get("seed", zlib.crc32(f"{store.json_file}:{key}".encode())))
+        self.x = float(spec.get("start", spec.get("offset", spec.get("mean", 0.0))))
+        self.state = int(spec.get("start", 0)) if self.kind == MARKOV else 0
+        self.counter = 0
+
+
+def _levels(spec):
+    levels = [float(v) for v in spec.get("states" if spec.get("type") == "markov" else "levels", [0.0])]
+    return levels[:MAX_STATES] or [0.0]
+
+
+def _transitions(spec, count):
+    matrix = spec.get("transitions")
+    if matrix:
+        rows = [[float(p) for p in row[:count]] + [0.0] * (count - len(row[:count])) for row in matrix[:count]]
+        rows += [[1.0 if j == i else 0.0 for j in range(count)] for i in range(len(rows), count)]
+    else:
+        stay = float(spec.get("stay", 0.9))
+        move = (1.0 - stay) / (count - 1) if count > 1 else 0.0
+        rows = [[stay if j == i else move for j in range(count)] for i in range(count)]
+    normalized = []
+    for row in rows:
+        total = sum(row)
+        normalized.append([p / total for p in row] if total > 0 else [1.0 / count] * count)
+    return normalized
+
+
+class GeneratorBank:
+    """Every generated characteristic of the process, evaluated in NumPy batches."""
+
+    def __init__(self, interval=DEFAULT_INTERVAL):
+        self.interval = interval
+        self.intervals = {}    # owner -> its requested interval
+        self.rows = []
+        self.ticks = 0
+        self.changed = 0
+        self.last_changed = 0
+        self.generate_time = 0.0
+        self.encode_time = 0.0
+        self.publish_time = 0.0
+        self.started = time.monotonic()
+        self._compiled = False
+        self._task = None
+
+    # Registration ----------------------------------------------------------
+
+    def add(self, owner, store, uuid, spec, codec, publish=None):
+        if spec.get("type", "noise") not in KINDS:
+            raise ValueError(f"Unknown generator type {spec.get('type')!r} for {uuid}")
+        self._sync_back()
+        self.rows.append(_Row(owner, store, normalize_uuid(uuid), spec, codec, publish))
+        self._compiled = False
+
+    def remove(self, owner):
+        self._sync_back()
+        before = len(self.rows)
+        self.rows = [row for row in self.rows if row.owner is not owner]
+        self._compiled = False
+        if self.intervals.pop(owner, None) is not None and self.intervals:
+            self.interval = min(self.intervals.values())
+        if not self.rows:
+            self.stop()
+        return before - len(self.rows)
+
+    def set_interval(self, owner, interval):
+        """Tick at least every `interval` seconds while `owner` has rows."""
+        self.intervals[owner] = float(interval)
+        self.interval = min(self.intervals.values())
+
+    def _sync_back(self):
+        """Copy live state out of the arrays before they are rebuilt."""
+        if not self._compiled:
+            return
+        for i, row in enumerate(self.rows):
+            row.x = float(self.x[i])
+            row.state = int(self.state[i])
+            row.counter = int(self.counters[i])
+
+    def _compile(self):
+        np = _numpy()
+        # Sorted by kind, each kind's parameters and state are one contiguous slice (views, no gathers)
+        self.rows = rows = sorted(self.rows, key=lambda row: row.kind)
+        n = len(rows)
+        spec = [row.spec for row in rows]
+
+        def param(name, default, alias=None):
+            return np.array([float(s.get(name, s.get(alias, default) if alias else default)) for s in spec],
+                            dtype=np.float64)
+
+        self.kind = np.array([row.kind for row in rows], dtype=np.int8)
+        bounds = np.searchsorted(self.kind, np.arange(len(KINDS) + 1))
+        self.index = [slice(int(bounds[k]), int(bounds[k + 1])) for k in range(len(KINDS))]
+        self.base = param("offset", 0.0, "mean")
+        self.amplitude = param("amplitude", 0.0)
+        self.omega = 2.0 * np.pi / param("period_s", 60.0)
+        self.phase = param("phase", 0.0)
+        self.seasonal_amplitude = param("seasonal_amplitude", 0.0)
+        self.seasonal_omega = 2.0 * np.pi / np.array([float(s.get("seasonal_period_s", 0.0)) or np.inf
+                                                      for s in spec])
+        self.step = param("step", 1.0)
+        self.drift = param("drift", 0.0)
+        self.noise = np.array([float(s.get("noise", s.get("std", 0.0) if s.get("type") == "noise" else 0.0))
+                               for s in spec], dtype=np.float64)
+        self.noisy = np.flatnonzero(self.noise)
+        self.dwell = param("dwell_s", 60.0)
+        self.lo = param("min", -np.inf)
+        self.hi = param("max", np.inf)
+        self.scale = param("scale", 1.0)
+
+        stateful = [(i, _levels(s)) for i, (row, s) in enumerate(zip(rows, spec)) if row.kind in (MARKOV, STEP)]
+        width = max((len(levels) for _, levels in stateful), default=1)
+        self.levels = np.zeros((n, width), dtype=np.float64)
+        self.level_count = np.ones(n, dtype=np.int64)
+        self.cumulative = np.ones((n, width, width), dtype=np.float64)
+        for i, levels in stateful:
+            s = spec[i]
+            self.levels[i, :len(levels)] = levels
+            self.level_count[i] = len(levels)
+            if rows[i].kind == MARKOV:
+                matrix = np.array(_transitions(s, len(levels)))
+                self.cumulative[i, :len(levels), :len(levels)] = np.cumsum(matrix, axis=1)
+
+        self.seeds = _mix(np, np.array([row.seed & 0xFFFFFFFFFFFFFFFF for row in rows], dtype=np.uint64))
+        self.x = np.array([row.x for row in rows], dtype=np.float64)
+        self.state = np.minimum(np.array([row.state for row in rows], dtype=np.int64), self.level_count - 1)
+        self.counters = np.array([row.counter for row in rows], dtype=np.uint64)
+
+        # Encoding groups: one per fixed-width dtype, plus per-row text encoding for the rest
+        groups = {}
+        for i, row in enumerate(rows):
+            groups.setdefault(_dtype(np, row.codec), []).append(i)
+        self.groups = []
+        for dtype, members in groups.items():
+            members = np.array(members, dtype=np.int64)
+            previous = None if dtype is None else np.zeros(len(members), dtype=dtype)
+            self.groups.append([dtype, members, previous, True])
+        self._compiled = True
+        logger.info(f"🎲 Compiled {n} value generators in {len(self.groups)} encoding groups")
+
+    # Evaluation ------------------------------------------------------------
+
+    def generate(self, now=None):
+        """Advance every generator one tick; returns the values (before scaling)."""
+        np = _numpy()
+        if not self._compiled:
+            self._compile()
+        t = (time.monotonic() if now is None else now) - self.started
+        seeds, counters = self.seeds, self.counters
+        # Random draws only where a row uses them: lane 0 walks, lane 1 noise, lane 2 Markov steps
+        out = self.base.copy()
+        i = self.index[WALK]
+        if i.stop > i.start:
+            step = self.step[i] * _normal(np, seeds[i], counters[i], 0)
+            self.x[i] = np.clip(self.x[i] + self.drift[i] + step, self.lo[i], self.hi[i])
+            out[i] = self.x[i]
+        i = self.index[SINE]
+        if i.stop > i.start:
+            out[i] += (self.amplitude[i] * np.sin(self.omega[i] * t + self.phase[i])
+                       + self.seasonal_amplitude[i] * np.sin(self.seasonal_omega[i] * t))
+        i = self.index[MARKOV]
+        if i.stop > i.start:
+            u = _uniform(np, seeds[i], counters[i], 2)
+            state = self.state[i]
+            thresholds = np.take_along_axis(self.cumulative[i], state[:, None, None], axis=1)[:, 0]
+            state[:] = np.minimum((u[:, None] >= thresholds).sum(axis=1), self.level_count[i] - 1)
+            out[i] = np.take_along_axis(self.levels[i], state[:, None], axis=1)[:, 0]
+        i = self.index[STEP]
+        if i.stop > i.start:
+            state = self.state[i]
+            state[:] = np.floor((t + self.phase[i]) / self.dwell[i]).astype(np.int64) % self.level_count[i]
+            out[i] = np.take_along_axis(self.levels[i], state[:, None], axis=1)[:, 0]
+
+        i = self.noisy
+        if len(i):
+            out[i] += self.noise[i] * _normal(np, seeds[i], counters[i], 1)
+        np.clip(out, self.lo, self.hi, out=out)
+        counters += np.uint64(1)
+        return out
+
+    def encode(self, values):
+        """Row indices whose encoded value changed, and their new bytes."""
+        np = _numpy()
+        indices, payloads = [], []
+        for group in self.groups:
+            dtype, members, previous, first = group
+            if dtype is None:
+                for i in members:
+                    row = self.rows[i]
+                    decimals = int(row.spec.get("decimals", 1))
+                    data = row.codec.encode(f"{values[i] * self.scale[i]:.{decimals}f}")
+                    if first or data != row.store.get_bytes(row.key):
+                        indices.append(i)
+                        payloads.append(data)
+                group[3] = False
+                continue
+            scaled = values[members] * self.scale[members]
+            if dtype.kind in "iu":
+                info = np.iinfo(dtype)
+                scaled = np.clip(np.rint(scaled), info.min, info.max)
+            encoded = scaled.astype(dtype)
+            moved = np.arange(len(members)) if first else np.flatnonzero(encoded != previous)
+            if len(moved):
+                # A void view turns each element into its own bytes object in C
+                indices.extend(members[moved].tolist())
+                payloads.extend(encoded.view(np.dtype((np.void, dtype.itemsize)))[moved].tolist())
+            group[2] = encoded
+            group[3] = False
+        return indices, payloads
+
+    def tick(self, now=None):
+        """Generate, encode and publish one batch; returns the number of values that changed."""
+        if not self.rows:
+            return 0
+        started = time.perf_counter()
+        values = self.generate(now)
+        generated = time.perf_counter()
+        indices, payloads = self.encode(values)
+        encoded = time.perf_counter()
+        rows = self.rows
+        for i, data in zip(indices, payloads):
+            row = rows[i]
+            row.store.set_live(row.key, data)
+            if row.publish is not None:
+                row.publish(row.owner, row.key)
+        self.generate_time += generated - started
+        self.encode_time += encoded - generated
+        self.publish_time += time.perf_counter() - encoded
+        self.ticks += 1
+        self.last_changed = len(indices)
+        self.changed += len(indices)
+        return len(indices)
+
+    async def _run(self):
+        while self.rows:
+            try:
+                self.tick()
+            except Exception as e:
+                logger.error(f"❌ Value generator tick failed: {e}")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        return self._task
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def stats(self):
+        ticks = self.ticks or 1
+        return {
+            "rows": len(self.rows),
+            "ticks": self.ticks,
+            "interval": self.interval,
+            "changed_total": self.changed,
+            "changed_last": self.last_changed,
+            "generate_us": self.generate_time / ticks * 1e6,
+            "encode_us": self.encode_time / ticks * 1e6,
+            "publish_us": self.publish_time / ticks * 1e6,
+        }
+
+
+_bank = None
+
+
+def get_generator_bank():
+    """Process-wide bank shared by every device in this process."""
+    global _bank
+    if _bank is None:
+        _bank = GeneratorBank()
+    return _bank
+
+
+def start_generators(device, config, publish=None):
+    """Register the device's "generator" characteristics with the process bank, if any."""
+    store = device.value_store
+    found = [(uuid, store.characteristic(uuid).get("generator"))
+             for uuid in device.characteristics_by_uuid
+             if store.characteristic(uuid) is not None and store.characteristic(uuid).get("generator")]
+    if not found:
+        return None
+    bank = get_generator_bank()
+    bank.set_interval(device, config.get("generators", {}).get("interval", DEFAULT_INTERVAL))
+    for uuid, spec in found:
+        bank.add(device, store, uuid, spec, store.codec(uuid), publish)
+    bank.start()
+    logger.info(f"🎲 {len(found)} generated characteristics, ticking every {bank.interval}s")
+    return bank
+
+
+class _BenchmarkStore:
+    json_file = "benchmark"
+
+    def set_live(self, uuid, data):
+        pass
+
+    def get_bytes(self, uuid, default=None):
+        return default
+
+
+def measure_tick(count=10000, ticks=200):
+    """Per-tick cost of `count` generated characteristics spread over all generator types."""
+    from value_codecs import compile_codec
+    specs = [
+        {"type": "random_walk", "start": 20, "step": 0.3, "min": 0, "max": 40, "scale": 10},
+        {"type": "sine", "offset": 22, "amplitude": 3, "period_s": 600, "noise": 0.2, "scale": 10},
+        {"type": "markov", "states": [0, 1, 2], "stay": 0.95},
+        {"type": "step", "levels": [0, 50, 100], "dwell_s": 30},
+        {"type": "noise", "mean": 100, "std": 5},
+    ]
+    codecs = [compile_codec("uint16le"), compile_codec("int16le"), compile_codec("uint8"),
+              compile_codec("uint8"), compile_codec({"struct": "<f"})]
+    bank = GeneratorBank()
+    store = _BenchmarkStore()
+    owner = object()
+    for n in range(count):
+        bank.add(owner, store, f"{n:04x}", specs[n % len(specs)], codecs[n % len(codecs)])
+    bank.tick()
+    bank.generate_time = bank.encode_time = bank.publish_time = 0.0
+    bank.ticks = 0
+    for n in range(ticks):
+        bank.tick(bank.started + n)
+    return {"characteristics": count, **bank.stats()}
+
+
+if __name__ == "__main__":
+    import sys
+    import json
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    print(json.dumps(measure_tick(count), indent=4))
@@ -0,0 +1,249 @@
+# value_store.py
+
+import os
+import json
+import time
+import logging
+import threading
+
+from persistence_journal import atomic_write
+from value_codecs import compile_codec
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_uuid(uuid):
+    """Normalize a UUID string so '0xDD01', 'DD01' and 'dd01' hit the same slot."""
+    uuid = str(uuid).strip().lower()
+    if uuid.startswith("0x"):
+        uuid = uuid[2:]
+    return uuid
+
+
+def encode_spec_value(value_str):
+    """Encode a spec 'initial_value' that has no declared format ("0x.." hex, else UTF-8)."""
+    return compile_codec(None).encode(value_str)
+
+
+class CharacteristicValueStore:
+    """In-memory view of one device_spec.json, indexed by normalized UUID."""
+
+    def __init__(self, json_file):
+        self.json_file = json_file
+        self.config = {}
+        self._chars = {}      # uuid -> characteristic dict inside self.config
+        self._encoded = {}    # uuid -> cached bytes for the current spec value
+        self._live = {}       # uuid -> bytes pushed by a live source (replay, generators)
+        self.codecs = {}      # uuid -> ValueCodec compiled from the characteristic's "format"
+        self._signature = None
+        self._lock = threading.RLock()
+        self.journal = None   # WriteBehindJournal, see persistence_journal.enable_spec_journal
+        self.listeners = []   # callback(normalized uuid) after every set() / set_live()
+        self.reads = 0
+        self.read_time = 0.0
+        self.reloads = 0
+        self.load()
+
+    def _stat_signature(self):
+        try:
+            st = os.stat(self.json_file)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def load(self):
+        """(Re)parse the spec file and rebuild the UUID index."""
+        with self._lock:
+            with open(self.json_file, "r") as f:
+                config = json.load(f)
+            self._signature = self._stat_signature()
+            self.config = config
+            self._chars = {}
+            self._encoded = {}
+            self.codecs = {}
+            for service in config.get("gatt", {}).get("services", []):
+                for char in service.get("characteristics", []):
+                    uuid = char.get("uuid")
+                    if uuid:
+                        key = normalize_uuid(uuid)
+                        self._chars[key] = char
+                        self.codecs[key] = compile_codec(char.get("format"))
+            self.reloads += 1
+            logger.info(f"Indexed {len(self._chars)} characteristics from {self.json_file}")
+            return config
+
+    def reload_if_changed(self):
+        """Reload only if someone else touched the file since we last saw it."""
+        signature = self._stat_signature()
+        if signature is None or signature == self._signature:
+            return []
+        with self._lock:
+            old = {uuid: char.get("initial_value") for uuid, char in self._chars.items()}
+            try:
+                self.load()
+            except Exception as e:
+                logger.error(f"Failed to reload {self.json_file}: {e}")
+                return []
+            if self.journal is not None:
+                # Our own writes that haven't been flushed yet still win
+                for uuid, value in self.journal.pending.items():
+                    char = self._chars.get(normalize_uuid(uuid))
+                    if char is not None:
+                        char["initial_value"] = value
+            return [uuid for uuid, char in self._chars.items()
+                    if old.get(uuid) != char.get("initial_value")]
+
+    def __contains__(self, uuid):
+        return normalize_uuid(uuid) in self._chars
+
+    def uuids(self):
+        return list(self._chars)
+
+    def characteristic(self, uuid):
+        return self._chars.get(normalize_uuid(uuid))
+
+    def codec(self, uuid):
+        return self.codecs.get(normalize_uuid(uuid)) or compile_codec(None)
+
+    def get(self, uuid, default=None):
+        """Raw spec value (string as stored in JSON) for a UUID."""
+        char = self._chars.get(normalize_uuid(uuid))
+        if char is None:
+            return default
+        return char.get("initial_value", "0x00")
+
+    def get_bytes(self, uuid, default=None):
+        """Encoded value for a UUID, cached until the value changes."""
+        start = time.perf_counter()
+        key = normalize_uuid(uuid)
+        value = self._live.get(key)
+        if value is None:
+            value = self._encoded.get(key)
+        if value is None:
+            char = self._chars.get(key)
+            if char is not None:
+                value = self.codecs[key].encode(char.get("initial_value", "0x00"))
+                self._encoded[key] = value
+        self.reads += 1
+        self.read_time += time.perf_counter() - start
+        return default if value is None else value
+
+    def set(self, uuid, value, persist=True):
+        """Update a UUID's spec value in memory and, by default, on disk.
+
+        With a journal attached the disk write is deferred: the value is
+        journaled and the spec is rewritten on the next flush.
+        """
+        key = normalize_uuid(uuid)
+        with self._lock:
+            char = self._chars.get(key)
+            if char is None:
+                logger.warning(f"⚠️ UUID {uuid} not found in {self.json_file}!")
+                return False
+            char["initial_value"] = value
+            self._encoded.pop(key, None)
+            self._live.pop(key, None)
+        self._notify(key)
+        if persist:
+            if self.journal is not None:
+                self.journal.append(key, value)
+            else:
+                self.save()
+        return True
+
+    def set_live(self, uuid, data):
+        """Serve already-encoded bytes for a UUID without touching the spec.
+
+        Used by live sources that change values many times a second; a real
+        write through set() takes over again.
+        """
+        key = normalize_uuid(uuid)
+        self._live[key] = data
+        self._notify(key)
+
+    def add_listener(self, callback):
+        if callback not in self.listeners:
+            self.listeners.append(callback)
+
+    def remove_listener(self, callback):
+        if callback in self.listeners:
+            self.listeners.remove(callback)
+
+    def _notify(self, key):
+        for callback in self.listeners:
+            try:
+                callback(key)
+            except Exception as e:
+                logger.error(f"Value listener failed for {key}: {e}")
+
+    def save(self):
+        """Atomically write the whole spec back and remember the signature as our own."""
+        with self._lock:
+            atomic_write(self.json_file, lambda f: json.dump(self.config, f, indent=4))
+            self._signature = self._stat_signature()
+
+    def stats(self):
+        avg = self.read_time / self.reads if self.reads else 0.0
+        return {"reads": self.reads, "avg_read_us": avg * 1e6, "reloads": self.reloads}
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_value_store(json_file):
+    """Per-device store shared by every characteristic of that spec file."""
+    key = os.path.abspath(json_file)
+    with _stores_lock:
+        store = _stores.get(key)
+        if store is None:
+            store = CharacteristicValueStore(json_file)
+            _stores[key] = store
+        return store
+
+
+def _legacy_read(json_file, uuid):
+    # What DynamicCharacteristic.read_json_value used to do per ATT read
+    with open(json_file, "r") as f:
+        data = json.load(f)
+    for service in data.get("gatt", {}).get("services", []):
+        for char in service.get("characteristics", []):
+            if char.get("uuid", "").lower() == uuid.lower():
+                return encode_spec_value(char.get("initial_value", "0x00"))
+    return None
+
+
+def measure_read_latency(json_file, rounds=1000):
+    """Compare per-read latency of the old re-parse path against the store."""
+    store = CharacteristicValueStore(json_file)
+    uuids = store.uuids()
+    if not uuids:
+        return {}
+
+    start = time.perf_counter()
+    for i in range(rounds):
+        _legacy_read(json_file, uuids[i % len(uuids)])
+    legacy = (time.perf_counter() - start) / rounds
+
+    start = time.perf_counter()
+    for i in range(rounds):
+        store.reload_if_changed()
+        store.get_bytes(uuids[i % len(uuids)])
+    indexed = (time.perf_counter() - start) / rounds
+
+    return {
+        "characteristics": len(uuids),
+        "rounds": rounds,
+        "legacy_read_us": legacy * 1e6,
+        "store_read_us": indexed * 1e6,
+        "speedup": legacy / indexed if indexed else float("inf"),
+    }
+
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) < 2:
+        print("Usage: python value_store.py <device_spec.json> [rounds]")
+        sys.exit(1)
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    print(json.dumps(measure_read_latency(sys.argv[1], rounds), indent=4))